@@ -0,0 +1,312 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple  # type: ignore
+import argparse  # type: ignore
+import datetime  # type: ignore
+import io  # type: ignore
+import json  # type: ignore
+import os  # type: ignore
+import pickle  # type: ignore
+import platform  # type: ignore
+import random  # type: ignore
+import statistics  # type: ignore
+import tempfile  # type: ignore
+import time  # type: ignore
+import networkx as nx  # type: ignore
+from haversine import haversine  # type: ignore
+
+# Benchmarks of the functions on the /find and /guide paths and of the graph
+# build. They run on a synthetic city written to a temporary directory (a
+# street grid the size of Barcelona's walking network, a metro over it and a
+# restaurant list), so they need no network and no real data files; the map
+# tiles come from an offline cache that draws them blank. Results are saved
+# as JSON and can be compared with an earlier run:
+#
+#     python benchmark.py --out before.json
+#     python benchmark.py --out after.json --compare before.json
+
+# Corner and step, in degrees, of the synthetic street grid.
+LON0: float = 2.08
+LAT0: float = 41.34
+STEP: float = 0.0006
+# About the number of nodes of the walking network of Barcelona.
+SIZE: int = 300
+LINES: int = 8
+STATIONS_PER_LINE: int = 20
+RESTAURANTS: int = 3000
+QUERIES: int = 20
+# A benchmark is a regression when it got slower than this ratio.
+THRESHOLD: float = 1.2
+
+WORDS: List[str] = ["Bar", "Can", "Casa", "Restaurant", "Pizzeria", "Café",
+                    "Sushi", "Tapas", "Nou", "Vell", "Mar", "Sol", "Gràcia",
+                    "Forn", "Bodega", "Taverna", "Cuina", "Celler"]
+STREETS: List[str] = ["Carrer de Mallorca", "Gran Via de les Corts",
+                      "Passeig de Gràcia", "Carrer d'Aragó",
+                      "Avinguda Diagonal", "Carrer de Sants",
+                      "Rambla del Poblenou", "Carrer de Verdi"]
+NEIGHBORHOODS: List[str] = ["el Raval", "Sant Antoni", "la Barceloneta",
+                            "la Dreta de l'Eixample", "Vila de Gràcia",
+                            "Sants", "el Poblenou"]
+DISTRICTS: List[str] = ["Ciutat Vella", "Eixample", "Gràcia",
+                        "Sants-Montjuïc", "Sant Martí"]
+STATION_NAMES: List[str] = ["Sants", "Espanya", "Catalunya", "Urquinaona",
+                            "Verdaguer", "Sagrada Família", "Clot",
+                            "Glòries", "Diagonal", "Universitat", "Liceu",
+                            "Drassanes", "Paral·lel", "Poble Sec", "Marina",
+                            "Bogatell", "Llacuna", "Poblenou", "Selva de Mar",
+                            "Fontana", "Lesseps", "Vallcarca", "Penitents",
+                            "Maragall", "Sagrera", "Navas", "Fabra i Puig",
+                            "Tetuan", "Girona", "Passeig de Gràcia"]
+
+
+def make_synthetic_city(directory: str, size: int = SIZE,
+                        seed: int = 1) -> None:
+    """Writes to directory the files the bot builds its data from:
+       barcelona_walk (a size x size street grid as an osmnx graph),
+       estacions.csv, accessos.csv and restaurants.csv"""
+    import pandas as pd  # type: ignore
+    rng = random.Random(seed)
+
+    def node_id(i: int, j: int) -> int:
+        return 30000000 + i * size + j
+
+    g1 = nx.MultiDiGraph(crs="epsg:4326")
+    for i in range(size):
+        for j in range(size):
+            g1.add_node(node_id(i, j),
+                        x=LON0 + j * STEP + rng.uniform(-STEP, STEP) / 4,
+                        y=LAT0 + i * STEP + rng.uniform(-STEP, STEP) / 4)
+    for i in range(size):
+        for j in range(size):
+            for a, b in ((i, j + 1), (i + 1, j)):
+                # Some streets are missing and some have a second way.
+                if a < size and b < size and rng.random() < 0.93:
+                    u, v = node_id(i, j), node_id(a, b)
+                    length: float = haversine(
+                        (g1.nodes[u]["y"], g1.nodes[u]["x"]),
+                        (g1.nodes[v]["y"], g1.nodes[v]["x"]), unit="m")
+                    g1.add_edge(u, v, 0, length=length)
+                    g1.add_edge(v, u, 0, length=length)
+                    if rng.random() < 0.03:
+                        g1.add_edge(u, v, 1, length=length * 1.3)
+    with open(os.path.join(directory, "barcelona_walk"), "wb") as file:
+        pickle.dump(g1, file)
+
+    # Metro lines cross the grid; stations with the same name on different
+    # lines are transfers.
+    stations: List[Dict[str, Any]] = []
+    accesses: List[Dict[str, Any]] = []
+    extent: float = (size - 1) * STEP
+    for line in range(LINES):
+        lon_a, lat_a = LON0 + rng.random() * extent, LAT0
+        lon_b, lat_b = LON0 + rng.random() * extent, LAT0 + extent
+        if line % 2:
+            lon_a, lat_a, lon_b, lat_b = LON0, lat_a + rng.random() * extent, \
+                LON0 + extent, LAT0 + rng.random() * extent
+        colour: str = "%06X" % rng.randrange(1 << 24)
+        for k in range(STATIONS_PER_LINE):
+            t: float = k / (STATIONS_PER_LINE - 1)
+            lon: float = lon_a + t * (lon_b - lon_a)
+            lat: float = lat_a + t * (lat_b - lat_a)
+            station_id: int = 100 * (line + 1) + k
+            name: str = rng.choice(STATION_NAMES)
+            stations.append({"ID_ESTACIO_LINIA": station_id,
+                             "NOM_ESTACIO": name, "NOM_LINIA": "L%d" % line,
+                             "COLOR_LINIA": colour,
+                             "GEOMETRY": "POINT (%r %r)" % (lon, lat)})
+            for a in range(2):
+                accesses.append({
+                    "CODI_ACCES": 10 * station_id + a,
+                    "NOM_ACCES": "%s %d" % (name, a + 1),
+                    "NOM_ESTACIO": name, "ID_ESTACIO": station_id,
+                    "GEOMETRY": "POINT (%r %r)" % (
+                        lon + rng.uniform(-2, 2) * STEP,
+                        lat + rng.uniform(-2, 2) * STEP)})
+    pd.DataFrame(stations).to_csv(os.path.join(directory, "estacions.csv"),
+                                  index=False)
+    pd.DataFrame(accesses).to_csv(os.path.join(directory, "accessos.csv"),
+                                  index=False)
+
+    rows: List[Dict[str, Any]] = []
+    for k in range(RESTAURANTS):
+        rows.append({
+            "name": "%s %d" % (" ".join(rng.sample(WORDS, 2)), k),
+            "addresses_road_name": rng.choice(STREETS + [None]),
+            "addresses_start_street_number": rng.randint(1, 300),
+            "addresses_neighborhood_name": rng.choice(NEIGHBORHOODS),
+            "addresses_district_name": rng.choice(DISTRICTS),
+            "addresses_zip_code": 8001 + rng.randrange(40),
+            "values_value": rng.choice(["93%07d" % rng.randrange(10 ** 7),
+                                        None]),
+            # The csv file has the latitude in x and the longitude in y.
+            "geo_epgs_4326_x": LAT0 + rng.random() * extent,
+            "geo_epgs_4326_y": LON0 + rng.random() * extent})
+    pd.DataFrame(rows).to_csv(os.path.join(directory, "restaurants.csv"),
+                              index=False)
+
+
+def measure(function: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """Returns statistics, in seconds, of running function repeat times"""
+    times: List[float] = []
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"runs": repeat, "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.fmean(times)}
+
+
+def _cycle(items: List[Any]) -> Callable[[], Any]:
+    """Returns a function that gives the items one after the other"""
+    position: List[int] = [0]
+
+    def next_item() -> Any:
+        item = items[position[0] % len(items)]
+        position[0] += 1
+        return item
+    return next_item
+
+
+def run(size: int = SIZE, repeat: int = 5, seed: int = 1,
+        modes: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Generates the synthetic city in a temporary directory and returns the
+       results of every benchmark. modes are the routing.MODES measured on
+       the RoutingGraph; "ch" builds the contraction hierarchy first, which
+       takes minutes on a Barcelona-sized grid."""
+    import city  # type: ignore
+    import metro  # type: ignore
+    import restaurants  # type: ignore
+    import routing  # type: ignore
+    import search  # type: ignore
+    import spatial  # type: ignore
+    import tiles  # type: ignore
+    if modes is None:
+        modes = ["dijkstra", "bidirectional", "astar"]
+    results: Dict[str, Dict[str, float]] = {}
+    previous: str = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        start: float = time.perf_counter()
+        make_synthetic_city(directory, size, seed)
+        generation: float = time.perf_counter() - start
+        # The modules read their files from the working directory.
+        os.chdir(directory)
+        try:
+            tiles.configure(os.path.join(directory, "tiles"), offline=True)
+            g1 = city.load_osmnx_graph("barcelona_walk")
+            g2 = metro.get_metro_graph()
+            results["build_city_graph"] = measure(
+                lambda: city.build_city_graph(g1, g2), max(1, repeat // 2))
+            g = city.build_city_graph(g1, g2)
+            rg = routing.build_routing_graph(g)
+            if "ch" in modes:
+                routing.load_hierarchy(rg, "city_graph_ch")
+            index = spatial.index_from_routing(rg)
+
+            rng = random.Random(seed)
+            extent: float = (size - 1) * STEP
+            points: List[Tuple[float, float]] = [
+                (LON0 + rng.random() * extent, LAT0 + rng.random() * extent)
+                for _ in range(2 * QUERIES)]
+            pairs = _cycle(list(zip(points[::2], points[1::2])))
+            positions = _cycle(points)
+
+            results["get_closest_node/osmnx"] = measure(
+                lambda: city.get_closest_node(g1, positions()), repeat)
+            results["get_closest_node/index"] = measure(
+                lambda: city.get_closest_node(index, positions()),
+                repeat * QUERIES)
+            results["find_path/networkx"] = measure(
+                lambda: city.find_path(index, g, *pairs()), repeat)
+            for mode in modes:
+                results["find_path/" + mode] = measure(
+                    lambda: city.find_path(index, rg, *pairs(), mode), repeat)
+
+            paths = _cycle([city.find_path(index, rg, *pair)
+                            for pair in zip(points[::2], points[1::2])])
+            results["find_time_path/networkx"] = measure(
+                lambda: city.find_time_path(g, paths()), repeat * QUERIES)
+            results["find_time_path/routing"] = measure(
+                lambda: city.find_time_path(rg, paths()), repeat * QUERIES)
+            endpoints = _cycle(list(zip(points[::2], points[1::2])))
+
+            def plot() -> None:
+                src, dst = endpoints()
+                city.plot_path(rg, paths(), io.BytesIO(), src, dst)
+            # The first render fills the tile cache.
+            plot()
+            results["plot_path"] = measure(plot, repeat)
+
+            restaurants_list = restaurants.read()
+            queries = _cycle([["bar"], ["casa", "gracia"], ["sushi", "mar"],
+                              ["restaurant", "eixample"], ["tapas"]])
+            typos = _cycle(["Pizeria", "Tavrna", "Bodga", "Sushu", "Celer"])
+            results["multiple_search"] = measure(
+                lambda: restaurants.multiple_search(queries(),
+                                                    restaurants_list), repeat)
+            results["def_find"] = measure(
+                lambda: restaurants.def_find(typos(), restaurants_list),
+                repeat)
+            search_index = search.build_index(restaurants_list)
+            fuzzy_index = search.build_fuzzy_index(restaurants_list)
+            results["search.find_ids"] = measure(
+                lambda: search.find_ids(search_index, queries()), repeat)
+            results["search.fuzzy_find_ids"] = measure(
+                lambda: search.fuzzy_find_ids(fuzzy_index, [typos()]), repeat)
+        finally:
+            os.chdir(previous)
+    return {"meta": {"size": size, "nodes": size * size, "repeat": repeat,
+                     "seed": seed, "modes": modes,
+                     "generation_seconds": generation,
+                     "python": platform.python_version(),
+                     "machine": platform.machine(),
+                     "date": datetime.datetime.now().isoformat(
+                         timespec="seconds")},
+            "results": results}
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any],
+            threshold: float = THRESHOLD) -> List[str]:
+    """Returns a line for every benchmark with the ratio between the medians
+       of results and baseline, marking the ones slower than threshold"""
+    lines: List[str] = []
+    for name, stats in results["results"].items():
+        if name not in baseline["results"]:
+            lines.append("%-28s %10.6f s   (new)" % (name, stats["median"]))
+            continue
+        ratio: float = stats["median"] / baseline["results"][name]["median"]
+        lines.append("%-28s %10.6f s %6.2fx%s" % (
+            name, stats["median"], ratio,
+            "   REGRESSION" if ratio > threshold else ""))
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks on a synthetic city")
+    parser.add_argument("--size", type=int, default=SIZE,
+                        help="side of the street grid, in nodes")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--modes", default="dijkstra,bidirectional,astar",
+                        help="routing modes to measure, comma separated")
+    parser.add_argument("--out", default="benchmark.json",
+                        help="file the results are written to")
+    parser.add_argument("--compare", help="results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    results: Dict[str, Any] = run(args.size, args.repeat, args.seed,
+                                  args.modes.split(","))
+    with open(args.out, "w") as file:
+        json.dump(results, file, indent=1)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline: Dict[str, Any] = json.load(file)
+        lines: List[str] = compare(results, baseline, args.threshold)
+    else:
+        lines = ["%-28s %10.6f s" % (name, stats["median"])
+                 for name, stats in results["results"].items()]
+    print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,58 @@
+import time  # type: ignore
+# Taken before the other imports, so the startup report includes them.
+STARTED: float = time.perf_counter()
+from typing import Any, Callable  # type: ignore
+from queue import Queue  # type: ignore
+import warnings  # type: ignore
+from telegram import Bot, Update  # type: ignore
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.ext import Dispatcher  # type: ignore
+from telegram.utils.request import Request  # type: ignore
 from city import *  # type: ignore
-import random  # type: ignore
+import timing  # type: ignore
+import metrics  # type: ignore
+import store  # type: ignore
+import workers  # type: ignore
+import search  # type: ignore
+import sessions  # type: ignore
+import catalog  # type: ignore
+import webhook  # type: ignore
 
+# What the bot remembers of every chat, opened by main().
+chats: sessions.SessionStore = sessions.MemorySessionStore()
 
-def load_restaurants() -> restaurants.Restaurants:
-    """Returns the list of all the restaurants in Barcelona"""
-    restaurants_list: restaurants.Restaurants = restaurants.load_restaurants("restaurants_list.pkl")
-    return restaurants_list
+# Minutes /near uses when the user gives none, and the most it searches;
+# larger budgets are cut to it.
+NEAR_MINUTES: int = 10
+MAX_NEAR_MINUTES: int = 30
+
+
+def read_restaurants() -> restaurants.Restaurants:
+    """Returns the list of all the restaurants in Barcelona, read from
+       restaurants.csv if it is here"""
+    if os.path.exists("restaurants.csv"):
+        return restaurants.read()
+    return restaurants.load_restaurants("restaurants_list.pkl")
+
+
+def snap_restaurants(positions: np.ndarray) -> np.ndarray:
+    """Returns the index in the routing graph of the street node closest to
+       every restaurant position"""
+    graphs: store.Graphs = store.get()
+    return snap_to_graph(graphs.spatial_index, graphs.routing_graph,
+                         positions.tolist())
+
+
+def stale_list(update, context, session: sessions.Session,
+               restaurants_catalog: catalog.Catalog) -> bool:
+    """Tells the user to search again if the restaurants changed since the
+       list of the session was made, and returns whether they did"""
+    if session.catalog == restaurants_catalog.version:
+        return False
+    context.bot.send_message(chat_id=update.effective_chat.id,
+                             text="The restaurants have been updated, " +
+                                  "please search again with /find.")
+    return True
 
 
 def start(update, context):
@@ -24,9 +70,14 @@ def help(update, context):
     help_text: str = ("To get the full experience of this bot, you can use " +
                       "the following commands:\n\n🔵 /author: Shows the " +
                       "authors of this project.\n\n🔵 /find <query>: Shows " +
-                      "the 12 closest matching restaurants in barcelona. " +
+                      "the 12 closest matching restaurants in barcelona; " +
+                      "if you have shared your location, with how long " +
+                      "it takes to get there, closest first. " +
                       "\n\n🔵 /info <index>: Shows the information about " +
-                      "the restaurant the user chose.\n\n🔵 /guide <index>: " +
+                      "the restaurant the user chose.\n\n🔵 /near " +
+                      "<minutes>: Shows the 12 closest restaurants you can " +
+                      "reach in that many minutes from the last location " +
+                      "you shared.\n\n🔵 /guide <index>: " +
                       "First asks the user for his/her current location " +
                       "and, once it reads it, returns an image of the " +
                       "fastest way to get to the restaurant chosen, and " +
@@ -42,19 +93,54 @@ def author(update, context):
                                    "Lucas Pons and Jan Quer"))
 
 
+@metrics.handler("find")
 def find(update, context):
     """Returns a list of twelve restaurants that match the search of the
        user."""
     # We read the query the user wants to find
     query: List[str] = context.args
-    restaurants_list: Restaurants = load_restaurants()
-    # We get a list of restaurants from the functin find() in the module
-    # restaurants. Than, we cut the list to get the first 12 matches; if the
-    # list is shorter, this won't modify it.
-    search_list: Restaurants = restaurants.multiple_search(query,
-                                                           restaurants_list)[:12]
-    # We save the search list in the dictionary user_data.
-    context.user_data['restaurants_list'] = search_list
+    # We look the words up in the search index, which gives the positions of
+    # the matching restaurants in the catalog. If none matches, we look for
+    # names and streets that match with a typo, closest ones first. The
+    # catalog may be replaced while we answer; we keep using this one.
+    restaurants_catalog: catalog.Catalog = catalog.get()
+    ids: List[int] = search.find_ids(restaurants_catalog.search_index, query)
+    if not ids:
+        ids = search.fuzzy_find_ids(restaurants_catalog.fuzzy_index, query)
+    # If the user has shared a location, the matches are sorted by how long
+    # it takes to get to them from there. A single search from the user
+    # gives the time to all of them; the ones out of reach go last. The
+    # restaurants were snapped to the graph when the catalog was loaded, so
+    # only their nodes are sent. The search can cover most of the city, so
+    # it runs in a worker process like the routes; if the pool is busy or
+    # slow, the matches are not sorted.
+    chat_id: int = update.effective_chat.id
+    location: Optional[Coord] = chats.get(chat_id).location
+    etas: Dict[int, Optional[int]] = {}
+    if location is not None and ids:
+        job = None
+        try:
+            job = workers.submit_travel_times(
+                location, restaurants_catalog.nodes[ids].tolist())
+            minutes: List[Optional[int]] = job.result(
+                timeout=workers.JOB_TIMEOUT)
+            etas = dict(zip(ids, minutes))
+            ids = sorted(ids, key=lambda i: (etas[i] is None, etas[i] or 0))
+        except workers.PoolBusy:
+            metrics.increment("telbot_handler_errors_total", handler="find",
+                              error="busy")
+        except TimeoutError:
+            job.cancel()
+            metrics.increment("telbot_handler_errors_total", handler="find",
+                              error="timeout")
+    # Than, we cut the list to get the first 12 matches; if the list is
+    # shorter, this won't modify it.
+    search_list: List[str] = [restaurants_catalog.name(i) for i in ids[:12]]
+    metrics.observe("telbot_results", len(search_list), handler="find")
+    # We save the positions of the restaurants in the catalog in the
+    # session of the chat.
+    chats.update(chat_id, ids=tuple(ids[:12]),
+                 catalog=restaurants_catalog.version)
     # We create the text that the bot will send as a message to the user by
     # merging all the elements of the search_list into one string (answer).
     if len(search_list) == 0:
@@ -63,135 +149,359 @@ def find(update, context):
     else:
         answer = "What restaurant are you looking for?\n"
         for i in range(len(search_list)):
-            answer += str(i + 1) + " - " + search_list[i].name + "\n"
+            answer += str(i + 1) + " - " + search_list[i]
+            if ids[i] in etas:
+                eta: Optional[int] = etas[ids[i]]
+                answer += (" (%d min)" % eta if eta is not None else
+                           " (more than %d min)" % (TRAVEL_TIME_LIMIT // 60))
+            answer += "\n"
     # The bot sends as a message the list of the first twelve restaurants that
     # match the search.
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text=answer)
 
 
+@metrics.handler("near")
+def near(update, context):
+    """Returns a list of the twelve closest restaurants the user can reach
+       from his/her last location in the minutes given"""
+    chat_id: int = update.effective_chat.id
+    location: Optional[Coord] = chats.get(chat_id).location
+    if location is None:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Please share your location first, " +
+                                      "then ask me again.")
+        return
+    try:
+        minutes: int = int(context.args[0]) if context.args else NEAR_MINUTES
+    except ValueError:
+        minutes = 0
+    if minutes < 1:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Please use /near <minutes>, with a " +
+                                      "whole number of minutes (up to %d)."
+                                      % MAX_NEAR_MINUTES)
+        return
+    minutes = min(minutes, MAX_NEAR_MINUTES)
+    # The restaurants were snapped to the graph when the bot started, so
+    # only the search from the user is left, and it stops at the budget.
+    graphs: store.Graphs = store.get()
+    restaurants_catalog: catalog.Catalog = catalog.get()
+    found: List[Tuple[int, int]] = find_within(
+        graphs.spatial_index, graphs.routing_graph,
+        location, minutes, restaurants_catalog.nodes)[:12]
+    search_list: List[str] = [restaurants_catalog.name(i) for i, _ in found]
+    metrics.observe("telbot_results", len(search_list), handler="near")
+    # The list is saved like the one of /find, so /info and /guide use it.
+    chats.update(chat_id, ids=tuple(i for i, _ in found),
+                 catalog=restaurants_catalog.version)
+    if len(search_list) == 0:
+        answer: str = ("There are no restaurants %d minutes away from you, " +
+                       "try with more minutes!") % minutes
+    else:
+        answer = "These are the restaurants %d minutes away:\n" % minutes
+        for i in range(len(search_list)):
+            answer += "%d - %s (%d min)\n" % (i + 1, search_list[i],
+                                               found[i][1])
+    context.bot.send_message(chat_id=update.effective_chat.id, text=answer)
+
+
+@metrics.handler("info")
 def info(update, context):
     """Returns the information about the restaurant selected by the user from
        the list given"""
     # We read the index the user wants information about.
     index: int = int(context.args[0])
     # We check that the user has first entered a /find command.
-    if 'restaurants_list' not in context.user_data.keys():
+    session: sessions.Session = chats.get(update.effective_chat.id)
+    ids: Optional[Tuple[int, ...]] = session.ids
+    if ids is None:
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Please enter the command /find to " +
                                       "allow me to search the matching " +
                                       "restaurants.")
         return
-    # We upload the search_list from the user_data; each user will have it's
-    # own list.
-    search_list: Restaurants = context.user_data['restaurants_list']
+    restaurants_catalog: catalog.Catalog = catalog.get()
+    if stale_list(update, context, session, restaurants_catalog):
+        return
+    # The session of each user has the positions in the catalog of the
+    # restaurants of its own list.
     if index > 12:
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Please choose a restaurant index " +
                                       "between 1 and 12.")
         return
-    elif index > len(search_list):
+    elif index > len(ids):
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Please choose a restaurant index " +
                                       "between 1 and %d." % index)
         return
     # We create the text that the bot will send as a message (answer) to the
     # user by merging all the attributes of the chosen restaurant.
+    restaurant: Restaurant = restaurants_catalog.restaurant(ids[index - 1])
     answer: str = "This is the information about index; %d\n" % index
-    answer += " - Name: %s.\n" % search_list[index - 1].name
-    answer += " - Address: %s, %d, %s, %s, %d.\n" % (search_list[index - 1].street,
-                   search_list[index - 1].number,
-                   search_list[index - 1].neighborhood,
-                   search_list[index - 1].district,
-                   search_list[index - 1].zip)
-    if search_list[index - 1].telf:
-        answer += " - Telephone Number: %s.\n" % search_list[index - 1].telf
+    answer += " - Name: %s.\n" % restaurant.name
+    answer += " - Address: %s, %d, %s, %s, %d.\n" % (restaurant.street,
+                   restaurant.number,
+                   restaurant.neighborhood,
+                   restaurant.district,
+                   restaurant.zip)
+    if restaurant.telf:
+        answer += " - Telephone Number: %s.\n" % restaurant.telf
     context.bot.send_message(chat_id=update.effective_chat.id, text=answer)
 
 
+@metrics.handler("guide")
 def guide(update, context):
     """Sends the user an image of the route from his/her current location to
        the restaurant selected"""
     index: int = int(context.args[0])
-    if 'restaurants_list' not in context.user_data.keys():
+    chat_id: int = update.effective_chat.id
+    session: sessions.Session = chats.get(chat_id)
+    ids: Optional[Tuple[int, ...]] = session.ids
+    if ids is None:
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Please find restaurants.")
         return
-    search_list: Restaurants = context.user_data['restaurants_list']
-    if index > 12 or index > len(search_list):
+    restaurants_catalog: catalog.Catalog = catalog.get()
+    if stale_list(update, context, session, restaurants_catalog):
+        return
+    if index > 12 or index > len(ids):
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Please choose a restaurant index " +
                                       "between 1 and 12.")
         return
-    context.user_data['restaurant_position'] = search_list[index - 1].position
+    i: int = ids[index - 1]
+    chats.update(chat_id, destination=restaurants_catalog.position(i))
     context.bot.send_message(chat_id=update.effective_chat.id,
     text="I will guide you to %s, you just need to share your location!"
-          % search_list[index - 1].name)
+          % restaurants_catalog.name(i))
 
 
+@metrics.handler("path")
 def path(update, context):
     try:
         # We get the position of the user
         user_position: Coord = (update.message.location.longitude,
                                 update.message.location.latitude)
+        # The last location is kept to sort the results of /find.
+        session: sessions.Session = chats.update(update.effective_chat.id,
+                                                 location=user_position)
+        if session.destination is None:
+            context.bot.send_message(chat_id=update.effective_chat.id,
+                                     text="Thanks! Your next /find will " +
+                                          "show the closest restaurants " +
+                                          "first, and /near <minutes> " +
+                                          "the ones you can reach.")
+            return
         # We get the position of the restaurant.
-        restaurant_position: Coord = context.user_data["restaurant_position"]
-        # We build the path with the functino find_path() from city.py
-        path: Path = find_path(load_osmnx_graph("barcelona_walk"),
-                               load_city_graph("city_graph"),
-                               user_position, restaurant_position)
-        total_time: int = int(find_time_path(load_city_graph("city_graph"),
-                                             path))
-
-        # answer: str = "To get to the chosen restaurant you need to follow these instructions:\n"
-
-        # We create a random name for the filename since, at the end of the
-        # function, the file will be deleted
-        filename: str = "%d.png" % random.randint(1000000, 9999999)
-        # We create the map, saved as filename, where the path from the user's
-        # location to the restaurant is painted.
-        plot_path(load_city_graph("city_graph"), path, filename,
-                  user_position, restaurant_position)
+        restaurant_position: Coord = session.destination
+        # The route is computed and drawn by one of the worker processes,
+        # which already hold the graphs. This handler runs in its own thread,
+        # so waiting for the job does not stop the other commands.
+        start: float = time.perf_counter()
+        job = workers.submit_route(user_position, restaurant_position)
+        image, total_time, stages = job.result(timeout=workers.JOB_TIMEOUT)
+        waited: float = time.perf_counter() - start
+        # The worker measures its own stages; the rest of the wait is the
+        # time the job spent queued or passing between the processes.
+        for stage, seconds in stages.items():
+            metrics.observe("telbot_stage_seconds", seconds, stage=stage)
+        metrics.observe("telbot_stage_seconds",
+                        waited - sum(stages.values()), stage="queue")
         # The bot sends the map to the user.
-        context.bot.send_photo(chat_id=update.effective_chat.id,
-                               photo=open(filename, 'rb'))
+        with metrics.stage("upload"):
+            context.bot.send_photo(chat_id=update.effective_chat.id,
+                                   photo=image)
+        metrics.increment("telbot_image_bytes_total", len(image))
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Trip will be of approx %d minutes."
                                       % total_time)
-        # We delete the map.
-        os.remove(filename)
+    except workers.PoolBusy:
+        metrics.increment("telbot_handler_errors_total", handler="path",
+                          error="busy")
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="I'm guiding too many people right " +
+                                      "now, please share your location " +
+                                      "again in a moment.")
+    except TimeoutError:
+        # If the job has not started yet, it won't.
+        job.cancel()
+        metrics.increment("telbot_handler_errors_total", handler="path",
+                          error="timeout")
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="The route is taking too long, " +
+                                      "please try again later.")
     except Exception as e:
         print(e)
+        metrics.increment("telbot_handler_errors_total", handler="path",
+                          error=type(e).__name__)
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text='💣')
 
 
-def start_bot():
+def read_token() -> str:
     # declara una constant amb el access token que llegeix de token.txt
-    TOKEN = open('token.txt').read().strip()
-    # crea objectes per treballar amb Telegram
-    updater = Updater(token=TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
-    # indica que quan el bot rebi la comanda /start s'executi la funció start
+    return open('token.txt').read().strip()
+
 
-    commands: Dict[str, str] = {'start': start, 'help': help,
-                                'author': author, 'find': find,
-                                'info': info, 'guide': guide}
+def add_handlers(dispatcher: Dispatcher, run_async: bool = True) -> None:
+    """Adds the handlers of the commands and of the locations. /find and
+       the locations wait for the worker processes, so they run in threads
+       of their own; without run_async they are handled in the thread that
+       gets them, like the other commands."""
+    # indica que quan el bot rebi la comanda /start s'executi la funció start
+    commands: Dict[str, Callable[..., Any]] = {
+        'start': start, 'help': help, 'author': author, 'find': find,
+        'near': near, 'info': info, 'guide': guide}
     for command in commands.keys():
-        dispatcher.add_handler(CommandHandler(command, commands[command]))
+        dispatcher.add_handler(CommandHandler(
+            command, commands[command],
+            run_async=run_async and command == 'find'))
+
+    dispatcher.add_handler(MessageHandler(Filters.location, path,
+                                          run_async=run_async))
+
+
+def start_services(timer: Optional[timing.Timer] = None,
+                   route_workers: int = workers.WORKERS,
+                   metrics_port: Optional[int] = None,
+                   rebuild_catalog: bool = True) -> None:
+    """Starts what the handlers use besides the graphs and the catalog: the
+       route workers, the session store, the catalog reloads and, if a port
+       is given, the metrics server. Without rebuild_catalog, another
+       process builds the stored restaurants again when they change."""
+    global chats
+    if timer is None:
+        timer = timing.Timer()
+    # The workers are forked now, before the bot starts its threads. They
+    # search the routes with the mode named by TELBOT_ROUTE_MODE; "ch" needs
+    # the hierarchy built beforehand with python store.py.
+    with timer.stage("workers"):
+        workers.start(route_workers, mode=os.environ.get("TELBOT_ROUTE_MODE")
+                      or workers.ROUTE_MODE)
+    # The sessions are kept in memory, or in the SQLite file named by
+    # TELBOT_SESSIONS so they survive restarts. The file is opened after the
+    # fork, so the workers don't share the connection.
+    with timer.stage("sessions"):
+        chats = sessions.open_store(os.environ.get("TELBOT_SESSIONS"))
+    # From now on the catalog is loaded again when its files change.
+    catalog.watch(rebuild=rebuild_catalog)
+    # Metrics are only recorded when there is a port to serve them on. The
+    # server thread is started after the workers have been forked.
+    if metrics_port is not None:
+        metrics.enable(metrics_port)
+
 
-    dispatcher.add_handler(MessageHandler(Filters.location, path))
+def stop_services() -> None:
+    """Stops what start_services() started"""
+    catalog.stop()
+    metrics.disable()
+    workers.shutdown()
+
+
+def start_bot(base_url: Optional[str] = None):
+    TOKEN = read_token()
+    # crea objectes per treballar amb Telegram
+    # There is a thread for every /guide the worker pool may be running.
+    # base_url points the bot to another Bot API server (see loadtest.py);
+    # by default it talks to Telegram.
+    updater = Updater(token=TOKEN, use_context=True, workers=workers.MAX_QUEUE,
+                      base_url=base_url)
+    add_handlers(updater.dispatcher)
     # engega el bot
     updater.start_polling()
     updater.idle()
 
 
+def start_shard(index: int, shards: int, base_url: Optional[str] = None
+                ) -> Callable[[webhook.Update], None]:
+    """Starts the services of webhook shard index and returns the function
+       that handles its updates. The cores are split among the route
+       workers of all the shards, and the metrics of shard index are served
+       on TELBOT_METRICS_PORT + index. The stored restaurants are built again
+       by the server process, and the shards map them again."""
+    port: Optional[str] = os.environ.get("TELBOT_METRICS_PORT")
+    start_services(route_workers=max(1, workers.WORKERS // shards),
+                   metrics_port=int(port) + index if port else None,
+                   rebuild_catalog=False)
+    # Every thread of the shard may be sending at the same time.
+    bot = Bot(read_token(), base_url,
+              request=Request(con_pool_size=webhook.THREADS + 4))
+    # No handler runs asynchronously here, so the dispatcher needs no
+    # threads of its own (and would warn about it).
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        dispatcher = Dispatcher(bot, Queue(), workers=0)
+    # The /find or location of a chat must be handled before its next
+    # update, so they run in the thread handling their chat; the shard
+    # hands the updates of other chats to its other threads meanwhile.
+    add_handlers(dispatcher, run_async=False)
+    return lambda data: dispatcher.process_update(Update.de_json(data, bot))
+
+
+def start_webhook(port: int, url: Optional[str] = None,
+                  shards: int = webhook.SHARDS,
+                  base_url: Optional[str] = None) -> None:
+    """Serves the bot in webhook mode until the process is stopped, with
+       the updates spread among that many shard processes. url is the public
+       address of the server registered with Telegram, and its path is the
+       one the server takes updates at; without it the webhook has to be set
+       separately, with the path /."""
+    token: str = read_token()
+    secret: str = webhook.secret_token(token)
+    server = webhook.WebhookServer(
+        lambda index: start_shard(index, shards, base_url), secret, shards,
+        port=port, path=webhook.path_of(url) if url else "/",
+        teardown=stop_services)
+    server.start()
+    # Only this process builds the stored restaurants again when
+    # restaurants.csv changes; the shards then map the new files.
+    catalog.watch()
+    try:
+        if url:
+            Bot(token, base_url).set_webhook(url, secret_token=secret)
+        server.wait()
+    finally:
+        catalog.stop()
+        server.stop()
+
+
 def main():
-    g: CityGraph = load_city_graph("city_graph")
-    ox_g: OsmnxGraph = load_osmnx_graph("barcelona_walk")
-    restaurants_list: restaurants.Restaurants = load_restaurants()
+    timer = timing.Timer()
+    timer.add("imports", time.perf_counter() - STARTED)
+    # The graphs are loaded once and shared by all the handlers.
+    with timer.stage("graphs"):
+        store.load("city_graph")
+    # The restaurants are stored in a mapped directory that is built again
+    # whenever restaurants.csv changes; the catalog adds their search
+    # indices and graph nodes.
+    with timer.stage("restaurants"):
+        catalog.load(read_restaurants, snap_restaurants)
+    with timer.stage("freeze"):
+        store.freeze()
+    # Load tests draw the maps on blank tiles instead of downloading them.
+    if os.environ.get("TELBOT_OFFLINE_TILES"):
+        import tiles  # type: ignore
+        tiles.configure(offline=True)
+    # With TELBOT_WEBHOOK_PORT the updates come from Telegram to that port
+    # and are handled by TELBOT_SHARDS processes, which start their own
+    # services; otherwise this process polls for them.
+    base_url: Optional[str] = os.environ.get("TELBOT_API_URL")
+    if os.environ.get("TELBOT_WEBHOOK_PORT"):
+        print(timer.report())
+        print("done uploading")
+        start_webhook(int(os.environ["TELBOT_WEBHOOK_PORT"]),
+                      os.environ.get("TELBOT_WEBHOOK_URL"),
+                      int(os.environ.get("TELBOT_SHARDS") or webhook.SHARDS),
+                      base_url)
+        return
+    metrics_port: Optional[str] = os.environ.get("TELBOT_METRICS_PORT")
+    start_services(timer, metrics_port=int(metrics_port) if metrics_port
+                   else None)
+    print(timer.report())
     print("done uploading")
-    start_bot()
+    start_bot(base_url)
 
 
 main()
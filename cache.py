@@ -0,0 +1,73 @@
+from collections import OrderedDict  # type: ignore
+from typing import Any, Dict, Hashable, Optional, Tuple  # type: ignore
+import threading  # type: ignore
+import time  # type: ignore
+
+
+class LRUCache:
+    """Thread safe cache that forgets the least recently used entries when it
+       holds more than max_entries entries (or more than max_size in total
+       size, if it is given) and the entries older than ttl seconds."""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None,
+                 max_size: Optional[int] = None) -> None:
+        self.max_entries: int = max_entries
+        self.ttl: Optional[float] = ttl
+        self.max_size: Optional[int] = max_size
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        # key -> (value, size, time it was stored)
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int, float]]" = \
+            OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Returns the value stored with key, or None if there is none"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and \
+                    time.monotonic() - entry[2] > self.ttl:
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int = 1) -> None:
+        """Stores value with key; size only matters when max_size is given"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_size is not None and size > self.max_size:
+                return
+            self._entries[key] = (value, size, time.monotonic())
+            self.size += size
+            while len(self._entries) > self.max_entries or \
+                    (self.max_size is not None and self.size > self.max_size):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Forgets all the entries"""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the counters of the cache"""
+        return {"entries": len(self._entries), "size": self.size,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
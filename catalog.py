@@ -0,0 +1,236 @@
+from dataclasses import dataclass  # type: ignore
+from typing import Any, Callable, Dict, List, Optional, Tuple  # type: ignore
+from typing import TypeAlias  # type: ignore
+import hashlib  # type: ignore
+import math  # type: ignore
+import os  # type: ignore
+import threading  # type: ignore
+import numpy as np  # type: ignore
+import restaurants  # type: ignore
+import search  # type: ignore
+import storage  # type: ignore
+
+# The catalog keeps the restaurants the bot answers with as the columns
+# stored by storage.py, mapped from their files, plus what the commands need
+# computed once: the normalized texts and search indices, the positions and
+# the graph nodes closest to them. Restaurant objects are only made for the
+# one a user asks about.
+#
+# Like the graph store, the catalog is a snapshot that is replaced as a
+# whole. watch() checks restaurants.csv and the stored files every few
+# seconds and, when they change, builds a new snapshot in its thread and
+# then publishes it; handlers that already got the old one keep using it.
+#
+# When several processes watch the same files, only one of them may build
+# the stored files again; the others watch(rebuild=False) and only map them
+# again when that one has replaced them.
+
+Coord: TypeAlias = Tuple[float, float]
+
+# Seconds between the checks of watch().
+RELOAD_INTERVAL: float = 10
+# Fields /find searches in and fields the typo tolerant search uses.
+SEARCH_FIELDS: List[str] = ["name", "street", "neighborhood", "district"]
+FUZZY_FIELDS: List[str] = ["name", "street"]
+
+
+@dataclass(frozen=True)
+class Catalog:
+    columns: Dict[str, np.ndarray]      # see storage.load_restaurant_columns
+    positions: np.ndarray               # float64 (n, 2), (lon, lat)
+    lower: Dict[str, List[Optional[str]]]  # normalized text fields
+    search_index: search.SearchIndex
+    fuzzy_index: search.FuzzyIndex
+    nodes: np.ndarray                   # see city.snap_to_graph, -1 if none
+    version: str                        # changes when the restaurants do
+    generation: int
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def name(self, i: int) -> str:
+        return str(self.columns["name"][i])
+
+    def position(self, i: int) -> Coord:
+        lon, lat = self.positions[i].tolist()
+        return (lon, lat)
+
+    def restaurant(self, i: int) -> restaurants.Restaurant:
+        """Returns the restaurant with id i; missing text values are NaN, as
+           when they are read from the csv file"""
+        values: List[Any] = []
+        for field in storage.RESTAURANT_FIELDS:
+            if field + "_missing" in self.columns and \
+                    self.columns[field + "_missing"][i]:
+                values.append(math.nan)
+            else:
+                values.append(self.columns[field][i].item())
+        return restaurants.Restaurant(*values, self.position(i))
+
+
+Snap: TypeAlias = Callable[[np.ndarray], np.ndarray]
+
+_catalog: Optional[Catalog] = None
+_build: Callable[[], restaurants.Restaurants] = lambda: []
+_snap: Optional[Snap] = None
+_signature: Tuple[Tuple[str, int, int], ...] = ()
+_rebuild: bool = True
+_lock = threading.Lock()
+_watcher: Optional[threading.Thread] = None
+_stop = threading.Event()
+
+
+def _text_column(columns: Dict[str, np.ndarray],
+                 field: str) -> List[Optional[str]]:
+    """Returns the normalized values of a text field, None where they are
+       missing or the field holds no text"""
+    if field + "_missing" not in columns:
+        return [None] * len(columns["position"])
+    return [None if missing else search.normalize(value) for value, missing in
+            zip(columns[field].tolist(), columns[field + "_missing"].tolist())]
+
+
+def _version(columns: Dict[str, np.ndarray]) -> str:
+    digest = hashlib.sha256()
+    for name in sorted(columns):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(columns[name]).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def build_catalog(columns: Dict[str, np.ndarray],
+                  snap: Optional[Snap] = None,
+                  generation: int = 1) -> Catalog:
+    """Returns the catalog of the restaurants stored in columns. snap gives
+       the graph node of every position, if it is given."""
+    positions: np.ndarray = np.asarray(columns["position"])
+    lower: Dict[str, List[Optional[str]]] = {
+        field: _text_column(columns, field) for field in SEARCH_FIELDS}
+    texts: List[List[str]] = [
+        [text for text in row if text is not None]
+        for row in zip(*[lower[field] for field in SEARCH_FIELDS])]
+    fuzzy_texts: List[List[str]] = [
+        [text for text in row if text is not None]
+        for row in zip(*[lower[field] for field in FUZZY_FIELDS])]
+    nodes: np.ndarray = np.full(len(positions), -1, dtype=np.int64)
+    if snap is not None:
+        nodes = snap(positions)
+    return Catalog(columns, positions, lower, search.index_texts(texts),
+                   search.fuzzy_index_texts(fuzzy_texts), nodes,
+                   _version(columns), generation)
+
+
+def _sources() -> List[str]:
+    """Returns the files whose changes make the catalog reload"""
+    manifest: List[str] = [
+        os.path.join(storage.RESTAURANTS_DIRECTORY, storage.MANIFEST)]
+    return storage.RESTAURANTS_SOURCES + manifest if _rebuild else manifest
+
+
+def _not_built() -> restaurants.Restaurants:
+    raise RuntimeError("the stored restaurants are being built again")
+
+
+def _stat(sources: List[str]) -> Tuple[Tuple[str, int, int], ...]:
+    signature: List[Tuple[str, int, int]] = []
+    for source in sources:
+        if os.path.exists(source):
+            status = os.stat(source)
+            signature.append((source, status.st_size, status.st_mtime_ns))
+    return tuple(signature)
+
+
+def load(build: Callable[[], restaurants.Restaurants],
+         snap: Optional[Snap] = None) -> Catalog:
+    """Loads the catalog from the stored restaurants, which are built again
+       with build() when restaurants.csv changed, and publishes it"""
+    global _build, _snap
+    _build, _snap = build, snap
+    return reload()
+
+
+def reload() -> Catalog:
+    """Loads the catalog again and replaces the published one once the new
+       one is complete"""
+    global _catalog, _signature
+    with _lock:
+        generation: int = 1 if _catalog is None else _catalog.generation + 1
+        if _rebuild:
+            columns: Dict[str, np.ndarray] = storage.load_restaurant_columns(
+                storage.RESTAURANTS_DIRECTORY, _build)
+            # Taken after loading, since loading may rewrite the stored
+            # files.
+            _signature = _stat(_sources())
+        else:
+            # The files are mapped as they are; while the process that
+            # builds them is replacing them they are loaded again later.
+            signature: Tuple[Tuple[str, int, int], ...] = _stat(_sources())
+            columns = storage.load_restaurant_columns(
+                storage.RESTAURANTS_DIRECTORY, _not_built, sources=[])
+            if _stat(_sources()) != signature:
+                raise RuntimeError("the stored restaurants changed while "
+                                   "they were loaded")
+            _signature = signature
+        _catalog = build_catalog(columns, _snap, generation)
+        return _catalog
+
+
+def reload_if_changed() -> bool:
+    """Reloads the catalog if its files changed since it was loaded; returns
+       whether it did"""
+    if _stat(_sources()) == _signature:
+        return False
+    reload()
+    return True
+
+
+def get() -> Catalog:
+    """Returns the current catalog"""
+    catalog: Optional[Catalog] = _catalog
+    if catalog is None:
+        raise RuntimeError("the restaurant catalog has not been loaded")
+    return catalog
+
+
+def _watch(interval: float) -> None:
+    while not _stop.wait(interval):
+        try:
+            reload_if_changed()
+        except Exception as e:
+            # A file caught half written is read again on the next check.
+            print("could not reload the restaurants:", e)
+
+
+def watch(interval: float = RELOAD_INTERVAL, rebuild: bool = True) -> None:
+    """Starts a thread that reloads the catalog when its files change. Start
+       it after the workers are forked. Without rebuild, the stored files
+       are only mapped again once another process has built them."""
+    global _watcher, _rebuild, _signature
+    if _watcher is None:
+        _rebuild = rebuild
+        _signature = tuple(entry for entry in _signature
+                           if entry[0] in _sources())
+        _stop.clear()
+        _watcher = threading.Thread(target=_watch, args=(interval,),
+                                    name="catalog", daemon=True)
+        _watcher.start()
+
+
+def stop() -> None:
+    global _watcher
+    _stop.set()
+    if _watcher is not None:
+        _watcher.join()
+        _watcher = None
+
+
+def _after_fork() -> None:
+    # Only the thread that forked goes on in the child process, so a reload
+    # the watcher was doing never ends there, and the child starts its own
+    # watcher.
+    global _lock, _watcher
+    _lock = threading.Lock()
+    _watcher = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -1,15 +1,29 @@
 from dataclasses import dataclass  # type: ignore
-from typing import Union, Optional, TextIO, List, Tuple, TypeAlias
-from staticmap import StaticMap, CircleMarker, Line  # type: ignore
+from typing import Union, Optional, TextIO, BinaryIO, Dict, List, Tuple
+from typing import TYPE_CHECKING, TypeAlias  # type: ignore
 import networkx as nx  # type: ignore
-import matplotlib.pyplot as plt  # type: ignore
-import osmnx as ox  # type: ignore
+import numpy as np  # type: ignore
 import restaurants  # type: ignore
 import metro  # type: ignore
+import routing  # type: ignore
+import spatial  # type: ignore
+import cache  # type: ignore
+import geometry  # type: ignore
+import osm  # type: ignore
+import timing  # type: ignore
 import pickle  # type: ignore
 import time  # type: ignore
+import gc  # type: ignore
+import math  # type: ignore
 import os  # type: ignore
 
+# osmnx, pandas, matplotlib and staticmap are only needed to build the graphs
+# or to draw them, so the functions that use them import them and loading
+# this module (and starting the bot) does not.
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+    from staticmap import StaticMap  # type: ignore
+
 CityGraph: TypeAlias = nx.Graph
 MetroGraph: TypeAlias = nx.Graph
 OsmnxGraph: TypeAlias = nx.MultiDiGraph
@@ -19,6 +33,14 @@ Coord: TypeAlias = Tuple[float, float]
 NodeID: TypeAlias = Union[int, str]
 Path: TypeAlias = List[NodeID]
 
+# Seconds after which find_travel_times() and travel_times_to() stop looking
+# for destinations.
+TRAVEL_TIME_LIMIT: float = 90 * 60
+# OpenStreetMap extracts the walk graph is built from when one of them
+# exists, instead of downloading it, and the part of them that is kept.
+OSM_EXTRACTS: List[str] = ["barcelona.osm.pbf", "barcelona.osm"]
+BARCELONA_BBOX: osm.Bbox = (2.0524, 41.3170, 2.2283, 41.4682)
+
 
 @dataclass
 class Edge:
@@ -27,8 +49,17 @@ class Edge:
     col_id: str
 
 
-def get_osmnx_graph() -> OsmnxGraph:
-    """Returns a osmnxgraph"""
+def get_osmnx_graph(extract: Optional[str] = None) -> OsmnxGraph:
+    """Returns a osmnxgraph. It is read from the OpenStreetMap file extract
+       or, if none is given, from the first of OSM_EXTRACTS that exists, and
+       downloaded only when there is none."""
+    if extract is None:
+        extract = next((filename for filename in OSM_EXTRACTS
+                        if os.path.exists(filename)), None)
+    if extract is not None:
+        return osmnx_graph_from_tables(
+            *osm.read_walk_tables(extract, BARCELONA_BBOX))
+    import osmnx as ox  # type: ignore
     g: OsmnxGraph = ox.graph_from_place('Barcelona, Catalonia, Spain',
                                         simplify=True, network_type='walk')
     return g
@@ -66,42 +97,116 @@ def load_city_graph(filename: str) -> CityGraph:
         g: CityGraph = pickle.load(pickle_in)
         pickle_in.close()
     else:
-        g1: OsmnxGraph = load_osmnx_graph("barcelona_walk")
-        g2: MetroGraph = metro.get_metro_graph()
-        g = build_city_graph(g1, g2)
+        g = make_city_graph()
         save_city_graph(g, filename)
     return g
 
 
-def add_g1(g: CityGraph, g1: OsmnxGraph) -> None:
+def make_city_graph() -> CityGraph:
+    """Builds the city graph from the osmnx graph and the metro files and
+       prints how long every stage took"""
+    timer = timing.Timer()
+    with timer.stage("osmnx graph"):
+        g1: OsmnxGraph = load_osmnx_graph("barcelona_walk")
+    with timer.stage("metro graph"):
+        # The accesses are read once, for the metro graph and for connecting
+        # them to the streets.
+        accesses_list: metro.Accesses = metro.read_accesses()
+        g2: MetroGraph = metro.get_metro_graph(metro.read_stations(),
+                                               accesses_list)
+    g: CityGraph = build_city_graph(g1, g2, timer, accesses_list)
+    print(timer.report())
+    return g
 
-    # for each node and its neighbours' information ...
-    for u, nbrsdict in g1.adjacency():
-        x_u: float = g1.nodes[u]["x"]
-        y_u: float = g1.nodes[u]["y"]
-        coord_u: Coord = (x_u, y_u)
-        g.add_node(u, type="Street", position=coord_u)
-        # for each adjacent node v and its (u, v) edges' information ...
-        for v, edgesdict in nbrsdict.items():
-            x_v: float = g1.nodes[v]["x"]
-            y_v: float = g1.nodes[v]["y"]
-            coord_v: Coord = (x_v, y_v)
-            g.add_node(v, type="Street", position=coord_v)
-
-            edge_type: str = "Street"
-            # Hem de calcular la distancia dels edges del graf OsmnxGraph; en
-            # canvi cada aresta del MetroGraph té guardada la seva distancia
-            # osmnx graphs are multigraphs, but we will just consider their
-            # first edge
-            eattr = edgesdict[0]    # eattr contains the attributes of the
-            # first edge we remove geometry information from eattr because we
-            # don't need it and take a lot of space
-            distance: float = eattr["length"]
-            col_id: str = "#fffc38"
-            edge = Edge(edge_type, distance, col_id)
-            speed: float = 1.5
-            time: float = distance / speed
-            g.add_edge(u, v, info=edge, weight=time)
+
+def osmnx_tables(g1: OsmnxGraph) -> Tuple["pd.DataFrame", "pd.DataFrame"]:
+    """Returns the table of nodes (indexed by id, with columns x and y) and
+       the table of edges (columns u, v, key and length) of g1, both in the
+       order of g1. Only the first edge (key 0) between two nodes is kept."""
+    import pandas as pd  # type: ignore
+    nodes = pd.DataFrame({"x": [x for _, x in g1.nodes(data="x")],
+                          "y": [y for _, y in g1.nodes(data="y")]},
+                         index=list(g1.nodes))
+    edges = pd.DataFrame([(u, v, 0, keys[0]["length"])
+                          for u, nbrs in g1.adjacency()
+                          for v, keys in nbrs.items()],
+                         columns=["u", "v", "key", "length"])
+    return nodes, edges
+
+
+def osmnx_graph_from_tables(nodes: "pd.DataFrame",
+                            edges: "pd.DataFrame") -> OsmnxGraph:
+    """Returns the osmnx graph with the tables of osmnx_tables(), in the
+       order of the tables"""
+    g1: OsmnxGraph = nx.MultiDiGraph(crs="epsg:4326")
+    g1.add_nodes_from((node, {"x": x, "y": y}) for node, x, y in
+                      zip(nodes.index.tolist(), nodes["x"].tolist(),
+                          nodes["y"].tolist()))
+    g1.add_edges_from((u, v, key, {"length": length})
+                      for u, v, key, length in
+                      zip(edges["u"].tolist(), edges["v"].tolist(),
+                          edges["key"].tolist(), edges["length"].tolist()))
+    return g1
+
+
+def add_g1(g: CityGraph, g1: OsmnxGraph) -> None:
+    add_g1_tables(g, *osmnx_tables(g1))
+
+
+def add_g1_tables(g: CityGraph, nodes: "pd.DataFrame",
+                  edges: "pd.DataFrame") -> None:
+    """Adds the streets given by the tables of osmnx_tables() to g. The
+       edges table may also be indexed by (u, v, key), like the edges
+       GeoDataFrame of osmnx. The nodes and edges are added in the same order
+       as walking the adjacency of the osmnx graph, so the graph is the same
+       one."""
+    import pandas as pd  # type: ignore
+    if "u" not in edges.columns:
+        edges = edges.reset_index()
+    # osmnx graphs are multigraphs, but we will just consider their first edge
+    edges = edges[edges["key"] == 0]
+    ids = nodes.index
+    # The edges of every node go right after it, in their order.
+    u_positions: np.ndarray = ids.get_indexer(edges["u"])
+    order: np.ndarray = np.argsort(u_positions, kind="stable")
+    u: np.ndarray = edges["u"].to_numpy()[order]
+    v: np.ndarray = edges["v"].to_numpy()[order]
+    distance: np.ndarray = edges["length"].to_numpy(dtype=np.float64)[order]
+    counts: np.ndarray = np.bincount(u_positions[order], minlength=len(ids))
+    starts: np.ndarray = np.arange(len(ids)) + np.cumsum(counts) - counts
+    # Each node is added the first time it shows up as u or as a neighbour v.
+    sequence = np.empty(len(ids) + len(v),
+                        dtype=np.result_type(ids.dtype, v.dtype))
+    is_u = np.zeros(len(sequence), dtype=bool)
+    is_u[starts] = True
+    sequence[is_u] = ids.to_numpy()
+    sequence[~is_u] = v
+    added = pd.unique(sequence)
+    coords = nodes.loc[added, ["x", "y"]]
+    g.add_nodes_from((node, {"type": "Street", "position": coord})
+                     for node, coord in zip(added.tolist(),
+                                            zip(coords["x"].tolist(),
+                                                coords["y"].tolist())))
+
+    # g is undirected, so (u, v) and (v, u) are the same edge: it takes its
+    # place in the adjacency the first time it is added and its attributes
+    # the last time. Only that place and those attributes are added.
+    u_sorted: np.ndarray = u_positions[order].astype(np.int64)
+    v_positions: np.ndarray = ids.get_indexer(v).astype(np.int64)
+    pairs, _ = pd.factorize(np.minimum(u_sorted, v_positions) * len(ids) +
+                            np.maximum(u_sorted, v_positions))
+    # pairs are numbered in the order they first show up.
+    _, first = np.unique(pairs, return_index=True)
+    last = np.zeros(len(first), dtype=np.int64)
+    np.maximum.at(last, pairs, np.arange(len(pairs)))
+    speed: float = 1.5
+    time: np.ndarray = distance[last] / speed
+    col_id: str = "#fffc38"
+    g.add_edges_from((a, b, {"info": Edge("Street", d, col_id), "weight": t})
+                     for a, b, d, t in zip(u[first].tolist(),
+                                           v[first].tolist(),
+                                           distance[last].tolist(),
+                                           time.tolist()))
 
 
 def add_g2(g: CityGraph, g2: MetroGraph) -> None:
@@ -124,14 +229,18 @@ def add_g2(g: CityGraph, g2: MetroGraph) -> None:
         g.add_edge(e[0], e[1], info=edge, weight=time)
 
 
-def connect_accesses_to_closest_intersection(g: CityGraph,
-                                             g1: OsmnxGraph) -> None:
-    accesses_list: metro.Accesses = metro.read_accesses()
-    for access in accesses_list:
-        closest_node, distance = ox.distance.nearest_nodes(g1,
-                                                           access.position[0],
-                                                           access.position[1],
-                                                           return_dist=True)
+def connect_accesses_to_closest_intersection(
+        g: CityGraph, g1: OsmnxGraph,
+        accesses_list: Optional[metro.Accesses] = None) -> None:
+    # The accesses are read if they are not given.
+    if accesses_list is None:
+        accesses_list = metro.read_accesses()
+    # All accesses are snapped at once with an index of the street nodes.
+    index: spatial.SpatialIndex = spatial.index_from_osmnx(g1)
+    closest_nodes, distances = spatial.nearest_nodes(
+        index, [access.position for access in accesses_list])
+    for access, closest_node, distance in zip(accesses_list, closest_nodes,
+                                              distances.tolist()):
         # 562726252 = Id node; 35,8m = distancia entre access i node
         edge = Edge("Street", distance, "#fbac2c")
         speed: float = 1.5
@@ -139,33 +248,184 @@ def connect_accesses_to_closest_intersection(g: CityGraph,
         g.add_edge(access.id, closest_node, info=edge, weight=time)
 
 
-def build_city_graph(g1: OsmnxGraph, g2: MetroGraph) -> CityGraph:
+def build_city_graph(g1: OsmnxGraph, g2: MetroGraph,
+                     timer: Optional[timing.Timer] = None,
+                     accesses_list: Optional[metro.Accesses] = None
+                     ) -> CityGraph:
     # fusió de g1 (nodes: Street; edges: Street) i g2 (nodes: Station, Access;
     # edges: enllaç, access, tram)
-    g = nx.Graph()
-    add_g1(g, g1)
-    add_g2(g, g2)
-    connect_accesses_to_closest_intersection(g, g1)
-    g.remove_edges_from(nx.selfloop_edges(g))
+    # The time of every stage is added to timer, if it is given.
+    if timer is None:
+        timer = timing.Timer()
+    # Everything allocated here stays alive, so the garbage collector would
+    # only walk the growing graph again and again.
+    collecting: bool = gc.isenabled()
+    gc.disable()
+    try:
+        g = nx.Graph()
+        with timer.stage("osmnx tables"):
+            nodes, edges = osmnx_tables(g1)
+        with timer.stage("streets"):
+            add_g1_tables(g, nodes, edges)
+        with timer.stage("metro"):
+            add_g2(g, g2)
+        with timer.stage("accesses"):
+            connect_accesses_to_closest_intersection(g, g1,
+                                                        accesses_list)
+        with timer.stage("self loops"):
+            g.remove_edges_from(nx.selfloop_edges(g))
+    finally:
+        if collecting:
+            gc.enable()
     return g  # Fusio de tots els carrers i el graf metro
 
 
-def get_closest_node(ox_g: OsmnxGraph, position: Coord) -> NodeID:
+def get_closest_node(ox_g: Union[OsmnxGraph, spatial.SpatialIndex],
+                     position: Coord) -> NodeID:
+    """Returns the street node closest to position. ox_g can be the osmnx
+       graph or a SpatialIndex of its nodes, which is built once and answers
+       without scanning the graph."""
+    if isinstance(ox_g, spatial.SpatialIndex):
+        return spatial.nearest_node(ox_g, position)[0]
+    import osmnx as ox  # type: ignore
     x: float = position[0]
     y: float = position[1]
     node: NodeID = ox.distance.nearest_nodes(ox_g, x, y)
     return node
 
 
-def find_path(ox_g: OsmnxGraph, g: CityGraph, src: Coord, dst: Coord) -> Path:
+def find_path(ox_g: Union[OsmnxGraph, spatial.SpatialIndex],
+              g: Union[CityGraph, routing.RoutingGraph],
+              src: Coord, dst: Coord, mode: str = "dijkstra") -> Path:
+    """Returns the fastest path between the nodes closest to src and dst.
+       g can be the CityGraph or its RoutingGraph, which is much faster and
+       returns the same path. With a RoutingGraph, mode chooses the search
+       (see routing.MODES); "astar" and "bidirectional" settle far fewer
+       nodes on short trips and return the same route."""
     src_node: NodeID = get_closest_node(ox_g, src)
     dst_node: NodeID = get_closest_node(ox_g, dst)
+    return _shortest_path(g, src_node, dst_node, mode)
+
+
+def _shortest_path(g: Union[CityGraph, routing.RoutingGraph],
+                   src_node: NodeID, dst_node: NodeID, mode: str) -> Path:
+    if isinstance(g, routing.RoutingGraph):
+        return routing.shortest_path(g, src_node, dst_node, mode)
     path: Path = nx.shortest_path(g, source=src_node, target=dst_node,
                                   weight="weight", method='dijkstra')
     return path
 
 
-def find_time_path(g: CityGraph, p: Path) -> int:
+def find_route(ox_g: Union[OsmnxGraph, spatial.SpatialIndex],
+               g: Union[CityGraph, routing.RoutingGraph], src: Coord,
+               dst: Coord, mode: str = "dijkstra",
+               routes: Optional[cache.LRUCache] = None,
+               timer: Optional[timing.Timer] = None) -> Tuple[Path, int]:
+    """Returns the fastest path between the nodes closest to src and dst and
+       the minutes it takes. Routes are kept in routes by their pair of
+       snapped nodes, so users going from the same places to the same
+       restaurants only compute them once. The time of snapping and routing
+       is added to timer, if it is given."""
+    if timer is None:
+        timer = timing.Timer()
+    with timer.stage("snap"):
+        src_node: NodeID = get_closest_node(ox_g, src)
+        dst_node: NodeID = get_closest_node(ox_g, dst)
+    if routes is not None:
+        route: Optional[Tuple[Path, int]] = routes.get((src_node, dst_node))
+        if route is not None:
+            return route
+    with timer.stage("route"):
+        path: Path = _shortest_path(g, src_node, dst_node, mode)
+        route = (path, find_time_path(g, path))
+    if routes is not None:
+        routes.put((src_node, dst_node), route)
+    return route
+
+
+def find_travel_times(ox_g: Union[OsmnxGraph, spatial.SpatialIndex],
+                      g: Union[CityGraph, routing.RoutingGraph], src: Coord,
+                      dsts: List[Coord], limit: float = TRAVEL_TIME_LIMIT
+                      ) -> List[Optional[int]]:
+    """Returns the minutes it takes to go from src to each of dsts, all of
+       them found by a single search from src instead of a find_path() for
+       every one. The search stops at limit seconds; destinations farther
+       than that, or without a position, get None."""
+    src_node: NodeID = get_closest_node(ox_g, src)
+    positions: np.ndarray = np.array(dsts, dtype=np.float64).reshape(-1, 2)
+    known: np.ndarray = np.isfinite(positions).all(axis=1)
+    if isinstance(ox_g, spatial.SpatialIndex):
+        nodes, _ = spatial.nearest_nodes(ox_g, positions[known])
+    else:
+        nodes = [get_closest_node(ox_g, tuple(p)) for p in positions[known]]
+    if isinstance(g, routing.RoutingGraph):
+        seconds: List[float] = routing.travel_times(
+            g, routing.node_index(g, src_node),
+            np.array([routing.node_index(g, node) for node in nodes],
+                     dtype=np.int64), limit).tolist()
+    else:
+        reached = nx.single_source_dijkstra_path_length(
+            g, src_node, cutoff=limit, weight="weight")
+        seconds = [reached.get(node, math.inf) for node in nodes]
+    minutes: List[Optional[int]] = [None] * len(positions)
+    for i, duration in zip(np.flatnonzero(known).tolist(), seconds):
+        if duration <= limit:
+            minutes[i] = int(duration // 60)
+    return minutes
+
+
+def snap_to_graph(ox_g: spatial.SpatialIndex, g: routing.RoutingGraph,
+                  positions: List[Coord]) -> np.ndarray:
+    """Returns the index in g of the street node closest to every position,
+       or -1 for the positions that are missing. Places that don't move,
+       like the restaurants, are snapped once and then looked up with
+       find_within()."""
+    points: np.ndarray = np.array(positions, dtype=np.float64).reshape(-1, 2)
+    known: np.ndarray = np.isfinite(points).all(axis=1)
+    indices: np.ndarray = np.full(len(points), -1, dtype=np.int64)
+    nodes, _ = spatial.nearest_nodes(ox_g, points[known])
+    indices[known] = [routing.node_index(g, node) for node in nodes]
+    return indices
+
+
+def find_within(ox_g: spatial.SpatialIndex, g: routing.RoutingGraph,
+                src: Coord, minutes: float,
+                places: np.ndarray) -> List[Tuple[int, int]]:
+    """Returns the places that can be reached from src in the given minutes,
+       walking and by metro, as (position in places, minutes) pairs from the
+       closest to the farthest. places are the node indices given by
+       snap_to_graph(). The search from src stops when it runs out of
+       time."""
+    limit: float = minutes * 60
+    s: int = routing.node_index(g, get_closest_node(ox_g, src))
+    times: np.ndarray = routing.reachable(g, s, limit)
+    # Missing places (-1) are pointed to the source and then dropped.
+    seconds: np.ndarray = np.where(places >= 0, times[np.maximum(places, 0)],
+                                   np.inf)
+    within: np.ndarray = np.flatnonzero(seconds <= limit)
+    within = within[np.argsort(seconds[within], kind="stable")]
+    return [(i, int(t // 60)) for i, t in
+            zip(within.tolist(), seconds[within].tolist())]
+
+
+def travel_times_to(ox_g: spatial.SpatialIndex, g: routing.RoutingGraph,
+                    src: Coord, places: List[int],
+                    limit: float = TRAVEL_TIME_LIMIT) -> List[Optional[int]]:
+    """Returns the minutes it takes to go from src to each of places, the
+       node indices given by snap_to_graph(), like find_travel_times() does
+       for positions. Places farther than limit seconds, or missing (-1),
+       get None."""
+    s: int = routing.node_index(g, get_closest_node(ox_g, src))
+    targets: np.ndarray = np.asarray(places, dtype=np.int64)
+    times: np.ndarray = routing.reachable(g, s, limit)
+    seconds: np.ndarray = np.where(targets >= 0,
+                                   times[np.maximum(targets, 0)], np.inf)
+    return [int(t // 60) if t <= limit else None for t in seconds.tolist()]
+
+
+def find_time_path(g: Union[CityGraph, routing.RoutingGraph], p: Path) -> int:
+    if isinstance(g, routing.RoutingGraph):
+        return int(routing.path_time(g, p) // 60)
     total_time: float = 0
     for i in range(len(p) - 1):
         total_time += float(g[p[i]][p[i + 1]]["weight"])
@@ -175,6 +435,7 @@ def find_time_path(g: CityGraph, p: Path) -> int:
 
 def show(g: CityGraph) -> None:
     # mostra g de forma interactiva en una finestra
+    import matplotlib.pyplot as plt  # type: ignore
     pos = nx.get_node_attributes(g, 'position')
     nx.draw(g, pos, node_size=10)
     plt.show()
@@ -190,69 +451,93 @@ def node_color(g: CityGraph, node: str) -> str:
     return color
 
 
-def plot(g: CityGraph, filename: str) -> None:
+def plot(g: CityGraph, filename: str,
+         tolerance: Optional[float] = None) -> None:
     """Prints the representation of a graph on top of a map with nodes painted
        in black and edges in different colors, depending on the line they
-       represent."""
-    # We create the list edges which is a list of edges, each one represented
-    # as a Tuple of two nodes.
-    # edges: List[Tuple[str, str]] = list(g.edges)
+       represent. With a tolerance (in pixels) the lines are simplified
+       before they are drawn."""
+    import tiles  # type: ignore
     # We create the dictionary pos that contains the position of every node in
     # the graph.
     pos = nx.get_node_attributes(g, 'position')
     # We create the empty map
-    m = StaticMap(3000, 4000, 80)
-    for edge in list(g.edges):
-        nodeA = edge[0]
-        nodeB = edge[1]
-        # We get the position of the two nodes that connect the edge i
-        pos_node_A: Coord = (pos[nodeA][0], pos[nodeA][1])
-        pos_node_B: Coord = (pos[nodeB][0], pos[nodeB][1])
-        # We add the two nodes to the map with the functin add_marker() as
-        # circles.
-        color_nodeA: str = node_color(g, nodeA)
-        color_nodeB: str = node_color(g, nodeB)
-        # We get the color of the line that connects NodeA and NodeB getting
-        # the attribute "col_id" of the edge i.
-        col_id: str = g[edge[0]][edge[1]]["info"].col_id
-        # We add the edge that connects NodeA and NodeB to the map.
-        paint_union_two_points(m, pos_node_A, pos_node_B, color_nodeA, color_nodeB, col_id)
+    m = tiles.new_map(3000, 4000, 80)
+    # We get the color of every edge from the attribute "col_id" of its info.
+    edges: List[Tuple[NodeID, NodeID, str]] = [
+        (a, b, g[a][b]["info"].col_id) for a, b in g.edges]
+    colors: Dict[NodeID, str] = {node: node_color(g, node) for node in g}
+    tiles.add_network(m, edges, pos, colors, 8, 5)
+    zoom: Optional[int] = None
+    if tolerance is not None:
+        zoom = m.simplify_lines(tolerance)
     # We save the map.
-    image = m.render()
+    image = m.render(zoom=zoom)
     image.save(filename)
 
 
-def paint_union_two_points(m: StaticMap, point_A: Coord, point_B: Coord,
+def paint_union_two_points(m: "StaticMap", point_A: Coord, point_B: Coord,
                      color_A: str, color_B: str, color_line: str) -> None:
+    from staticmap import CircleMarker, Line  # type: ignore
     m.add_marker(CircleMarker(point_A, color_A, 8))
     m.add_marker(CircleMarker(point_B, color_B, 8))
     m.add_line(Line((point_A, point_B), color_line, 5))
 
 
-def plot_path(g: CityGraph, p: Path, filename: str, src: Coord,
-              dst: Coord) -> None:
-    # mostra el camí p en l'arxiu filename
-    # We create the empty map
-    m = StaticMap(500, 500)
-
-    pos_node_src: Coord = g.nodes[p[0]]["position"]
-    paint_union_two_points(m, src, pos_node_src, "black", "black", "black")
-
+def path_lines(g: Union[CityGraph, routing.RoutingGraph],
+               p: Path) -> Tuple[List[Coord], List[str]]:
+    """Returns the positions of the nodes of p and the colour each of its
+       edges is painted with: black for streets and the colour of the line
+       for the metro"""
+    if isinstance(g, routing.RoutingGraph):
+        indices: List[int] = [routing.node_index(g, node) for node in p]
+        positions: List[Coord] = [tuple(position) for position in
+                                  g.positions[indices].tolist()]
+        street: int = g.edge_type_names.index("Street")
+        colours: List[str] = []
+        for i, j in zip(indices, indices[1:]):
+            k: int = routing.edge_position(g, i, j)
+            colours.append("black" if g.edge_types[k] == street
+                           else g.colour_names[g.colours[k]])
+        return positions, colours
+    positions = [g.nodes[node]["position"] for node in p]
+    colours = []
     for i in range(len(p) - 1):
-        pos_node_A: Coord = g.nodes[p[i]]["position"]
-        pos_node_B: Coord = g.nodes[p[i + 1]]["position"]
         if g[p[i]][p[i + 1]]["info"].edge_type == "Street":
-            color: str = "black"
+            colours.append("black")
         else:
-            color = g[p[i]][p[i + 1]]["info"].col_id
-        m.add_line(Line((pos_node_A, pos_node_B), color, 5))
+            colours.append(g[p[i]][p[i + 1]]["info"].col_id)
+    return positions, colours
 
-    pos_node_dst: Coord = g.nodes[p[-1]]["position"]
-    paint_union_two_points(m, pos_node_dst, dst, "black", "black", "black")
 
+def plot_path(g: Union[CityGraph, routing.RoutingGraph], p: Path,
+              filename: Union[str, BinaryIO], src: Coord, dst: Coord,
+              tolerance: Optional[float] = None) -> None:
+    # mostra el camí p en l'arxiu filename, que també pot ser un buffer
+    # With a tolerance (in pixels) the route is simplified before it is drawn.
+    from staticmap import Line  # type: ignore
+    import tiles  # type: ignore
+    # We create the empty map
+    m = tiles.new_map(500, 500)
+    positions, colours = path_lines(g, p)
+
+    paint_union_two_points(m, src, positions[0], "black", "black", "black")
+
+    # Consecutive edges of the same colour are drawn as one line; the colour
+    # already tells the streets from every metro line. StaticMap would drop
+    # the points of a line closer than a few pixels, so it is told not to.
+    for line, colour in geometry.merge_runs(positions, colours):
+        m.add_line(Line(line, colour, 5, simplify=False))
+
+    paint_union_two_points(m, positions[-1], dst, "black", "black", "black")
+
+    zoom: Optional[int] = None
+    if tolerance is not None:
+        zoom = m.simplify_lines(tolerance)
     # We save the map.
-    image = m.render()
-    image.save(filename)
+    image = m.render(zoom=zoom)
+    # The format is given so that buffers, which have no extension, work.
+    image.save(filename, "PNG")
 
 # def main():
 #     g1: OsmnxGraph = load_osmnx_graph("barcelona_walk")
@@ -0,0 +1,280 @@
+from dataclasses import dataclass  # type: ignore
+from typing import Optional, Dict, List, Tuple, TypeAlias  # type: ignore
+from heapq import heappush, heappop, heapify  # type: ignore
+import hashlib  # type: ignore
+import os  # type: ignore
+import numpy as np  # type: ignore
+
+# A contraction hierarchy orders the nodes by importance and "contracts" them
+# from the least to the most important one. Contracting a node removes it and
+# adds a shortcut between two of its neighbours whenever the only fastest
+# path between them went through it. A query then only has to go up the
+# hierarchy from both ends, which settles a few hundred nodes instead of
+# a large part of the city.
+
+Adjacency: TypeAlias = List[Dict[int, float]]
+
+# Limits of the local searches that look for paths avoiding the node being
+# contracted. Stopping early only adds shortcuts that were not needed.
+WITNESS_SETTLED: int = 400
+# The last nodes of a street grid are connected to many others and almost every
+# pair of them needs a shortcut, so for nodes with more neighbours than this
+# the searches are skipped and all the shortcuts are added.
+WITNESS_DEGREE: int = 24
+FORMAT_VERSION: int = 1
+
+
+@dataclass
+class ContractionHierarchy:
+    """Upward graph of a contraction hierarchy in CSR form. The edges of node
+       i go to nodes of higher rank; middles holds the contracted node a
+       shortcut replaces, or -1 for the edges of the original graph."""
+    checksum: str
+    rank: np.ndarray     # int32 (n)
+    offsets: np.ndarray  # int32 (n + 1)
+    targets: np.ndarray  # int32
+    weights: np.ndarray  # float64
+    middles: np.ndarray  # int32
+
+
+def graph_checksum(offsets: np.ndarray, neighbours: np.ndarray,
+                   weights: np.ndarray) -> str:
+    """Returns a checksum of a CSR graph, used to know if a stored hierarchy
+       belongs to it"""
+    digest = hashlib.sha256()
+    for array in (offsets, neighbours, weights):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def _witness(adj: Adjacency, source: int, avoid: int, limit: float,
+             targets: Dict[int, float]) -> Dict[int, float]:
+    """Returns the distances from source, without going through avoid, to the
+       nodes of targets that can be reached in less than limit"""
+    dists: Dict[int, float] = {}
+    found: Dict[int, float] = {}
+    fringe: List[Tuple[float, int]] = [(0.0, source)]
+    seen: Dict[int, float] = {source: 0.0}
+    while fringe and len(dists) < WITNESS_SETTLED:
+        dist, v = heappop(fringe)
+        if v in dists:
+            continue
+        if dist > limit:
+            break
+        dists[v] = dist
+        if v in targets:
+            found[v] = dist
+            if len(found) == len(targets):
+                break
+        for w, weight in adj[v].items():
+            if w == avoid or w in dists:
+                continue
+            vw_length: float = dist + weight
+            if vw_length < seen.get(w, limit + 1):
+                seen[w] = vw_length
+                heappush(fringe, (vw_length, w))
+    return found
+
+
+def _shortcuts(adj: Adjacency, v: int) -> List[Tuple[int, int, float]]:
+    """Returns the shortcuts (u, w, weight) needed to contract v"""
+    neighbours: List[Tuple[int, float]] = list(adj[v].items())
+    shortcuts: List[Tuple[int, int, float]] = []
+    if len(neighbours) > WITNESS_DEGREE:
+        for i, (u, uv) in enumerate(neighbours[:-1]):
+            for w, vw in neighbours[i + 1:]:
+                if uv + vw < adj[u].get(w, uv + vw + 1):
+                    shortcuts.append((u, w, uv + vw))
+        return shortcuts
+    for i, (u, uv) in enumerate(neighbours[:-1]):
+        targets: Dict[int, float] = {w: uv + vw
+                                     for w, vw in neighbours[i + 1:]}
+        witnesses = _witness(adj, u, v, max(targets.values()), targets)
+        for w, via_v in targets.items():
+            if witnesses.get(w, via_v + 1) > via_v:
+                shortcuts.append((u, w, via_v))
+    return shortcuts
+
+
+def _priority(adj: Adjacency, deleted: List[int],
+              shortcuts: List[Tuple[int, int, float]], v: int) -> int:
+    """Returns how good it is to contract v now: nodes that add few shortcuts
+       and whose neighbours have not lost many neighbours go first"""
+    return len(shortcuts) - len(adj[v]) + deleted[v]
+
+
+def build_contraction_hierarchy(offsets: np.ndarray, neighbours: np.ndarray,
+                                weights: np.ndarray) -> ContractionHierarchy:
+    """Returns the contraction hierarchy of the undirected CSR graph given by
+       offsets, neighbours and weights"""
+    n: int = len(offsets) - 1
+    adj: Adjacency = [{} for _ in range(n)]
+    middle: Dict[Tuple[int, int], int] = {}
+    offsets_list: List[int] = offsets.tolist()
+    neighbours_list: List[int] = neighbours.tolist()
+    weights_list: List[float] = weights.tolist()
+    for u in range(n):
+        for k in range(offsets_list[u], offsets_list[u + 1]):
+            adj[u][neighbours_list[k]] = weights_list[k]
+
+    deleted: List[int] = [0] * n
+    fringe: List[Tuple[int, int]] = [
+        (_priority(adj, deleted, _shortcuts(adj, v), v), v) for v in range(n)]
+    heapify(fringe)
+    rank: List[int] = [0] * n
+    upward: List[List[Tuple[int, float, int]]] = [[] for _ in range(n)]
+    contracted: int = 0
+    while fringe:
+        _, v = heappop(fringe)
+        # Lazy updates: the priority is computed again and, if v is not the
+        # best node any more, it goes back to the queue.
+        shortcuts: List[Tuple[int, int, float]] = _shortcuts(adj, v)
+        priority: int = _priority(adj, deleted, shortcuts, v)
+        if fringe and priority > fringe[0][0]:
+            heappush(fringe, (priority, v))
+            continue
+        for u, w, weight in shortcuts:
+            if weight < adj[u].get(w, weight + 1):
+                adj[u][w] = weight
+                adj[w][u] = weight
+                middle[(min(u, w), max(u, w))] = v
+        for u, weight in adj[v].items():
+            upward[v].append((u, weight, middle.get((min(u, v), max(u, v)),
+                                                    -1)))
+            del adj[u][v]
+            deleted[u] += 1
+        adj[v] = {}
+        rank[v] = contracted
+        contracted += 1
+
+    up_offsets = np.zeros(n + 1, dtype=np.int32)
+    up_offsets[1:] = np.cumsum([len(edges) for edges in upward])
+    edges = [edge for node_edges in upward for edge in node_edges]
+    return ContractionHierarchy(
+        graph_checksum(offsets, neighbours, weights),
+        np.array(rank, dtype=np.int32), up_offsets,
+        np.array([edge[0] for edge in edges], dtype=np.int32),
+        np.array([edge[1] for edge in edges], dtype=np.float64),
+        np.array([edge[2] for edge in edges], dtype=np.int32))
+
+
+def save_contraction_hierarchy(ch: ContractionHierarchy,
+                               filename: str) -> None:
+    """Saves the hierarchy ch in file named filename"""
+    with open(filename, "wb") as file:
+        np.savez(file, version=np.array(FORMAT_VERSION),
+                 checksum=np.array(ch.checksum), rank=ch.rank,
+                 offsets=ch.offsets, targets=ch.targets, weights=ch.weights,
+                 middles=ch.middles)
+
+
+def load_contraction_hierarchy(filename: str, offsets: np.ndarray,
+                               neighbours: np.ndarray, weights: np.ndarray,
+                               build: bool = True
+                               ) -> Optional[ContractionHierarchy]:
+    """Returns the hierarchy of the given graph stored in the file named
+       filename. If the file does not exist or belongs to another graph, it
+       is built (and saved) again, or None is returned without build."""
+    checksum: str = graph_checksum(offsets, neighbours, weights)
+    if os.path.exists(filename):
+        with np.load(filename) as data:
+            if (int(data["version"]) == FORMAT_VERSION and
+                    str(data["checksum"]) == checksum):
+                return ContractionHierarchy(checksum, data["rank"],
+                                            data["offsets"], data["targets"],
+                                            data["weights"], data["middles"])
+    if not build:
+        return None
+    ch = build_contraction_hierarchy(offsets, neighbours, weights)
+    save_contraction_hierarchy(ch, filename)
+    return ch
+
+
+def _unpack(ch: ContractionHierarchy, path: List[int]) -> List[int]:
+    """Returns the path of the original graph that the path of the hierarchy
+       stands for, replacing every shortcut with the nodes it skips"""
+    rank = memoryview(ch.rank)
+    offsets = memoryview(ch.offsets)
+    targets = memoryview(ch.targets)
+    middles = memoryview(ch.middles)
+    unpacked: List[int] = [path[0]]
+    stack: List[Tuple[int, int]] = [(path[i], path[i + 1])
+                                    for i in range(len(path) - 2, -1, -1)]
+    while stack:
+        u, v = stack.pop()
+        # The edge is stored with the lower of its two nodes.
+        low, high = (u, v) if rank[u] < rank[v] else (v, u)
+        m: int = -1
+        for k in range(offsets[low], offsets[low + 1]):
+            if targets[k] == high:
+                m = middles[k]
+                break
+        if m == -1:
+            unpacked.append(v)
+        else:
+            stack.append((m, v))
+            stack.append((u, m))
+    return unpacked
+
+
+def query(ch: ContractionHierarchy, s: int, t: int,
+          stats: Optional[Dict[str, int]] = None) -> Tuple[float, List[int]]:
+    """Returns the length and the node indices of the fastest path between
+       s and t, searching upwards in the hierarchy from both of them"""
+    offsets = memoryview(ch.offsets)
+    targets = memoryview(ch.targets)
+    weights = memoryview(ch.weights)
+    infinity: float = float("inf")
+    dists: List[Dict[int, float]] = [{}, {}]
+    seen: List[Dict[int, float]] = [{s: 0.0}, {t: 0.0}]
+    preds: List[Dict[int, int]] = [{s: -1}, {t: -1}]
+    fringe: List[List[Tuple[float, int]]] = [[(0.0, s)], [(0.0, t)]]
+    best: float = infinity if s != t else 0.0
+    meetnode: int = s
+    while True:
+        # The side with the closest node is expanded; a side stops when its
+        # next node is further than the best path found.
+        next_forward: float = fringe[0][0][0] if fringe[0] else infinity
+        next_backward: float = fringe[1][0][0] if fringe[1] else infinity
+        if next_forward >= best and next_backward >= best:
+            break
+        direction: int = 0 if next_forward <= next_backward else 1
+        dist, v = heappop(fringe[direction])
+        if v in dists[direction]:
+            continue
+        dists[direction][v] = dist
+        seen_dir: Dict[int, float] = seen[direction]
+        seen_other: Dict[int, float] = seen[1 - direction]
+        if v in seen_other and dist + seen_other[v] < best:
+            best, meetnode = dist + seen_other[v], v
+        edges: List[Tuple[int, float]] = list(
+            zip(targets[offsets[v]:offsets[v + 1]],
+                weights[offsets[v]:offsets[v + 1]]))
+        # Stall on demand: if a higher node already reaches v faster, nothing
+        # found from v can be part of a fastest path.
+        if any(seen_dir.get(w, infinity) + weight < dist
+               for w, weight in edges):
+            continue
+        for w, weight in edges:
+            vw_length: float = dist + weight
+            if vw_length < seen_dir.get(w, infinity):
+                seen_dir[w] = vw_length
+                preds[direction][w] = v
+                heappush(fringe[direction], (vw_length, w))
+                if w in seen_other and vw_length + seen_other[w] < best:
+                    best, meetnode = vw_length + seen_other[w], w
+    if stats is not None:
+        stats["settled"] = len(dists[0]) + len(dists[1])
+    if best == infinity:
+        raise ValueError("No path between %d and %d" % (s, t))
+    up: List[int] = []
+    node: int = meetnode
+    while node != -1:
+        up.append(node)
+        node = preds[0][node]
+    up.reverse()
+    node = preds[1][meetnode]
+    while node != -1:
+        up.append(node)
+        node = preds[1][node]
+    return best, _unpack(ch, up)
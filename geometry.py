@@ -0,0 +1,88 @@
+from typing import Dict, Hashable, List, Tuple, TypeAlias  # type: ignore
+import numpy as np  # type: ignore
+
+# Helpers that turn the edges drawn on a map into as few polylines as
+# possible, so StaticMap draws one line per stretch of the same colour
+# instead of one per edge.
+
+Coord: TypeAlias = Tuple[float, float]
+
+
+def merge_runs(positions: List[Coord],
+               styles: List[Hashable]) -> List[Tuple[List[Coord], Hashable]]:
+    """Returns the path through positions, whose edge i has style styles[i],
+       as polylines of consecutive edges with the same style"""
+    runs: List[Tuple[List[Coord], Hashable]] = []
+    for i, style in enumerate(styles):
+        if runs and runs[-1][1] == style:
+            runs[-1][0].append(positions[i + 1])
+        else:
+            runs.append(([positions[i], positions[i + 1]], style))
+    return runs
+
+
+def chains(edges: List[Tuple[Hashable, Hashable, Hashable]]
+           ) -> List[Tuple[List[Hashable], Hashable]]:
+    """Returns the (u, v, style) edges of a graph as chains of nodes joined
+       by edges of the same style. Every edge is in exactly one chain; chains
+       go through the nodes with two edges of their style and stop at the
+       others. The styles come in the order they first appear in edges."""
+    # style -> node -> neighbours by unused edges of that style
+    graphs: Dict[Hashable, Dict[Hashable, List[Hashable]]] = {}
+    for u, v, style in edges:
+        graph = graphs.setdefault(style, {})
+        graph.setdefault(u, []).append(v)
+        graph.setdefault(v, []).append(u)
+    result: List[Tuple[List[Hashable], Hashable]] = []
+    for style, graph in graphs.items():
+        degrees: Dict[Hashable, int] = {u: len(vs) for u, vs in graph.items()}
+        # Chains start at the ends and crossings first; what is left after
+        # that are cycles, which start anywhere.
+        starts: List[Hashable] = [u for u, d in degrees.items() if d != 2] + \
+            [u for u, d in degrees.items() if d == 2]
+        for start in starts:
+            while graph[start]:
+                chain: List[Hashable] = [start]
+                node: Hashable = start
+                while True:
+                    following: Hashable = graph[node].pop()
+                    graph[following].remove(node)
+                    chain.append(following)
+                    node = following
+                    if degrees[node] != 2 or not graph[node]:
+                        break
+                result.append((chain, style))
+    return result
+
+
+def douglas_peucker(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Returns the indices of the points of the polyline points (an n x 2
+       array) that are kept when it is simplified so that no point moves
+       more than tolerance away from it. The first and last are always
+       kept."""
+    n: int = len(points)
+    if n <= 2:
+        return np.arange(n)
+    keep: np.ndarray = np.zeros(n, dtype=bool)
+    keep[0] = keep[n - 1] = True
+    stack: List[Tuple[int, int]] = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a: np.ndarray = points[first]
+        direction: np.ndarray = points[last] - a
+        inner: np.ndarray = points[first + 1:last] - a
+        length: float = float(np.hypot(*direction))
+        if length == 0:
+            distances: np.ndarray = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(direction[0] * inner[:, 1] -
+                               direction[1] * inner[:, 0]) / length
+        farthest: int = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle: int = first + 1 + farthest
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return np.flatnonzero(keep)
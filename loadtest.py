@@ -0,0 +1,439 @@
+from collections import Counter  # type: ignore
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple  # type: ignore
+import argparse  # type: ignore
+import email  # type: ignore
+import json  # type: ignore
+import math  # type: ignore
+import os  # type: ignore
+import queue  # type: ignore
+import random  # type: ignore
+import subprocess  # type: ignore
+import sys  # type: ignore
+import threading  # type: ignore
+import time  # type: ignore
+import urllib.request  # type: ignore
+
+# Load test of the bot against a local stand-in for the Telegram Bot API.
+# FakeTelegram answers the methods the Updater uses (getMe, deleteWebhook,
+# getUpdates, sendMessage, sendPhoto); simulated users push /find, /guide and
+# location updates to it and time how long the bot takes to answer them.
+#
+#     python loadtest.py --users 50 --rounds 10
+#
+# starts bot.py from the current directory (which needs its data files)
+# with TELBOT_API_URL pointing at the fake server and TELBOT_OFFLINE_TILES
+# set, so the maps are drawn on blank tiles instead of waiting for
+# downloads. With --no-bot the server waits for a bot started separately. With --webhook-port the bot runs in webhook mode
+# with --shards processes and the server POSTs the updates to it instead of
+# waiting for getUpdates.
+#
+# The fake server accepts any token, but python-telegram-bot refuses one
+# that is not <digits>:<characters>. Without a token.txt the load test writes
+# one with DUMMY_TOKEN.
+
+HOST: str = "127.0.0.1"
+PORT: int = 8081
+DUMMY_TOKEN: str = "123456789:loadtest"
+# Seconds a user waits for an answer before counting it as lost.
+REPLY_TIMEOUT: float = 60
+# Default area of the simulated locations (lon, lat of two corners).
+AREA: Tuple[float, float, float, float] = (2.10, 41.36, 2.20, 41.44)
+QUERIES: List[str] = ["bar", "restaurant", "pizza", "cafe", "sushi",
+                      "tapas", "eixample", "gracia", "casa", "mar"]
+COMMANDS: List[str] = ["find", "guide", "location"]
+
+
+class FakeTelegram:
+    """Bot API server that keeps the updates the users send until the bot
+       polls them, or sends them to its webhook once it sets one, and gives
+       every chat the messages the bot sends to it"""
+
+    def __init__(self, host: str = HOST, port: int = PORT) -> None:
+        self.updates: List[Dict[str, Any]] = []
+        self.next_update_id: int = 1
+        self.next_message_id: int = 1
+        self.condition = threading.Condition()
+        self.replies: Dict[int, "queue.Queue[Dict[str, Any]]"] = {}
+        self.calls: Counter = Counter()
+        # Set once the bot polls for updates or sets its webhook.
+        self.ready = threading.Event()
+        # Webhook url and secret token, and the updates waiting to be sent
+        # to it, one after another and in order.
+        self.webhook: Optional[Tuple[str, str]] = None
+        self.deliveries: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self.delivery_errors: int = 0
+        self.server = ThreadingHTTPServer((host, port), _BotAPIHandler)
+        self.server.daemon_threads = True
+        self.server.telegram = self  # type: ignore
+
+    def url(self) -> str:
+        """Returns the base_url to give to the Updater"""
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d/bot" % (host, port)
+
+    def start(self) -> None:
+        threading.Thread(target=self.server.serve_forever,
+                         name="fake telegram", daemon=True).start()
+        threading.Thread(target=self._deliver, name="webhook delivery",
+                         daemon=True).start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _message(self, chat_id: int, **fields: Any) -> Dict[str, Any]:
+        with self.condition:
+            message_id: int = self.next_message_id
+            self.next_message_id += 1
+        message: Dict[str, Any] = {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private",
+                     "first_name": "User %d" % chat_id}}
+        message.update(fields)
+        return message
+
+    def push(self, chat_id: int, **fields: Any) -> None:
+        """Queues an update with a message from the user of chat_id"""
+        message: Dict[str, Any] = self._message(
+            chat_id, **fields, **{"from": {"id": chat_id, "is_bot": False,
+                                           "first_name": "User %d" % chat_id}})
+        with self.condition:
+            update: Dict[str, Any] = {"update_id": self.next_update_id,
+                                      "message": message}
+            self.next_update_id += 1
+            if self.webhook is not None:
+                self.deliveries.put(update)
+            else:
+                self.updates.append(update)
+                self.condition.notify_all()
+
+    def _deliver(self) -> None:
+        """Sends the updates to the webhook; like Telegram, an update that
+           is not accepted is sent again"""
+        while True:
+            update: Dict[str, Any] = self.deliveries.get()
+            while self.webhook is not None:
+                url, secret = self.webhook
+                request = urllib.request.Request(
+                    url, json.dumps(update).encode(),
+                    {"Content-Type": "application/json",
+                     "X-Telegram-Bot-Api-Secret-Token": secret})
+                try:
+                    urllib.request.urlopen(request, timeout=10).read()
+                    break
+                except OSError:
+                    self.delivery_errors += 1
+                    time.sleep(0.1)
+
+    def command(self, chat_id: int, text: str) -> None:
+        """Queues the command text (like "/find bar") from chat_id"""
+        length: int = len(text.split()[0])
+        self.push(chat_id, text=text,
+                  entities=[{"type": "bot_command", "offset": 0,
+                             "length": length}])
+
+    def location(self, chat_id: int, longitude: float,
+                 latitude: float) -> None:
+        self.push(chat_id, location={"longitude": longitude,
+                                     "latitude": latitude})
+
+    def get_updates(self, offset: int, limit: int,
+                    timeout: float) -> List[Dict[str, Any]]:
+        """Returns the updates from offset on, waiting up to timeout seconds
+           for one to arrive; the ones before offset are confirmed and
+           dropped, as Telegram does"""
+        self.ready.set()
+        deadline: float = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                self.updates = [u for u in self.updates
+                                if u["update_id"] >= offset]
+                remaining: float = deadline - time.monotonic()
+                if self.updates or remaining <= 0:
+                    return self.updates[:limit]
+                self.condition.wait(remaining)
+
+    def inbox(self, chat_id: int) -> "queue.Queue[Dict[str, Any]]":
+        with self.condition:
+            return self.replies.setdefault(chat_id, queue.Queue())
+
+    def send(self, chat_id: int, **fields: Any) -> Dict[str, Any]:
+        """Gives chat_id a message from the bot and returns it"""
+        message: Dict[str, Any] = self._message(chat_id, **fields)
+        self.inbox(chat_id).put(message)
+        return message
+
+    def call(self, method: str, data: Dict[str, Any]) -> Any:
+        """Returns the result of the Bot API method"""
+        self.calls[method] += 1
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "TelBot",
+                    "username": "telbot_test_bot"}
+        if method == "setWebhook":
+            with self.condition:
+                self.webhook = (str(data["url"]),
+                                str(data.get("secret_token") or ""))
+                for update in self.updates:
+                    self.deliveries.put(update)
+                self.updates = []
+            self.ready.set()
+            return True
+        if method == "deleteWebhook":
+            with self.condition:
+                self.webhook = None
+            return True
+        if method == "getUpdates":
+            return self.get_updates(int(data.get("offset") or 0),
+                                    int(data.get("limit") or 100),
+                                    float(data.get("timeout") or 0))
+        if method == "sendMessage":
+            return self.send(int(data["chat_id"]), text=str(data["text"]))
+        if method == "sendPhoto":
+            return self.send(int(data["chat_id"]), photo=[{
+                "file_id": "photo", "file_unique_id": "photo",
+                "width": 800, "height": 800}])
+        raise KeyError(method)
+
+
+def _form(content_type: str, body: bytes) -> Dict[str, Any]:
+    """Returns the fields of a multipart/form-data body"""
+    message = email.message_from_bytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    fields: Dict[str, Any] = {}
+    for part in message.get_payload():
+        name: Optional[str] = part.get_param("name",
+                                             header="content-disposition")
+        if name is not None and part.get_filename() is None:
+            fields[name] = part.get_payload(decode=True).decode()
+    return fields
+
+
+class _BotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        telegram: FakeTelegram = self.server.telegram  # type: ignore
+        body: bytes = self.rfile.read(int(self.headers["Content-Length"]
+                                          or 0))
+        content_type: str = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            data: Dict[str, Any] = _form(content_type, body)
+        elif body:
+            data = json.loads(body)
+        else:
+            data = {}
+        # The path is /bot<token>/<method>.
+        method: str = self.path.rstrip("/").rsplit("/", 1)[-1]
+        try:
+            answer: Dict[str, Any] = {"ok": True,
+                                      "result": telegram.call(method, data)}
+        except KeyError:
+            answer = {"ok": False, "error_code": 404,
+                      "description": "Not Found: method %s" % method}
+        response: bytes = json.dumps(answer).encode()
+        self.send_response(200 if answer["ok"] else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class Results:
+    """Latencies of the answered commands and counts of the rest"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {c: [] for c in COMMANDS}
+        self.lost: Counter = Counter()
+        # Locations answered without a map (busy pool, timeout, error...).
+        self.without_map: int = 0
+
+    def add(self, command: str, seconds: Optional[float]) -> None:
+        with self.lock:
+            if seconds is None:
+                self.lost[command] += 1
+            else:
+                self.latencies[command].append(seconds)
+
+
+def _answer(inbox: "queue.Queue[Dict[str, Any]]",
+            timeout: float) -> Optional[Dict[str, Any]]:
+    """Waits for the next text message in inbox and returns it, with
+       "photos" set to the number of photos that came before it; None if it
+       does not arrive in timeout seconds"""
+    deadline: float = time.monotonic() + timeout
+    photos: int = 0
+    while True:
+        remaining: float = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            message: Dict[str, Any] = inbox.get(timeout=remaining)
+        except queue.Empty:
+            return None
+        if "photo" in message:
+            photos += 1
+        else:
+            message["photos"] = photos
+            return message
+
+
+def _user(telegram: FakeTelegram, chat_id: int, rounds: int, seed: int,
+          area: Tuple[float, float, float, float], timeout: float,
+          results: Results) -> None:
+    """Runs rounds of /find, /guide and a location as the user of chat_id,
+       waiting for each answer before the next message"""
+    rng = random.Random(seed)
+    inbox: "queue.Queue[Dict[str, Any]]" = telegram.inbox(chat_id)
+    for _ in range(rounds):
+        for command in COMMANDS:
+            # Answers that came after their timeout are not counted again.
+            while not inbox.empty():
+                inbox.get_nowait()
+            start: float = time.perf_counter()
+            if command == "find":
+                telegram.command(chat_id, "/find " + rng.choice(QUERIES))
+            elif command == "guide":
+                telegram.command(chat_id, "/guide 1")
+            else:
+                telegram.location(chat_id, rng.uniform(area[0], area[2]),
+                                  rng.uniform(area[1], area[3]))
+            answer: Optional[Dict[str, Any]] = _answer(inbox, timeout)
+            results.add(command, None if answer is None
+                        else time.perf_counter() - start)
+            if command == "location" and answer is not None and \
+                    answer["photos"] == 0:
+                with results.lock:
+                    results.without_map += 1
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Returns the p-th percentile of values (nearest rank)"""
+    ordered: List[float] = sorted(values)
+    if not ordered:
+        return math.nan
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def run(telegram: FakeTelegram, users: int, rounds: int,
+        area: Tuple[float, float, float, float] = AREA,
+        timeout: float = REPLY_TIMEOUT, seed: int = 1) -> Dict[str, Any]:
+    """Runs users concurrent users against the bot polling telegram and
+       returns the throughput and latency percentiles of every command"""
+    results = Results()
+    threads: List[threading.Thread] = [
+        threading.Thread(target=_user, args=(telegram, 1000 + i, rounds,
+                                             seed + i, area, timeout,
+                                             results))
+        for i in range(users)]
+    start: float = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds: float = time.perf_counter() - start
+    report: Dict[str, Any] = {"users": users, "rounds": rounds,
+                              "seconds": seconds,
+                              "locations_without_map": results.without_map,
+                              "commands": {}}
+    answered: int = 0
+    for command in COMMANDS:
+        latencies: List[float] = results.latencies[command]
+        answered += len(latencies)
+        report["commands"][command] = {
+            "answered": len(latencies), "lost": results.lost[command],
+            "throughput": len(latencies) / seconds,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99)}
+    report["throughput"] = answered / seconds
+    return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines: List[str] = [
+        "%d users x %d rounds in %.1f s, %.1f answers/s" % (
+            report["users"], report["rounds"], report["seconds"],
+            report["throughput"]),
+        "%-10s %8s %6s %8s %9s %9s %9s" % ("command", "answered", "lost",
+                                           "per s", "p50 ms", "p95 ms",
+                                           "p99 ms")]
+    for command, stats in report["commands"].items():
+        lines.append("%-10s %8d %6d %8.1f %9.1f %9.1f %9.1f" % (
+            command, stats["answered"], stats["lost"], stats["throughput"],
+            1000 * stats["p50"], 1000 * stats["p95"], 1000 * stats["p99"]))
+    lines.append("locations answered without a map: %d"
+                 % report["locations_without_map"])
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Load test of the bot against a fake Bot API server")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="/find, /guide and location runs of every user")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--area", type=float, nargs=4, default=AREA,
+                        metavar=("LON0", "LAT0", "LON1", "LAT1"))
+    parser.add_argument("--timeout", type=float, default=REPLY_TIMEOUT)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-bot", action="store_true",
+                        help="do not start bot.py; wait for one instead")
+    parser.add_argument("--online-tiles", action="store_true",
+                        help="let the bot download the map tiles")
+    parser.add_argument("--webhook-port", type=int,
+                        help="run the bot in webhook mode on this port")
+    parser.add_argument("--shards", type=int, default=2,
+                        help="processes of the bot in webhook mode")
+    parser.add_argument("--out", help="file the report is written to as JSON")
+    args = parser.parse_args()
+
+    telegram = FakeTelegram(HOST, args.port)
+    telegram.start()
+    bot: Optional[subprocess.Popen] = None
+    if not args.no_bot:
+        if not os.path.exists("token.txt"):
+            with open("token.txt", "w") as file:
+                file.write(DUMMY_TOKEN + "\n")
+        env: Dict[str, str] = dict(os.environ, TELBOT_API_URL=telegram.url())
+        if not args.online_tiles:
+            env["TELBOT_OFFLINE_TILES"] = "1"
+        if args.webhook_port:
+            env.update(TELBOT_WEBHOOK_PORT=str(args.webhook_port),
+                       TELBOT_WEBHOOK_URL="http://%s:%d/" % (
+                           HOST, args.webhook_port),
+                       TELBOT_SHARDS=str(args.shards))
+        bot = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(
+                os.path.abspath(__file__)), "bot.py")], env=env)
+    print("waiting for the bot at %s" % telegram.url())
+    try:
+        # The bot is ready once it polls for updates or sets its webhook.
+        while not telegram.ready.wait(1):
+            if bot is not None and bot.poll() is not None:
+                raise SystemExit("bot.py exited with code %d" % bot.returncode)
+        report: Dict[str, Any] = run(telegram, args.users, args.rounds,
+                                     tuple(args.area), args.timeout,
+                                     args.seed)
+    finally:
+        if bot is not None:
+            bot.terminate()
+            bot.wait()
+        telegram.stop()
+    print(format_report(report))
+    if args.webhook_port:
+        print("webhook deliveries sent again: %d" % telegram.delivery_errors)
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(report, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+from contextlib import contextmanager, nullcontext  # type: ignore
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, ContextManager, Dict, Iterator, List
+from typing import Optional, Tuple  # type: ignore
+import functools  # type: ignore
+import math  # type: ignore
+import threading  # type: ignore
+import time  # type: ignore
+
+# Latency histograms and counters of the bot, served in the Prometheus text
+# format by a small HTTP server. Nothing is recorded until enable() is
+# called; until then the handler wrappers and stage() only check one flag.
+
+METRICS_HOST: str = "127.0.0.1"
+METRICS_PORT: int = 9464
+
+# Upper bounds of the histogram buckets, in seconds and in restaurants.
+LATENCY_BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025,
+                                      0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                                      30, math.inf)
+SIZE_BUCKETS: Tuple[float, ...] = (0, 1, 2, 4, 8, 12, math.inf)
+
+# name -> (type, help, buckets)
+METRICS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "telbot_handler_seconds": (
+        "histogram", "Time spent in every bot handler.", LATENCY_BUCKETS),
+    "telbot_handler_errors_total": (
+        "counter", "Handler calls that failed, by kind of error.", ()),
+    "telbot_stage_seconds": (
+        "histogram", "Time spent in every stage of a /guide route.",
+        LATENCY_BUCKETS),
+    "telbot_results": (
+        "histogram", "Restaurants returned by every search.", SIZE_BUCKETS),
+    "telbot_image_bytes_total": (
+        "counter", "Bytes of the route images sent.", ()),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Counts of the values up to every bucket bound, their sum and their
+       number"""
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets: Tuple[float, ...] = buckets
+        self.counts: List[int] = [0] * len(buckets)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        # Counts are kept per bucket and added up when they are rendered.
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+_enabled: bool = False
+_lock = threading.Lock()
+_histograms: Dict[Tuple[str, Labels], Histogram] = {}
+_counters: Dict[Tuple[str, Labels], float] = {}
+_server: Optional[ThreadingHTTPServer] = None
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def observe(name: str, value: float, **labels: str) -> None:
+    """Adds value to the histogram name with the given labels"""
+    if not _enabled:
+        return
+    key: Tuple[str, Labels] = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram: Optional[Histogram] = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(METRICS[name][2])
+        histogram.observe(value)
+
+
+def increment(name: str, value: float = 1, **labels: str) -> None:
+    """Adds value to the counter name with the given labels"""
+    if not _enabled:
+        return
+    key: Tuple[str, Labels] = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+@contextmanager
+def _timed_stage(name: str) -> Iterator[None]:
+    start: float = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("telbot_stage_seconds", time.perf_counter() - start,
+                stage=name)
+
+
+_nothing: ContextManager[None] = nullcontext()
+
+
+def stage(name: str) -> ContextManager[None]:
+    """Measures the code inside the with block as the stage name"""
+    if not _enabled:
+        return _nothing
+    return _timed_stage(name)
+
+
+def handler(name: str) -> Callable[[Callable[..., Any]],
+                                   Callable[..., Any]]:
+    """Decorator that measures every call of a handler and counts the calls
+       that raise"""
+    def decorator(function: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(function)
+        def measured(*args: Any, **kwargs: Any) -> Any:
+            if not _enabled:
+                return function(*args, **kwargs)
+            start: float = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                increment("telbot_handler_errors_total", handler=name,
+                          error=type(e).__name__)
+                raise
+            finally:
+                observe("telbot_handler_seconds",
+                        time.perf_counter() - start, handler=name)
+        return measured
+    return decorator
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels)
+
+
+def _format_number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render() -> str:
+    """Returns every metric in the Prometheus text format"""
+    with _lock:
+        histograms: Dict[Tuple[str, Labels], Tuple[List[int], float, int]] = {
+            key: (list(h.counts), h.sum, h.count)
+            for key, h in _histograms.items()}
+        counters: Dict[Tuple[str, Labels], float] = dict(_counters)
+    lines: List[str] = []
+    for name, (kind, text, buckets) in METRICS.items():
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        if kind == "counter":
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append("%s%s %s" % (name, _format_labels(labels),
+                                              _format_number(value)))
+            continue
+        for (metric, labels), (counts, total, count) in \
+                sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative: int = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append("%s_bucket%s %d" % (
+                    name, _format_labels(labels + (("le", _format_number(
+                        bound)),)), cumulative))
+            lines.append("%s_sum%s %s" % (name, _format_labels(labels),
+                                          _format_number(total)))
+            lines.append("%s_count%s %d" % (name, _format_labels(labels),
+                                            count))
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body: bytes = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type",
+                         "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Scrapes are not worth a line each.
+        pass
+
+
+def enable(port: int = METRICS_PORT,
+           host: str = METRICS_HOST) -> ThreadingHTTPServer:
+    """Starts recording and serves the metrics at http://host:port/metrics
+       from a daemon thread. Call it after workers.start(), so the workers
+       are not forked with the server thread."""
+    global _enabled, _server
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="metrics",
+                         daemon=True).start()
+    _enabled = True
+    return _server
+
+
+def disable() -> None:
+    """Stops recording and serving; the values recorded so far are kept"""
+    global _enabled, _server
+    _enabled = False
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
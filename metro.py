@@ -1,13 +1,14 @@
 from dataclasses import dataclass  # type: ignore
-from typing import Union, Optional, TextIO, List, Tuple, TypeAlias
+from typing import Union, Optional, TextIO, Dict, List, Tuple, TypeAlias
+from typing import TYPE_CHECKING  # type: ignore
 import networkx as nx  # type: ignore
-import matplotlib.pyplot as plt  # type: ignore
-import pandas as pd  # type: ignore
-import requests  # type: ignore
-import io  # type: ignore
-from staticmap import StaticMap, CircleMarker, Line  # type: ignore
 from haversine import haversine  # type: ignore
 
+# pandas, matplotlib and staticmap are imported by the functions that read
+# the files or draw the graph, so importing this module does not load them.
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+
 MetroGraph: TypeAlias = nx.Graph
 
 Coord: TypeAlias = Tuple[float, float]
@@ -44,36 +45,40 @@ Stations: TypeAlias = List[Station]
 Accesses: TypeAlias = List[Access]
 
 
+def _positions(geometries: "pd.Series") -> List[Coord]:
+    """Returns the positions of a column of "POINT (lon lat)" strings"""
+    coords = geometries.str[7:-1].str.split(expand=True)
+    return list(zip(coords[0].astype(float).tolist(),
+                    coords[1].astype(float).tolist()))
+
+
 def read_stations() -> Stations:
     """Returns a list of all stations, some are repeated"""
+    import pandas as pd  # type: ignore
     url = 'estacions.csv'
     # Read the csv file and keep only few columns
     df = pd.read_csv(url, usecols=["ID_ESTACIO_LINIA", "NOM_ESTACIO",
                                    "NOM_LINIA", "COLOR_LINIA", "GEOMETRY"])
-    stations_list: Stations = []
-    for row in df.itertuples():
-        coord: List[str] = row.GEOMETRY[7:-1].split()
-        position: Coord = (float(coord[0]), float(coord[1]))
-        s = Station(row.ID_ESTACIO_LINIA, row.NOM_ESTACIO, row.NOM_LINIA,
-                    "#" + row.COLOR_LINIA, position, "Station")
-        stations_list.append(s)
-    return stations_list
+    return [Station(id, name, line, "#" + color, position, "Station")
+            for id, name, line, color, position in
+            zip(df["ID_ESTACIO_LINIA"].tolist(), df["NOM_ESTACIO"].tolist(),
+                df["NOM_LINIA"].tolist(), df["COLOR_LINIA"].tolist(),
+                _positions(df["GEOMETRY"]))]
 
 
 def read_accesses() -> Accesses:
     """Returns a list of all accesses"""
+    import pandas as pd  # type: ignore
     url = 'accessos.csv'
     # Read the csv file and keep only few columns
     df = pd.read_csv(url, usecols=["CODI_ACCES", "NOM_ACCES", "NOM_ESTACIO",
                                    "ID_ESTACIO", "GEOMETRY"])
-    accesses_list: Accesses = []
-    for row in df.itertuples():
-        coord: List[str] = row.GEOMETRY[7:-1].split()
-        position: Coord = (float(coord[0]), float(coord[1]))
-        a = Access(row.CODI_ACCES, row.NOM_ACCES, row.NOM_ESTACIO,
-                   row.ID_ESTACIO, position, "Access")
-        accesses_list.append(a)
-    return accesses_list
+    return [Access(id, access_name, station_name, station_id, position,
+                   "Access")
+            for id, access_name, station_name, station_id, position in
+            zip(df["CODI_ACCES"].tolist(), df["NOM_ACCES"].tolist(),
+                df["NOM_ESTACIO"].tolist(), df["ID_ESTACIO"].tolist(),
+                _positions(df["GEOMETRY"]))]
 
 
 def get_distance(p1: Coord, p2: Coord) -> float:
@@ -94,10 +99,23 @@ def add_edge(g: MetroGraph, node_a: int, node_b: int, edge_type: str,
     g.add_edge(node_a, node_b, info=edge)
 
 
-def transbordaments(g: MetroGraph, stations_list: Stations) -> None:
+def stations_by_name(stations_list: Stations) -> Dict[str, Stations]:
+    """Returns the stations of every name, in the order of the list"""
+    names: Dict[str, Stations] = {}
+    for station in stations_list:
+        names.setdefault(station.name, []).append(station)
+    return names
+
+
+def transbordaments(g: MetroGraph, stations_list: Stations,
+                    names: Optional[Dict[str, Stations]] = None) -> None:
+    # Only the stations with the same name are compared, in the same order
+    # as comparing every pair, so the edges end up the same.
+    if names is None:
+        names = stations_by_name(stations_list)
     for stationA in stations_list:
-        for stationB in stations_list:
-            if stationA.name == stationB.name and stationA.id != stationB.id:
+        for stationB in names[stationA.name]:
+            if stationA.id != stationB.id:
                 distance: float = get_distance(stationA.position,
                                                stationB.position)
                 col_id: str = stationA.color_line
@@ -105,10 +123,12 @@ def transbordaments(g: MetroGraph, stations_list: Stations) -> None:
                          distance, col_id)
 
 
-def add_stations_edges(g: MetroGraph) -> None:  # tipus, (linia), dist, color
+def add_stations_edges(g: MetroGraph,
+                       stations_list: Optional[Stations] = None) -> None:
     """Adds, as nodes, all stations to the graph and connects them with
-       edges."""
-    stations_list: Stations = read_stations()
+       edges. The stations are read if they are not given."""
+    if stations_list is None:
+        stations_list = read_stations()
     n: int = len(stations_list)
     for i in range(n - 1):
         add_nodes(g, stations_list, i)
@@ -125,36 +145,47 @@ def add_stations_edges(g: MetroGraph) -> None:  # tipus, (linia), dist, color
     transbordaments(g, stations_list)
 
 
-def add_accesses_edges(g: MetroGraph) -> None:
+def add_accesses_edges(g: MetroGraph, stations_list: Optional[Stations] = None,
+                       accesses_list: Optional[Accesses] = None) -> None:
     """Adds, as nodes, all accesses to the graph and connects them to their
-       respective station."""
-    accesses_list: Accesses = read_accesses()
-    stations_list: Stations = read_stations()
+       respective station. The stations and accesses are read if they are
+       not given."""
+    if accesses_list is None:
+        accesses_list = read_accesses()
+    if stations_list is None:
+        stations_list = read_stations()
+    names: Dict[str, Stations] = stations_by_name(stations_list)
     # Every access is added as a node and connected to its station node.
     # CONNECTO CADA ACCESS AMB TOTES LES ESTACIONS A LES QUE VA UNIDES
     for access in accesses_list:
         g.add_node(access.id, info=access, position=access.position)
-        for station in stations_list:
-            if access.station_name == station.name:
-                distance: float = get_distance(access.position,
-                                               station.position)
-                add_edge(g, access.id, station.id, "access", distance,
-                         "black")
-
-
-def get_metro_graph() -> MetroGraph:
-    """Returns a graph with stations and accesses as nodes."""
+        for station in names.get(access.station_name, []):
+            distance: float = get_distance(access.position,
+                                           station.position)
+            add_edge(g, access.id, station.id, "access", distance,
+                     "black")
+
+
+def get_metro_graph(stations_list: Optional[Stations] = None,
+                    accesses_list: Optional[Accesses] = None) -> MetroGraph:
+    """Returns a graph with stations and accesses as nodes. The stations and
+       accesses are read (once) if they are not given."""
+    if stations_list is None:
+        stations_list = read_stations()
+    if accesses_list is None:
+        accesses_list = read_accesses()
     g = nx.Graph()
     # First we add and connect the stations.
-    add_stations_edges(g)
+    add_stations_edges(g, stations_list)
     # Then we add the access and connect them to their respective station.
-    add_accesses_edges(g)
+    add_accesses_edges(g, stations_list, accesses_list)
     return g
 
 
 def show(g: MetroGraph) -> None:
     """Prints the representation of a graph with nodes painted in blue and
        edges in black"""
+    import matplotlib.pyplot as plt  # type: ignore
     # To place each node in the correct position we need the function
     # as "get_node_attributes()" that returns a dictionary with the nodes
     # labels elements and their position coordinates as values.
@@ -163,33 +194,29 @@ def show(g: MetroGraph) -> None:
     plt.show()
 
 
-def plot(g: MetroGraph, filename: str) -> None:
+def plot(g: MetroGraph, filename: str,
+         tolerance: Optional[float] = None) -> None:
     """Prints the representation of a graph on top of a map with nodes painted
        in black and edges in different colors, depending on the line they
-       represent."""
-    # We create the list edges which is a list of edges, each one represented
-    # as a Tuple of two nodes.
-    edges: List[Tuple[str, str]] = list(g.edges)
+       represent. With a tolerance (in pixels) the lines are simplified
+       before they are drawn."""
+    import tiles  # type: ignore
     # We create the dictionary pos that contains the position of every node in
     # the graph.
     pos = nx.get_node_attributes(g, 'position')
     # We create the empty map
-    m = StaticMap(3000, 4000, 80)
-    for i in range(len(edges)):
-        # We get the position of the two nodes that connect the edge i
-        posNodeA: Coord = (pos[edges[i][0]][0], pos[edges[i][0]][1])
-        posNodeB: Coord = (pos[edges[i][1]][0], pos[edges[i][1]][1])
-        # We add the two nodes to the map with the functin add_marker() as
-        # black circles.
-        m.add_marker(CircleMarker(posNodeA, "black", 6))
-        m.add_marker(CircleMarker(posNodeB, "black", 6))
-        # We get the color of the line that connects NodeA and NodeB getting
-        # the attribute "col_id" of the edge i.
-        col_id: str = g[edges[i][0]][edges[i][1]]["info"].col_id
-        # We add the edge that connects NodeA and NodeB to the map.
-        m.add_line(Line((posNodeA, posNodeB), col_id, 5))
+    m = tiles.new_map(3000, 4000, 80)
+    # We get the color of the line that connects every two nodes from the
+    # attribute "col_id" of the edge. Edges of the same color are drawn
+    # as one line and every node as one black circle.
+    edges: List[Tuple[int, int, str]] = [(a, b, g[a][b]["info"].col_id)
+                                         for a, b in g.edges]
+    tiles.add_network(m, edges, pos, {node: "black" for node in g}, 6, 5)
+    zoom: int = 14
+    if tolerance is not None:
+        zoom = m.simplify_lines(tolerance, zoom)
     # We save the map.
-    image = m.render(zoom=14)
+    image = m.render(zoom=zoom)
     image.save(filename)
 
 # def main():
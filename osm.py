@@ -0,0 +1,539 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple  # type: ignore
+from typing import TYPE_CHECKING, TypeAlias  # type: ignore
+from xml.etree.ElementTree import iterparse  # type: ignore
+from array import array  # type: ignore
+import argparse  # type: ignore
+import bz2  # type: ignore
+import gzip  # type: ignore
+import lzma  # type: ignore
+import multiprocessing  # type: ignore
+import os  # type: ignore
+import re  # type: ignore
+import struct  # type: ignore
+import zlib  # type: ignore
+import numpy as np  # type: ignore
+import geometry  # type: ignore
+import spatial  # type: ignore
+
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
+
+# Builds the walk network from an OpenStreetMap extract on disk instead of
+# downloading it with osmnx, which needs Overpass. Both .osm (XML, possibly
+# .gz or .bz2 compressed) and .osm.pbf files are read as a stream, in two
+# passes: the first one keeps the node ids of the walkable ways and the
+# second one the positions of only those nodes, so nothing else of the
+# extract is ever held in memory. The blocks of a .pbf file are decoded by
+# a pool of processes.
+#
+# The results are the node and edge tables of city.osmnx_tables(), simplified
+# like osmnx does: the nodes in the middle of a street are dropped and its
+# edges joined, so there is one edge between every two intersections or
+# dead ends.
+
+Bbox: TypeAlias = Tuple[float, float, float, float]  # west, south, east, north
+
+# Processes that decode the blocks of a .pbf file.
+WORKERS: int = os.cpu_count() or 1
+# Nodes of an .osm file checked at once in the second pass.
+XML_BATCH: int = 65536
+# Ways with a highway tag are walkable unless one of these tags matches,
+# the same filter osmnx uses for network_type="walk".
+WALK_EXCLUDED: Dict[str, "re.Pattern[str]"] = {
+    key: re.compile(pattern) for key, pattern in {
+        "area": "yes",
+        "access": "private",
+        "highway": "abandoned|bus_guideway|construction|cycleway|motor|no|"
+                   "planned|platform|proposed|raceway|razed|rest_area|"
+                   "services",
+        "foot": "no",
+        "service": "private",
+        "sidewalk": "separate",
+        "sidewalk:both": "separate",
+        "sidewalk:left": "separate",
+        "sidewalk:right": "separate",
+    }.items()}
+
+
+def walkable(tags: Dict[str, str]) -> bool:
+    """Returns whether a way with the given tags is part of the walk
+       network"""
+    return "highway" in tags and not any(
+        pattern.search(tags[key]) for key, pattern in WALK_EXCLUDED.items()
+        if key in tags)
+
+
+# The .pbf format is a sequence of zlib compressed protocol buffer blocks.
+# Only the few messages needed here are decoded, by hand.
+
+def _varint(data: memoryview, position: int) -> Tuple[int, int]:
+    """Returns the varint at position and the position after it"""
+    result: int = 0
+    shift: int = 0
+    while True:
+        byte: int = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _fields(data: memoryview) -> Iterator[Tuple[int, Any]]:
+    """Yields the (field number, value) pairs of a protocol buffer message.
+       Values are ints or, for length delimited fields, memoryviews."""
+    position: int = 0
+    while position < len(data):
+        key, position = _varint(data, position)
+        wire_type: int = key & 7
+        value: Any
+        if wire_type == 0:
+            value, position = _varint(data, position)
+        elif wire_type == 2:
+            length, position = _varint(data, position)
+            value = data[position:position + length]
+            position += length
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == 5:
+            value = data[position:position + 4]
+            position += 4
+        else:
+            raise ValueError("unknown protocol buffer wire type %d"
+                             % wire_type)
+        yield key >> 3, value
+
+
+def _packed(data: memoryview) -> np.ndarray:
+    """Returns the packed varints in data as uint64"""
+    raw: np.ndarray = np.frombuffer(data, dtype=np.uint8)
+    if len(raw) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    # Every varint ends with the first byte below 0x80.
+    ends: np.ndarray = np.flatnonzero(raw < 0x80)
+    starts: np.ndarray = np.concatenate(([0], ends[:-1] + 1))
+    shifts: np.ndarray = 7 * (np.arange(len(raw)) -
+                              np.repeat(starts, ends - starts + 1))
+    parts: np.ndarray = (raw & 0x7F).astype(np.uint64) << \
+        shifts.astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts)
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    """Returns the signed values of zigzag encoded varints"""
+    return (values >> np.uint64(1)).astype(np.int64) ^ \
+        -(values & np.uint64(1)).astype(np.int64)
+
+
+def _signed(value: int) -> int:
+    """Returns the signed value of a zigzag encoded varint"""
+    return (value >> 1) ^ -(value & 1)
+
+
+def _int64(value: int) -> int:
+    """Returns the value of a varint of an int64 field"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _blocks(filename: str) -> Iterator[Tuple[str, int, int]]:
+    """Yields the type, offset and size of every block of a .pbf file"""
+    with open(filename, "rb") as file:
+        while True:
+            size_bytes: bytes = file.read(4)
+            if not size_bytes:
+                return
+            header = memoryview(file.read(struct.unpack(">I",
+                                                        size_bytes)[0]))
+            kind: str = ""
+            size: int = 0
+            for field, value in _fields(header):
+                if field == 1:
+                    kind = bytes(value).decode()
+                elif field == 3:
+                    size = value
+            yield kind, file.tell(), size
+            file.seek(size, os.SEEK_CUR)
+
+
+def _read_block(filename: str, offset: int, size: int) -> memoryview:
+    """Returns the uncompressed block of a .pbf file at offset"""
+    with open(filename, "rb") as file:
+        file.seek(offset)
+        blob = memoryview(file.read(size))
+    for field, value in _fields(blob):
+        if field == 1:
+            return value
+        if field == 3:
+            return memoryview(zlib.decompress(value))
+        if field == 4:
+            return memoryview(lzma.decompress(value))
+    raise ValueError("unsupported compression in block at %d of %s"
+                     % (offset, filename))
+
+
+def _primitive_groups(block: memoryview
+                      ) -> Tuple[List[str], List[memoryview], Dict[int, int]]:
+    """Returns the string table, the groups and the numeric fields of a
+       primitive block"""
+    strings: List[str] = []
+    groups: List[memoryview] = []
+    numbers: Dict[int, int] = {}
+    for field, value in _fields(block):
+        if field == 1:
+            strings = [bytes(s).decode() for _, s in _fields(value)]
+        elif field == 2:
+            groups.append(value)
+        elif isinstance(value, int):
+            numbers[field] = value
+    return strings, groups, numbers
+
+
+def _varints(data: memoryview) -> List[int]:
+    """Returns the packed varints in data; faster than _packed() for a
+       few"""
+    values: List[int] = []
+    position: int = 0
+    while position < len(data):
+        value, position = _varint(data, position)
+        values.append(value)
+    return values
+
+
+def _pbf_ways(job: Tuple[str, int, int]
+              ) -> Tuple[np.ndarray, np.ndarray, bool]:
+    """Returns the node ids of the walkable ways of a block, the number of
+       nodes of every way and whether the block has nodes"""
+    strings, groups, _ = _primitive_groups(_read_block(*job))
+    # The delta coded refs of the walkable ways are decoded all at once.
+    pieces: List[memoryview] = []
+    has_nodes: bool = False
+    highway: int = strings.index("highway") if "highway" in strings else -1
+    for group in groups:
+        for field, value in _fields(group):
+            if field in (1, 2):
+                has_nodes = True
+            elif field == 3 and highway >= 0:
+                keys: List[int] = []
+                values: List[int] = []
+                way_refs: memoryview = memoryview(b"")
+                for way_field, way_value in _fields(value):
+                    if way_field == 2:
+                        keys = _varints(way_value)
+                    elif way_field == 3:
+                        values = _varints(way_value)
+                    elif way_field == 8:
+                        way_refs = way_value
+                if highway in keys and walkable(
+                        {strings[k]: strings[v]
+                         for k, v in zip(keys, values)}):
+                    pieces.append(way_refs)
+    data: bytes = b"".join(pieces)
+    deltas: np.ndarray = _zigzag(_packed(memoryview(data)))
+    # Every way starts its deltas again from 0.
+    ends: np.ndarray = np.flatnonzero(np.frombuffer(data, dtype=np.uint8)
+                                      < 0x80)
+    limits: np.ndarray = np.cumsum([len(piece) for piece in pieces],
+                                   dtype=np.int64)
+    counts: np.ndarray = np.diff(np.searchsorted(ends, limits),
+                                 prepend=0)
+    totals: np.ndarray = np.cumsum(deltas)
+    before: np.ndarray = np.concatenate(([0], totals))[
+        np.cumsum(counts) - counts]
+    return totals - np.repeat(before, counts), counts, has_nodes
+
+
+# Sorted ids of the nodes kept by the second pass, in every worker.
+_needed: np.ndarray = np.zeros(0, dtype=np.int64)
+
+
+def _set_needed(needed: np.ndarray) -> None:
+    global _needed
+    _needed = needed
+
+
+def _is_needed(ids: np.ndarray) -> np.ndarray:
+    if len(_needed) == 0:
+        return np.zeros(len(ids), dtype=bool)
+    found: np.ndarray = np.searchsorted(_needed, ids)
+    found[found == len(_needed)] = 0
+    return _needed[found] == ids
+
+
+def _pbf_nodes(job: Tuple[str, int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the ids and (lon, lat) positions of the needed nodes of a
+       block"""
+    _, groups, numbers = _primitive_groups(_read_block(*job))
+    granularity: int = numbers.get(17, 100)
+    lat_offset: int = _int64(numbers.get(19, 0))
+    lon_offset: int = _int64(numbers.get(20, 0))
+    ids: List[np.ndarray] = []
+    lons: List[np.ndarray] = []
+    lats: List[np.ndarray] = []
+    for group in groups:
+        for field, value in _fields(group):
+            if field == 2:
+                columns: Dict[int, np.ndarray] = {
+                    dense_field: np.cumsum(_zigzag(_packed(dense_value)))
+                    for dense_field, dense_value in _fields(value)
+                    if dense_field in (1, 8, 9)}
+                ids.append(columns[1])
+                lats.append(columns[8])
+                lons.append(columns[9])
+            elif field == 1:
+                node: Dict[int, int] = {
+                    node_field: _signed(node_value)
+                    for node_field, node_value in _fields(value)
+                    if node_field in (1, 8, 9)}
+                ids.append(np.array([node[1]], dtype=np.int64))
+                lats.append(np.array([node[8]], dtype=np.int64))
+                lons.append(np.array([node[9]], dtype=np.int64))
+    if not ids:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 2))
+    block_ids: np.ndarray = np.concatenate(ids)
+    keep: np.ndarray = _is_needed(block_ids)
+    positions: np.ndarray = 1e-9 * np.column_stack((
+        lon_offset + granularity * np.concatenate(lons)[keep],
+        lat_offset + granularity * np.concatenate(lats)[keep]))
+    return block_ids[keep], positions
+
+
+def _map(function: Any, jobs: List[Any], workers: int,
+         needed: Optional[np.ndarray] = None) -> Iterator[Any]:
+    """Yields function(job) for every job, in order. The jobs run in a pool
+       of that many worker processes, or in this one if workers is 1."""
+    if needed is not None:
+        _set_needed(needed)
+    if workers <= 1 or len(jobs) <= 1:
+        yield from map(function, jobs)
+        return
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods()
+        else None)
+    with context.Pool(workers, initializer=_set_needed,
+                      initargs=(_needed,)) as pool:
+        yield from pool.imap(function, jobs, chunksize=4)
+
+
+def _read_pbf(filename: str, workers: int
+              ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the node ids and lengths of the walkable ways of a .pbf file,
+       and the ids and positions of their nodes"""
+    jobs: List[Tuple[str, int, int]] = [
+        (filename, offset, size) for kind, offset, size in _blocks(filename)
+        if kind == "OSMData"]
+    refs: List[np.ndarray] = []
+    lengths: List[np.ndarray] = []
+    node_jobs: List[Tuple[str, int, int]] = []
+    for job, (block_refs, block_lengths, has_nodes) in zip(
+            jobs, _map(_pbf_ways, jobs, workers)):
+        refs.append(block_refs)
+        lengths.append(block_lengths)
+        if has_nodes:
+            node_jobs.append(job)
+    all_refs: np.ndarray = np.concatenate(refs) if refs else \
+        np.zeros(0, dtype=np.int64)
+    ids: List[np.ndarray] = [np.zeros(0, dtype=np.int64)]
+    positions: List[np.ndarray] = [np.zeros((0, 2))]
+    for block_ids, block_positions in _map(_pbf_nodes, node_jobs, workers,
+                                           np.unique(all_refs)):
+        ids.append(block_ids)
+        positions.append(block_positions)
+    return (all_refs,
+            np.concatenate(lengths) if lengths else
+            np.zeros(0, dtype=np.int64),
+            np.concatenate(ids), np.concatenate(positions))
+
+
+def _open(filename: str) -> Any:
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    if filename.endswith(".bz2"):
+        return bz2.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def _elements(filename: str, tag: str) -> Iterator[Any]:
+    """Yields the top level elements of an .osm file with the given tag.
+       The elements read are dropped, so the tree never grows."""
+    with _open(filename) as file:
+        root: Any = None
+        for event, element in iterparse(file, events=("start", "end")):
+            if root is None:
+                root = element
+            elif event == "end" and element.tag in ("node", "way",
+                                                    "relation"):
+                if element.tag == tag:
+                    yield element
+                root.clear()
+
+
+def _read_xml(filename: str
+              ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Like _read_pbf(), for an .osm file. XML is read by one process."""
+    refs = array("q")
+    lengths = array("q")
+    for way in _elements(filename, "way"):
+        tags: Dict[str, str] = {tag.get("k"): tag.get("v")
+                                for tag in way.iter("tag")}
+        if walkable(tags):
+            way_refs: List[int] = [int(nd.get("ref")) for nd in way.iter("nd")]
+            refs.extend(way_refs)
+            lengths.append(len(way_refs))
+    all_refs: np.ndarray = np.frombuffer(refs, dtype=np.int64)
+    _set_needed(np.unique(all_refs))
+    ids: List[np.ndarray] = [np.zeros(0, dtype=np.int64)]
+    positions: List[np.ndarray] = [np.zeros((0, 2))]
+    # Nodes are read in batches, and only the needed ones of every batch
+    # are kept.
+    batch_ids = array("q")
+    batch_positions = array("d")
+    for node in _elements(filename, "node"):
+        batch_ids.append(int(node.get("id")))
+        batch_positions.extend((float(node.get("lon")),
+                                float(node.get("lat"))))
+        if len(batch_ids) == XML_BATCH:
+            _keep_needed(batch_ids, batch_positions, ids, positions)
+            batch_ids, batch_positions = array("q"), array("d")
+    _keep_needed(batch_ids, batch_positions, ids, positions)
+    return (all_refs, np.frombuffer(lengths, dtype=np.int64),
+            np.concatenate(ids), np.concatenate(positions))
+
+
+def _keep_needed(batch_ids: "array[int]", batch_positions: "array[float]",
+                 ids: List[np.ndarray], positions: List[np.ndarray]) -> None:
+    """Appends the needed nodes of a batch to ids and positions"""
+    if not batch_ids:
+        return
+    block_ids: np.ndarray = np.frombuffer(batch_ids, dtype=np.int64)
+    keep: np.ndarray = _is_needed(block_ids)
+    ids.append(block_ids[keep])
+    positions.append(np.frombuffer(batch_positions,
+                                   dtype=np.float64).reshape(-1, 2)[keep])
+
+
+def _great_circle(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Returns the distances in meters between the (lon, lat) positions of
+       a and b"""
+    lon_a, lat_a = np.radians(a[:, 0]), np.radians(a[:, 1])
+    lon_b, lat_b = np.radians(b[:, 0]), np.radians(b[:, 1])
+    h = np.sin((lat_b - lat_a) / 2) ** 2 + \
+        np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * spatial.EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(h, 1)))
+
+
+def _largest_component(n: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Returns which of the n nodes are in the largest connected component
+       of the graph with edges (a, b)"""
+    from scipy.sparse import coo_matrix  # type: ignore
+    from scipy.sparse.csgraph import connected_components  # type: ignore
+    _, labels = connected_components(
+        coo_matrix((np.ones(len(a)), (a, b)), shape=(n, n)), directed=False)
+    return labels == np.argmax(np.bincount(labels))
+
+
+def walk_tables(refs: np.ndarray, lengths: np.ndarray, ids: np.ndarray,
+                positions: np.ndarray, bbox: Optional[Bbox] = None,
+                retain_all: bool = False
+                ) -> Tuple["pd.DataFrame", "pd.DataFrame"]:
+    """Returns the simplified node and edge tables, like the ones of
+       city.osmnx_tables(), of the ways with the given node ids refs, where
+       way i has lengths[i] nodes, and nodes ids at positions. Nodes outside
+       bbox or without a position are dropped with their edges, and so are
+       the nodes outside the largest connected part unless retain_all."""
+    import pandas as pd  # type: ignore
+    order: np.ndarray = np.argsort(ids, kind="stable")
+    ids, positions = ids[order], positions[order]
+    if bbox is not None:
+        west, south, east, north = bbox
+        inside: np.ndarray = (positions[:, 0] >= west) & \
+            (positions[:, 0] <= east) & (positions[:, 1] >= south) & \
+            (positions[:, 1] <= north)
+        ids, positions = ids[inside], positions[inside]
+    # Every ref as an index in ids, or -1 if its node was dropped.
+    nodes: np.ndarray = np.searchsorted(ids, refs)
+    nodes[nodes == len(ids)] = 0
+    if len(ids):
+        nodes[ids[nodes] != refs] = -1
+    else:
+        nodes[:] = -1
+    # Consecutive nodes of the same way are joined by a segment; segments
+    # of several ways are kept once.
+    way: np.ndarray = np.repeat(np.arange(len(lengths)), lengths)
+    a, b = nodes[:-1], nodes[1:]
+    keep: np.ndarray = (way[:-1] == way[1:]) & (a >= 0) & (b >= 0) & (a != b)
+    a, b = a[keep], b[keep]
+    _, first = np.unique(np.minimum(a, b) * len(ids) + np.maximum(a, b),
+                         return_index=True)
+    first.sort()
+    a, b = a[first], b[first]
+    if not retain_all and len(a):
+        component: np.ndarray = _largest_component(len(ids), a, b)
+        a, b = a[component[a]], b[component[a]]
+    # The nodes with two neighbours are in the middle of a street; every
+    # chain of them becomes a single edge.
+    street_chains = geometry.chains(list(zip(a.tolist(), b.tolist(),
+                                             [None] * len(a))))
+    chain_nodes: np.ndarray = np.array(
+        [node for chain, _ in street_chains for node in chain],
+        dtype=np.int64)
+    sizes: np.ndarray = np.array([len(chain) for chain, _ in street_chains],
+                                 dtype=np.int64)
+    ends: np.ndarray = np.cumsum(sizes) - 1
+    starts: np.ndarray = ends - sizes + 1
+    steps: np.ndarray = np.zeros(len(chain_nodes))
+    steps[1:] = _great_circle(positions[chain_nodes[:-1]],
+                              positions[chain_nodes[1:]])
+    steps[starts] = 0
+    length: np.ndarray = np.add.reduceat(steps, starts) if len(starts) else \
+        np.zeros(0)
+    u: np.ndarray = ids[chain_nodes[starts]]
+    v: np.ndarray = ids[chain_nodes[ends]]
+    # Walking goes both ways, so every street is an edge in each direction,
+    # as in the osmnx walk graph.
+    edges = pd.DataFrame({"u": np.concatenate((u, v)),
+                          "v": np.concatenate((v, u)),
+                          "length": np.concatenate((length, length))})
+    edges.insert(2, "key", edges.groupby(["u", "v"]).cumcount())
+    used: np.ndarray = pd.unique(np.concatenate(
+        (chain_nodes[starts], chain_nodes[ends])))
+    nodes_table = pd.DataFrame({"x": positions[used, 0],
+                                "y": positions[used, 1]},
+                               index=pd.Index(ids[used], name="osmid"))
+    return nodes_table, edges
+
+
+def read_walk_tables(filename: str, bbox: Optional[Bbox] = None,
+                     retain_all: bool = False, workers: int = WORKERS
+                     ) -> Tuple["pd.DataFrame", "pd.DataFrame"]:
+    """Returns the node and edge tables of the walk network of the .osm or
+       .osm.pbf extract filename; see walk_tables()"""
+    if filename.endswith(".pbf"):
+        ways_and_nodes = _read_pbf(filename, workers)
+    else:
+        ways_and_nodes = _read_xml(filename)
+    return walk_tables(*ways_and_nodes, bbox=bbox, retain_all=retain_all)
+
+
+def main() -> None:
+    import city  # type: ignore
+    parser = argparse.ArgumentParser(
+        description="Builds the osmnx walk graph from an OpenStreetMap "
+                    "extract.")
+    parser.add_argument("extract", help=".osm or .osm.pbf file")
+    parser.add_argument("output", nargs="?", default="barcelona_walk")
+    parser.add_argument("--bbox", type=float, nargs=4,
+                        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+                        default=city.BARCELONA_BBOX)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+    nodes, edges = read_walk_tables(args.extract, tuple(args.bbox),
+                                    workers=args.workers)
+    city.save_osmnx_graph(city.osmnx_graph_from_tables(nodes, edges),
+                          args.output)
+    print("%d nodes and %d edges written to %s"
+          % (len(nodes), len(edges), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,6 @@
 from dataclasses import dataclass  # type: ignore
 from typing import Optional, TextIO, List, Tuple, TypeAlias  # type: ignore
 from fuzzysearch import find_near_matches  # type: ignore
-import pandas as pd  # type: ignore
-import requests  # type: ignore
-import io  # type: ignore
 import os  # type: ignore
 import pickle  # type: ignore
 
@@ -27,6 +24,9 @@ Restaurants: TypeAlias = List[Restaurant]
 
 def read() -> Restaurants:
     """Returns a list of all restaurants"""
+    # pandas is only needed to read the csv file, so it is not loaded when
+    # the restaurants come from their prebuilt files.
+    import pandas as pd  # type: ignore
     url = 'restaurants.csv'
     # Read the csv file and keep only few columns
     df = pd.read_csv(url, usecols=['name', 'addresses_road_name',
@@ -78,9 +78,7 @@ def def_find(query: str, restaurants: Restaurants) -> Restaurants:
         elements: List[str] = [restaurant.name]
         for attribute in elements:
             if type(attribute) == str:
-                if len(find_near_matches(query, attribute, max_l_dist=1)) != 0:
-                    find: str = find_near_matches(query, attribute,
-                                                  max_l_dist=1)[0].matched
+                if find_near_matches(query, attribute, max_l_dist=1):
                     restaurants_list.append(restaurant)
     return restaurants_list
 
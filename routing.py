@@ -0,0 +1,388 @@
+from dataclasses import dataclass  # type: ignore
+from typing import Union, Optional, Dict, List, Tuple, TypeAlias  # type: ignore
+from heapq import heappush, heappop  # type: ignore
+from itertools import count  # type: ignore
+from scipy.sparse import csr_matrix, csgraph  # type: ignore
+import math  # type: ignore
+import time  # type: ignore
+import networkx as nx  # type: ignore
+import numpy as np  # type: ignore
+import contraction  # type: ignore
+
+CityGraph: TypeAlias = nx.Graph
+
+NodeID: TypeAlias = Union[int, str]
+Path: TypeAlias = List[NodeID]
+
+# Small integer codes used instead of the strings stored in every node and
+# Edge of the CityGraph. Unknown values are appended when the graph is built.
+NODE_TYPES: List[str] = ["Street", "Station", "Access"]
+EDGE_TYPES: List[str] = ["Street", "tram", "enllaç", "access"]
+
+# Ways of searching a path; all of them return the same (fastest) route.
+# "ch" needs the contraction hierarchy of the graph, see load_hierarchy().
+MODES: List[str] = ["dijkstra", "bidirectional", "astar", "ch"]
+
+EARTH_RADIUS_M: float = 6371009
+
+
+@dataclass
+class RoutingGraph:
+    """Array based (CSR) copy of a CityGraph. The neighbours of node i are
+       neighbours[offsets[i]:offsets[i + 1]], in the same order as in the
+       CityGraph, and the arrays next to it hold the data of those edges."""
+    ids: np.ndarray         # NodeID of every node
+    index: Dict[NodeID, int]
+    positions: np.ndarray   # float64 (n, 2)
+    node_types: np.ndarray  # uint8 codes into node_type_names
+    offsets: np.ndarray     # int32 (n + 1)
+    neighbours: np.ndarray  # int32 (2 * m)
+    weights: np.ndarray     # float64, travel time in seconds
+    distances: np.ndarray   # float64, length in meters
+    edge_types: np.ndarray  # uint8 codes into edge_type_names
+    colours: np.ndarray     # uint8 codes into colour_names
+    node_type_names: List[str]
+    edge_type_names: List[str]
+    colour_names: List[str]
+    matrix: Optional[csr_matrix] = None  # shares the arrays above
+    max_speed: float = 0.0  # computed by the first A* search
+    hierarchy: Optional[contraction.ContractionHierarchy] = None
+
+    def __post_init__(self) -> None:
+        if self.matrix is None:
+            self.matrix = _matrix(self)
+
+
+def _code(names: List[str], codes: Dict[str, int], name: str) -> int:
+    if name not in codes:
+        codes[name] = len(names)
+        names.append(name)
+    return codes[name]
+
+
+def build_routing_graph(g: CityGraph) -> RoutingGraph:
+    """Returns the RoutingGraph of the CityGraph g"""
+    node_type_names: List[str] = list(NODE_TYPES)
+    edge_type_names: List[str] = list(EDGE_TYPES)
+    colour_names: List[str] = []
+    node_codes = {name: i for i, name in enumerate(node_type_names)}
+    edge_codes = {name: i for i, name in enumerate(edge_type_names)}
+    colour_codes: Dict[str, int] = {}
+
+    nodes: List[NodeID] = list(g.nodes)
+    index: Dict[NodeID, int] = {node: i for i, node in enumerate(nodes)}
+    n: int = len(nodes)
+    m: int = 2 * g.number_of_edges()
+
+    positions = np.empty((n, 2), dtype=np.float64)
+    node_types = np.empty(n, dtype=np.uint8)
+    offsets = np.empty(n + 1, dtype=np.int32)
+    neighbours = np.empty(m, dtype=np.int32)
+    weights = np.empty(m, dtype=np.float64)
+    distances = np.empty(m, dtype=np.float64)
+    edge_types = np.empty(m, dtype=np.uint8)
+    colours = np.empty(m, dtype=np.uint8)
+
+    k: int = 0
+    for i, u in enumerate(nodes):
+        positions[i] = g.nodes[u]["position"]
+        node_types[i] = _code(node_type_names, node_codes,
+                              g.nodes[u]["type"])
+        offsets[i] = k
+        for v, eattr in g.adj[u].items():
+            neighbours[k] = index[v]
+            weights[k] = eattr["weight"]
+            distances[k] = eattr["info"].distance
+            edge_types[k] = _code(edge_type_names, edge_codes,
+                                  eattr["info"].edge_type)
+            colours[k] = _code(colour_names, colour_codes,
+                               eattr["info"].col_id)
+            k += 1
+    offsets[n] = k
+
+    if all(isinstance(node, int) for node in nodes):
+        ids = np.array(nodes, dtype=np.int64)
+    else:
+        ids = np.array(nodes, dtype=object)
+    return RoutingGraph(ids, index, positions, node_types, offsets,
+                        neighbours[:k], weights[:k], distances[:k],
+                        edge_types[:k], colours[:k], node_type_names,
+                        edge_type_names, colour_names)
+
+
+def load_hierarchy(rg: RoutingGraph, filename: str,
+                   build: bool = True) -> None:
+    """Gives rg the contraction hierarchy stored in the file named filename,
+       building it first if the file is missing or belongs to another graph.
+       Without build, rg is left without a hierarchy in that case."""
+    rg.hierarchy = contraction.load_contraction_hierarchy(
+        filename, rg.offsets, rg.neighbours, rg.weights, build)
+
+
+def node_index(rg: RoutingGraph, node: NodeID) -> int:
+    """Returns the position of node in the arrays of rg"""
+    if node not in rg.index:
+        raise nx.NodeNotFound("Node %s is not in the graph" % node)
+    return rg.index[node]
+
+
+def edge_position(rg: RoutingGraph, i: int, j: int) -> int:
+    """Returns the position in the edge arrays of rg of the edge from the
+       node with index i to the node with index j"""
+    for k in range(rg.offsets[i], rg.offsets[i + 1]):
+        if rg.neighbours[k] == j:
+            return k
+    raise KeyError("There is no edge between %s and %s" % (rg.ids[i],
+                                                            rg.ids[j]))
+
+
+def path_time(rg: RoutingGraph, p: Path) -> float:
+    """Returns the seconds it takes to follow the path p"""
+    indices: List[int] = [node_index(rg, node) for node in p]
+    return sum(float(rg.weights[edge_position(rg, indices[i], indices[i + 1])])
+               for i in range(len(indices) - 1))
+
+
+def _matrix(rg: RoutingGraph) -> csr_matrix:
+    """Returns the arrays of rg as a scipy sparse matrix; it shares their
+       memory, nothing is copied"""
+    n: int = len(rg.ids)
+    return csr_matrix((rg.weights, rg.neighbours, rg.offsets), shape=(n, n),
+                      copy=False)
+
+
+def dijkstra(rg: RoutingGraph, s: int, t: int,
+             stats: Optional[Dict[str, int]] = None) -> Tuple[float, List[int]]:
+    """Returns the length and the node indices of the fastest path between
+       the nodes with indices s and t"""
+    if s == t:
+        if stats is not None:
+            stats["settled"] = 1
+        return 0.0, [s]
+    # The search itself runs in compiled code over the CSR arrays, which is
+    # what makes it much faster than nx.shortest_path over dict-of-dicts.
+    dists, preds = csgraph.dijkstra(rg.matrix, indices=s,
+                                    return_predecessors=True)
+    if np.isinf(dists[t]):
+        raise nx.NetworkXNoPath("No path between %s and %s." % (rg.ids[s],
+                                                                 rg.ids[t]))
+    if stats is not None:
+        # The compiled search does not stop at t; these are the nodes a
+        # search that stops there settles.
+        stats["settled"] = int(np.count_nonzero(dists <= dists[t]))
+    indices: List[int] = [t]
+    node: int = t
+    while node != s:
+        node = int(preds[node])
+        indices.append(node)
+    indices.reverse()
+    return float(dists[t]), indices
+
+
+def reachable(rg: RoutingGraph, s: int,
+              limit: float = math.inf) -> np.ndarray:
+    """Returns the seconds of the fastest paths from the node with index s
+       to every node, found with a single search that stops at limit
+       seconds; the nodes farther than that get inf"""
+    # With a limit the compiled search does not settle the nodes beyond it,
+    # so short budgets only visit a small part of the city.
+    return csgraph.dijkstra(rg.matrix, indices=s, limit=limit)
+
+
+def travel_times(rg: RoutingGraph, s: int, targets: np.ndarray,
+                 limit: float = math.inf) -> np.ndarray:
+    """Returns the seconds of the fastest paths from the node with index s
+       to every node of targets (see reachable())"""
+    return reachable(rg, s, limit)[np.asarray(targets, dtype=np.int64)]
+
+
+def _great_circle(lon1: float, lat1: float, lon2: float,
+                  lat2: float) -> float:
+    """Returns the distance in meters between two (lon, lat) points"""
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a: float = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) *
+                math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def _max_speed(rg: RoutingGraph) -> float:
+    """Returns the highest straight line speed (meters per second) over any
+       edge of rg. It is about 8 m/s, the speed of the metro, and dividing
+       the distance to the target by it never overestimates the time left,
+       so A* still finds the fastest path."""
+    if rg.max_speed == 0.0:
+        sources = np.repeat(np.arange(len(rg.ids)), np.diff(rg.offsets))
+        lon = np.radians(rg.positions[:, 0])
+        lat = np.radians(rg.positions[:, 1])
+        lon1, lat1 = lon[sources], lat[sources]
+        lon2, lat2 = lon[rg.neighbours], lat[rg.neighbours]
+        a = (np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) *
+             np.sin((lon2 - lon1) / 2) ** 2)
+        straight = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+        moving = rg.weights > 0
+        speeds = straight[moving] / rg.weights[moving]
+        # A little margin covers the rounding of the two distance formulas.
+        rg.max_speed = float(speeds.max(initial=1.5)) * (1 + 1e-9)
+    return rg.max_speed
+
+
+def astar(rg: RoutingGraph, s: int, t: int,
+          stats: Optional[Dict[str, int]] = None) -> Tuple[float, List[int]]:
+    """Returns the length and the node indices of the fastest path between
+       s and t. The search is guided towards t by the straight line time to
+       it, so it settles the nodes around the route instead of a whole circle
+       around s."""
+    offsets = memoryview(rg.offsets)
+    neighbours = memoryview(rg.neighbours)
+    weights = memoryview(rg.weights)
+    positions = memoryview(rg.positions.reshape(-1))
+    speed: float = _max_speed(rg)
+    t_lon: float = positions[2 * t]
+    t_lat: float = positions[2 * t + 1]
+
+    def heuristic(v: int) -> float:
+        return _great_circle(positions[2 * v], positions[2 * v + 1],
+                             t_lon, t_lat) / speed
+
+    dists: Dict[int, float] = {}
+    seen: Dict[int, float] = {s: 0.0}
+    preds: Dict[int, int] = {s: -1}
+    fringe: List[Tuple[float, int, float, int]] = []
+    c = count()
+    heappush(fringe, (heuristic(s), next(c), 0.0, s))
+    while fringe:
+        _, _, dist, v = heappop(fringe)
+        if v in dists:
+            continue
+        dists[v] = dist
+        if v == t:
+            if stats is not None:
+                stats["settled"] = len(dists)
+            return dist, _walk_back(preds, t)
+        for k in range(offsets[v], offsets[v + 1]):
+            w: int = neighbours[k]
+            vw_length: float = dist + weights[k]
+            if w not in dists and (w not in seen or vw_length < seen[w]):
+                seen[w] = vw_length
+                preds[w] = v
+                heappush(fringe, (vw_length + heuristic(w), next(c),
+                                  vw_length, w))
+    raise nx.NetworkXNoPath("No path between %s and %s." % (rg.ids[s],
+                                                             rg.ids[t]))
+
+
+def bidirectional_dijkstra(rg: RoutingGraph, s: int, t: int,
+                           stats: Optional[Dict[str, int]] = None
+                           ) -> Tuple[float, List[int]]:
+    """Returns the length and the node indices of the fastest path between
+       s and t, searching from both ends at once until the two searches
+       meet (the algorithm of nx.bidirectional_dijkstra)"""
+    if s == t:
+        if stats is not None:
+            stats["settled"] = 1
+        return 0.0, [s]
+    offsets = memoryview(rg.offsets)
+    neighbours = memoryview(rg.neighbours)
+    weights = memoryview(rg.weights)
+
+    dists: List[Dict[int, float]] = [{}, {}]
+    seen: List[Dict[int, float]] = [{s: 0.0}, {t: 0.0}]
+    preds: List[Dict[int, int]] = [{s: -1}, {t: -1}]
+    fringe: List[List[Tuple[float, int, int]]] = [[], []]
+    c = count()
+    heappush(fringe[0], (0.0, next(c), s))
+    heappush(fringe[1], (0.0, next(c), t))
+    finaldist: float = 0.0
+    meetnode: int = -1
+    direction: int = 1
+    while fringe[0] and fringe[1]:
+        direction = 1 - direction
+        dist, _, v = heappop(fringe[direction])
+        if v in dists[direction]:
+            continue
+        dists[direction][v] = dist
+        if v in dists[1 - direction]:
+            if stats is not None:
+                stats["settled"] = len(dists[0]) + len(dists[1])
+            path: List[int] = _walk_back(preds[0], meetnode)
+            return finaldist, path + _walk_back(preds[1], meetnode)[-2::-1]
+        seen_dir = seen[direction]
+        seen_other = seen[1 - direction]
+        for k in range(offsets[v], offsets[v + 1]):
+            w: int = neighbours[k]
+            vw_length: float = dist + weights[k]
+            if w in dists[direction]:
+                continue
+            if w not in seen_dir or vw_length < seen_dir[w]:
+                seen_dir[w] = vw_length
+                heappush(fringe[direction], (vw_length, next(c), w))
+                preds[direction][w] = v
+                if w in seen_other:
+                    finaldist_w: float = vw_length + seen_other[w]
+                    if meetnode == -1 or finaldist > finaldist_w:
+                        finaldist, meetnode = finaldist_w, w
+    raise nx.NetworkXNoPath("No path between %s and %s." % (rg.ids[s],
+                                                             rg.ids[t]))
+
+
+def _walk_back(preds: Dict[int, int], node: int) -> List[int]:
+    """Returns the path that ends at node following the predecessors"""
+    path: List[int] = []
+    while node != -1:
+        path.append(node)
+        node = preds[node]
+    path.reverse()
+    return path
+
+
+def search(rg: RoutingGraph, s: int, t: int, mode: str = "dijkstra",
+           stats: Optional[Dict[str, int]] = None) -> Tuple[float, List[int]]:
+    """Returns the length and the node indices of the fastest path between
+       s and t found with the given mode (one of MODES)"""
+    if mode == "dijkstra":
+        return dijkstra(rg, s, t, stats)
+    elif mode == "bidirectional":
+        return bidirectional_dijkstra(rg, s, t, stats)
+    elif mode == "astar":
+        return astar(rg, s, t, stats)
+    elif mode == "ch":
+        if rg.hierarchy is None:
+            raise ValueError("The graph has no contraction hierarchy")
+        try:
+            return contraction.query(rg.hierarchy, s, t, stats)
+        except ValueError:
+            raise nx.NetworkXNoPath("No path between %s and %s." %
+                                    (rg.ids[s], rg.ids[t]))
+    raise ValueError("Unknown search mode %s, use one of %s" % (mode, MODES))
+
+
+def shortest_path(rg: RoutingGraph, src_node: NodeID, dst_node: NodeID,
+                  mode: str = "dijkstra") -> Path:
+    """Returns the fastest path between the nodes src_node and dst_node"""
+    s: int = node_index(rg, src_node)
+    t: int = node_index(rg, dst_node)
+    _, indices = search(rg, s, t, mode)
+    return rg.ids[indices].tolist()
+
+
+def compare_modes(rg: RoutingGraph, src_node: NodeID,
+                  dst_node: NodeID) -> Dict[str, Dict[str, float]]:
+    """Runs the query with every mode and returns, for each one, the number
+       of nodes it settled, the seconds it took and whether it found the
+       same route as plain Dijkstra"""
+    s: int = node_index(rg, src_node)
+    t: int = node_index(rg, dst_node)
+    report: Dict[str, Dict[str, float]] = {}
+    reference: List[int] = []
+    for mode in MODES:
+        if mode == "ch" and rg.hierarchy is None:
+            continue
+        stats: Dict[str, int] = {}
+        start: float = time.perf_counter()
+        _, indices = search(rg, s, t, mode, stats)
+        elapsed: float = time.perf_counter() - start
+        if mode == "dijkstra":
+            reference = indices
+        report[mode] = {"settled": stats["settled"], "seconds": elapsed,
+                        "same_route": indices == reference}
+    return report
@@ -0,0 +1,184 @@
+from dataclasses import dataclass  # type: ignore
+from typing import Dict, List, Set, Tuple  # type: ignore
+from fuzzysearch import find_near_matches  # type: ignore
+import unicodedata  # type: ignore
+import restaurants  # type: ignore
+
+# Index of the words of the restaurants used by /find. It gives the same
+# restaurants as restaurants.multiple_search(), each one once and in the
+# order of the list, except that accents are ignored ("gracia" also finds
+# "Gràcia"). Every query word must be a substring of one of the searched
+# attributes, so all the substrings of up to GRAM characters of every word
+# are indexed; longer query words are looked up by their pieces of GRAM
+# characters and then checked against the text of the candidates.
+
+GRAM: int = 3
+
+
+@dataclass
+class SearchIndex:
+    texts: List[List[str]]      # normalized attributes of every restaurant
+    grams: Dict[str, Set[int]]  # substring -> ids of the restaurants
+
+
+def normalize(text: str) -> str:
+    """Returns text in lowercase and without accents"""
+    decomposed: str = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def attributes(restaurant: restaurants.Restaurant) -> List[str]:
+    """Returns the attributes of the restaurant /find searches in"""
+    elements = [restaurant.name, restaurant.street, restaurant.neighborhood,
+                restaurant.district]
+    return [normalize(attribute) for attribute in elements
+            if type(attribute) == str]
+
+
+def build_index(restaurants_list: restaurants.Restaurants) -> SearchIndex:
+    """Returns the index of the restaurants in restaurants_list; the ids are
+       their positions in the list"""
+    return index_texts([attributes(restaurant)
+                        for restaurant in restaurants_list])
+
+
+def index_texts(texts: List[List[str]]) -> SearchIndex:
+    """Returns the index of restaurants whose normalized attributes (see
+       attributes()) are given by texts"""
+    grams: Dict[str, Set[int]] = {}
+    for i, restaurant_texts in enumerate(texts):
+        for attribute in restaurant_texts:
+            for word in attribute.split():
+                for start in range(len(word)):
+                    for end in range(start + 1,
+                                     min(start + GRAM, len(word)) + 1):
+                        grams.setdefault(word[start:end], set()).add(i)
+    return SearchIndex(texts, grams)
+
+
+def _candidates(index: SearchIndex, word: str) -> Set[int]:
+    """Returns the ids of the restaurants that contain all the pieces of word
+       (a superset of the ones that contain word)"""
+    if len(word) <= GRAM:
+        return index.grams.get(word, set())
+    found: Set[int] = set(index.grams.get(word[:GRAM], set()))
+    for start in range(1, len(word) - GRAM + 1):
+        if not found:
+            break
+        found &= index.grams.get(word[start:start + GRAM], set())
+    return found
+
+
+def find_ids(index: SearchIndex, query: List[str]) -> List[int]:
+    """Returns, in the order of the list the index was built from, the ids of
+       the restaurants whose attributes contain every word of query"""
+    words: List[str] = [normalize(word) for word in query]
+    words = [word for word in words if word]
+    if not words:
+        return list(range(len(index.texts)))
+    # The rarest words go first so that the intersection shrinks quickly.
+    candidates: List[Set[int]] = sorted((_candidates(index, word)
+                                         for word in words), key=len)
+    found: Set[int] = set(candidates[0])
+    for ids in candidates[1:]:
+        found &= ids
+    return sorted(i for i in found
+                  if all(any(word in attribute for attribute in index.texts[i])
+                         for word in words if len(word) > GRAM))
+
+
+# Index used when no restaurant contains the query: every query word may then
+# be found with up to max_l_dist typos in the name or the street. Changing
+# one character of a text changes at most q of its pieces of q characters,
+# so a restaurant can only match a word if it shares, at least, all but
+# max_l_dist * q of the distinct pieces of the word. Only the restaurants
+# that pass this count are checked with fuzzysearch.
+
+FUZZY_GRAMS: List[int] = [3, 2, 1]
+
+
+@dataclass
+class FuzzyIndex:
+    texts: List[List[str]]              # normalized name and street
+    grams: Dict[int, Dict[str, Set[int]]]  # q -> piece -> restaurant ids
+
+
+def build_fuzzy_index(restaurants_list: restaurants.Restaurants) -> FuzzyIndex:
+    """Returns the typo tolerant index of the names and streets of the
+       restaurants in restaurants_list; the ids are their positions in the
+       list"""
+    return fuzzy_index_texts([[normalize(attribute) for attribute in
+                               (restaurant.name, restaurant.street)
+                               if type(attribute) == str]
+                              for restaurant in restaurants_list])
+
+
+def fuzzy_index_texts(texts: List[List[str]]) -> FuzzyIndex:
+    """Returns the typo tolerant index of restaurants whose normalized name
+       and street are given by texts"""
+    grams: Dict[int, Dict[str, Set[int]]] = {q: {} for q in FUZZY_GRAMS}
+    for i, restaurant_texts in enumerate(texts):
+        for attribute in restaurant_texts:
+            for q in FUZZY_GRAMS:
+                for start in range(len(attribute) - q + 1):
+                    grams[q].setdefault(attribute[start:start + q],
+                                        set()).add(i)
+    return FuzzyIndex(texts, grams)
+
+
+def _fuzzy_candidates(index: FuzzyIndex, word: str,
+                      max_l_dist: int) -> Set[int]:
+    """Returns the ids of the restaurants that share enough pieces with word
+       to contain it with up to max_l_dist typos"""
+    for q in FUZZY_GRAMS:
+        pieces: Set[str] = {word[start:start + q]
+                            for start in range(len(word) - q + 1)}
+        needed: int = len(pieces) - max_l_dist * q
+        if needed > 0:
+            counts: Dict[int, int] = {}
+            for piece in pieces:
+                for i in index.grams[q].get(piece, ()):
+                    counts[i] = counts.get(i, 0) + 1
+            return {i for i, count in counts.items() if count >= needed}
+    return set(range(len(index.texts)))
+
+
+def _distance(texts: List[str], word: str, max_l_dist: int) -> int:
+    """Returns the fewest typos needed to find word in one of texts, or -1 if
+       it needs more than max_l_dist"""
+    best: int = -1
+    for text in texts:
+        for match in find_near_matches(word, text, max_l_dist=max_l_dist):
+            if best == -1 or match.dist < best:
+                best = match.dist
+    return best
+
+
+def fuzzy_find_ids(index: FuzzyIndex, query: List[str],
+                   max_l_dist: int = 1) -> List[int]:
+    """Returns the ids of the restaurants whose name or street contain every
+       word of query with up to max_l_dist typos each, the ones with fewer
+       typos in total first and then in the order of the list"""
+    words: List[str] = [normalize(word) for word in query]
+    words = [word for word in words if word]
+    if not words:
+        return []
+    # A word can't be fully replaced, so short words allow fewer typos.
+    limits: List[int] = [min(max_l_dist, len(word) - 1) for word in words]
+    candidates: List[Set[int]] = sorted(
+        (_fuzzy_candidates(index, word, limit)
+         for word, limit in zip(words, limits)), key=len)
+    found: Set[int] = set(candidates[0])
+    for ids in candidates[1:]:
+        found &= ids
+    ranked: List[Tuple[int, int]] = []
+    for i in found:
+        total: int = 0
+        for word, limit in zip(words, limits):
+            dist: int = _distance(index.texts[i], word, limit)
+            if dist == -1:
+                break
+            total += dist
+        else:
+            ranked.append((total, i))
+    return [i for _, i in sorted(ranked)]
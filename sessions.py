@@ -0,0 +1,219 @@
+from abc import ABC, abstractmethod  # type: ignore
+from array import array  # type: ignore
+from collections import OrderedDict  # type: ignore
+from dataclasses import dataclass, replace  # type: ignore
+from typing import Any, Dict, List, Optional, Tuple, TypeAlias
+import sqlite3  # type: ignore
+import threading  # type: ignore
+import time  # type: ignore
+
+# What the bot remembers of every chat between its messages. Only the
+# positions of the restaurants in the catalog are kept, not the restaurants,
+# and chats that have been quiet for too long (or the least recently used
+# ones, when there are too many) are forgotten. SQLiteSessionStore keeps
+# them in a file, so they survive restarts.
+
+Coord: TypeAlias = Tuple[float, float]
+
+# Seconds a session is kept since it was last used, and most sessions kept.
+SESSION_TTL: float = 7 * 24 * 3600
+MAX_SESSIONS: int = 100000
+# The file store removes old sessions once every this many writes.
+PRUNE_INTERVAL: int = 256
+
+
+@dataclass(frozen=True)
+class Session:
+    # Positions in the catalog of the restaurants of the last /find or
+    # /near; None before the first search.
+    ids: Optional[Tuple[int, ...]] = None
+    destination: Optional[Coord] = None  # restaurant chosen with /guide
+    location: Optional[Coord] = None     # last location the user shared
+    catalog: Optional[str] = None        # version of the catalog of ids
+
+
+class SessionStore(ABC):
+    """Sessions by chat id. Sessions older than ttl seconds are dropped, as
+       are the least recently used ones beyond max_entries."""
+
+    def __init__(self, max_entries: int = MAX_SESSIONS,
+                 ttl: float = SESSION_TTL) -> None:
+        self.max_entries: int = max_entries
+        self.ttl: float = ttl
+        # The handlers of a chat run in several threads. Reentrant, so
+        # update() can hold it around get() and put().
+        self._lock = threading.RLock()
+
+    @abstractmethod
+    def get(self, chat_id: int) -> Session:
+        """Returns the session of chat_id, an empty one if there is none"""
+
+    @abstractmethod
+    def put(self, chat_id: int, session: Session) -> None:
+        """Keeps session as the one of chat_id"""
+
+    def update(self, chat_id: int, **changes: Any) -> Session:
+        """Changes the given fields of the session of chat_id and returns
+           it. Concurrent updates of the same session don't lose each other's
+           changes."""
+        with self._lock:
+            session: Session = replace(self.get(chat_id), **changes)
+            self.put(chat_id, session)
+            return session
+
+    @abstractmethod
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of sessions kept and of sessions dropped"""
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions kept in memory; they are lost when the bot stops"""
+
+    def __init__(self, max_entries: int = MAX_SESSIONS,
+                 ttl: float = SESSION_TTL) -> None:
+        super().__init__(max_entries, ttl)
+        self.evictions: int = 0
+        # chat id -> (session, time it was last used)
+        self._sessions: "OrderedDict[int, Tuple[Session, float]]" = \
+            OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, chat_id: int) -> Session:
+        with self._lock:
+            entry = self._sessions.get(chat_id)
+            if entry is None:
+                return Session()
+            if time.time() - entry[1] > self.ttl:
+                del self._sessions[chat_id]
+                self.evictions += 1
+                return Session()
+            self._sessions[chat_id] = (entry[0], time.time())
+            self._sessions.move_to_end(chat_id)
+            return entry[0]
+
+    def put(self, chat_id: int, session: Session) -> None:
+        with self._lock:
+            self._sessions[chat_id] = (session, time.time())
+            self._sessions.move_to_end(chat_id)
+            # The least recently used sessions are first; expired ones are
+            # dropped as well while they are there.
+            now: float = time.time()
+            while self._sessions:
+                oldest, (_, used) = next(iter(self._sessions.items()))
+                if len(self._sessions) <= self.max_entries and \
+                        now - used <= self.ttl:
+                    break
+                del self._sessions[oldest]
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"sessions": len(self._sessions), "evictions": self.evictions}
+
+
+def _coord(lon: Optional[float], lat: Optional[float]) -> Optional[Coord]:
+    return None if lon is None else (lon, lat)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions kept in an SQLite file, so they survive restarts. The ids are
+       stored as a blob of 32 bit integers."""
+
+    def __init__(self, filename: str, max_entries: int = MAX_SESSIONS,
+                 ttl: float = SESSION_TTL) -> None:
+        super().__init__(max_entries, ttl)
+        self.filename: str = filename
+        self.evictions: int = 0
+        self._writes: int = 0
+        # The handlers run in several threads; they share the connection
+        # under the lock.
+        self._db = sqlite3.connect(filename, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                         "chat_id INTEGER PRIMARY KEY, ids BLOB, "
+                         "destination_lon REAL, destination_lat REAL, "
+                         "location_lon REAL, location_lat REAL, "
+                         "used REAL NOT NULL, catalog TEXT)")
+        # Files made before the catalog version was kept get its column.
+        columns: List[str] = [row[1] for row in self._db.execute(
+            "PRAGMA table_info(sessions)")]
+        if "catalog" not in columns:
+            self._db.execute("ALTER TABLE sessions ADD COLUMN catalog TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_used "
+                         "ON sessions (used)")
+        with self._lock:
+            self._prune()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def get(self, chat_id: int) -> Session:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT ids, destination_lon, destination_lat, location_lon, "
+                "location_lat, used, catalog FROM sessions WHERE chat_id = ?",
+                (chat_id,)).fetchone()
+            if row is None:
+                return Session()
+            if time.time() - row[5] > self.ttl:
+                self._db.execute("DELETE FROM sessions WHERE chat_id = ?",
+                                 (chat_id,))
+                self.evictions += 1
+                return Session()
+            self._db.execute("UPDATE sessions SET used = ? WHERE chat_id = ?",
+                             (time.time(), chat_id))
+        ids: Optional[Tuple[int, ...]] = None
+        if row[0] is not None:
+            ids = tuple(array("i", row[0]))
+        return Session(ids, _coord(row[1], row[2]), _coord(row[3], row[4]),
+                       row[6])
+
+    def put(self, chat_id: int, session: Session) -> None:
+        ids: Optional[bytes] = None
+        if session.ids is not None:
+            ids = array("i", session.ids).tobytes()
+        destination = session.destination or (None, None)
+        location = session.location or (None, None)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?)",
+                (chat_id, ids, destination[0], destination[1], location[0],
+                 location[1], time.time(), session.catalog))
+            self._writes += 1
+            if self._writes % PRUNE_INTERVAL == 0:
+                self._prune()
+
+    def _prune(self) -> None:
+        """Removes the expired sessions and the least recently used ones
+           beyond max_entries"""
+        removed: int = self._db.execute(
+            "DELETE FROM sessions WHERE used < ?",
+            (time.time() - self.ttl,)).rowcount
+        removed += self._db.execute(
+            "DELETE FROM sessions WHERE chat_id IN (SELECT chat_id FROM "
+            "sessions ORDER BY used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)).rowcount
+        self.evictions += removed
+
+    def stats(self) -> Dict[str, int]:
+        return {"sessions": len(self), "evictions": self.evictions}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def open_store(filename: Optional[str] = None,
+               max_entries: int = MAX_SESSIONS,
+               ttl: float = SESSION_TTL) -> SessionStore:
+    """Returns a store kept in the SQLite file filename, or in memory if no
+       file is given"""
+    if filename:
+        return SQLiteSessionStore(filename, max_entries, ttl)
+    return MemorySessionStore(max_entries, ttl)
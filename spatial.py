@@ -0,0 +1,77 @@
+from dataclasses import dataclass  # type: ignore
+from typing import Union, List, Tuple, TypeAlias  # type: ignore
+from scipy.spatial import cKDTree  # type: ignore
+import networkx as nx  # type: ignore
+import numpy as np  # type: ignore
+import routing  # type: ignore
+
+OsmnxGraph: TypeAlias = nx.MultiDiGraph
+
+Coord: TypeAlias = Tuple[float, float]
+
+NodeID: TypeAlias = Union[int, str]
+
+# Same earth radius osmnx uses, so the distances match nearest_nodes().
+EARTH_RADIUS_M: float = 6371009
+
+
+@dataclass
+class SpatialIndex:
+    """KD-tree over the street nodes of a graph. Positions are stored as
+       points of the unit sphere, where the closest point in straight line is
+       also the closest one along the earth's surface."""
+    ids: np.ndarray
+    tree: cKDTree
+
+
+def _to_sphere(positions: np.ndarray) -> np.ndarray:
+    """Returns the (lon, lat) positions as points of the unit sphere"""
+    lon = np.radians(positions[:, 0])
+    lat = np.radians(positions[:, 1])
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon),
+                            np.sin(lat)))
+
+
+def _to_meters(chords: np.ndarray) -> np.ndarray:
+    """Returns the distances along the earth of the given chords of the unit
+       sphere"""
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(chords / 2, 1.0))
+
+
+def build_spatial_index(ids: np.ndarray,
+                        positions: np.ndarray) -> SpatialIndex:
+    """Returns the index of the nodes ids placed at (lon, lat) positions"""
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    return SpatialIndex(np.asarray(ids), cKDTree(_to_sphere(positions)))
+
+
+def index_from_osmnx(g1: OsmnxGraph) -> SpatialIndex:
+    """Returns the index of all the nodes of the osmnx graph g1"""
+    ids = np.array(list(g1.nodes))
+    positions = np.array([(g1.nodes[u]["x"], g1.nodes[u]["y"])
+                          for u in g1.nodes], dtype=np.float64)
+    return build_spatial_index(ids, positions)
+
+
+def index_from_routing(rg: routing.RoutingGraph) -> SpatialIndex:
+    """Returns the index of the street nodes of rg, which are the nodes of
+       the osmnx graph it was built from"""
+    street: int = rg.node_type_names.index("Street")
+    mask = rg.node_types == street
+    return build_spatial_index(rg.ids[mask], rg.positions[mask])
+
+
+def nearest_nodes(index: SpatialIndex,
+                  positions: np.ndarray) -> Tuple[List[NodeID], np.ndarray]:
+    """Returns the closest node to every (lon, lat) position and its
+       distance in meters"""
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    chords, found = index.tree.query(_to_sphere(positions))
+    return index.ids[found].tolist(), _to_meters(chords)
+
+
+def nearest_node(index: SpatialIndex, position: Coord) -> Tuple[NodeID, float]:
+    """Returns the closest node to position and its distance in meters"""
+    nodes, distances = nearest_nodes(index, np.array([position]))
+    return nodes[0], float(distances[0])
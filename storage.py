@@ -0,0 +1,266 @@
+from typing import Any, Callable, Dict, List, Optional  # type: ignore
+import hashlib  # type: ignore
+import json  # type: ignore
+import math  # type: ignore
+import os  # type: ignore
+import shutil  # type: ignore
+import numpy as np  # type: ignore
+import contraction  # type: ignore
+import restaurants  # type: ignore
+import routing  # type: ignore
+
+# Prebuilt data is kept in directories of .npy files with a manifest.json.
+# The arrays are opened with mmap_mode="r", so loading only maps the files
+# and every process that opens them shares the same pages. The manifest
+# records the files the data was built from; when one of them changed, the
+# directory is built again instead of being reused.
+
+FORMAT_VERSION: int = 1
+MANIFEST: str = "manifest.json"
+
+CITY_DIRECTORY: str = "city_graph_data"
+CITY_SOURCES: List[str] = ["barcelona_walk", "estacions.csv", "accessos.csv"]
+RESTAURANTS_DIRECTORY: str = "restaurants_data"
+RESTAURANTS_SOURCES: List[str] = ["restaurants.csv"]
+
+ROUTING_ARRAYS: List[str] = ["positions", "node_types", "offsets",
+                             "neighbours", "weights", "distances",
+                             "edge_types", "colours"]
+HIERARCHY_ARRAYS: List[str] = ["rank", "offsets", "targets", "weights",
+                               "middles"]
+RESTAURANT_FIELDS: List[str] = ["name", "street", "number", "neighborhood",
+                                "district", "zip", "telf"]
+
+
+def _file_checksum(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _describe(sources: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Returns the size, modification time and checksum of the sources that
+       exist"""
+    described: Dict[str, Dict[str, Any]] = {}
+    for source in sources:
+        if os.path.exists(source):
+            status = os.stat(source)
+            described[source] = {"size": status.st_size,
+                                 "mtime_ns": status.st_mtime_ns,
+                                 "sha256": _file_checksum(source)}
+    return described
+
+
+def _read_manifest(directory: str, kind: str,
+                   sources: List[str]) -> Optional[Dict[str, Any]]:
+    """Returns the manifest of directory if it holds data of the given kind
+       in the current format, built from the current sources; None if it
+       must be built again. Sources are only read again when their size or
+       modification time changed."""
+    filename: str = os.path.join(directory, MANIFEST)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as file:
+        manifest: Dict[str, Any] = json.load(file)
+    if manifest.get("kind") != kind or \
+            manifest.get("version") != FORMAT_VERSION:
+        return None
+    stored: Dict[str, Dict[str, Any]] = manifest["sources"]
+    touched: bool = False
+    for source in sources:
+        if not os.path.exists(source):
+            # Without the source there is nothing to build it again from.
+            continue
+        if source not in stored:
+            return None
+        status = os.stat(source)
+        if status.st_size == stored[source]["size"] and \
+                status.st_mtime_ns == stored[source]["mtime_ns"]:
+            continue
+        if _file_checksum(source) != stored[source]["sha256"]:
+            return None
+        # Same contents with a new time (a copy, a checkout...).
+        stored[source]["mtime_ns"] = status.st_mtime_ns
+        touched = True
+    if touched:
+        _write_manifest(directory, manifest)
+    return manifest
+
+
+def _write_manifest(directory: str, manifest: Dict[str, Any]) -> None:
+    temporary: str = os.path.join(directory, MANIFEST + ".tmp")
+    with open(temporary, "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(temporary, os.path.join(directory, MANIFEST))
+
+
+def _write_directory(directory: str, arrays: Dict[str, np.ndarray],
+                     manifest: Dict[str, Any]) -> None:
+    """Writes the arrays and the manifest in a new directory that then
+       replaces directory, so readers never see it half written. Processes
+       that mapped the old files keep them until they unmap them."""
+    new: str = "%s.new-%d" % (directory, os.getpid())
+    shutil.rmtree(new, ignore_errors=True)
+    os.makedirs(new)
+    for name, array in arrays.items():
+        np.save(os.path.join(new, name + ".npy"), np.ascontiguousarray(array),
+                allow_pickle=False)
+    _write_manifest(new, manifest)
+    old: str = "%s.old-%d" % (directory, os.getpid())
+    if os.path.exists(directory):
+        os.replace(directory, old)
+    os.replace(new, directory)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _load_array(directory: str, name: str) -> np.ndarray:
+    return np.load(os.path.join(directory, name + ".npy"), mmap_mode="r",
+                   allow_pickle=False)
+
+
+def save_routing_graph(rg: routing.RoutingGraph, directory: str,
+                       sources: List[str] = CITY_SOURCES) -> None:
+    """Saves rg, and its hierarchy if it has one, in directory"""
+    arrays: Dict[str, np.ndarray] = {name: getattr(rg, name)
+                                     for name in ROUTING_ARRAYS}
+    # Ids that are not all integers can't be mapped; they go in the
+    # manifest, which keeps them as numbers or strings.
+    if rg.ids.dtype == np.int64:
+        arrays["ids"] = rg.ids
+        ids: Optional[List[Any]] = None
+    else:
+        ids = rg.ids.tolist()
+    if rg.hierarchy is not None:
+        for name in HIERARCHY_ARRAYS:
+            arrays["ch_" + name] = getattr(rg.hierarchy, name)
+    manifest: Dict[str, Any] = {
+        "kind": "routing_graph", "version": FORMAT_VERSION,
+        "sources": _describe(sources),
+        "checksum": contraction.graph_checksum(rg.offsets, rg.neighbours,
+                                               rg.weights),
+        "ids": ids,
+        "node_type_names": rg.node_type_names,
+        "edge_type_names": rg.edge_type_names,
+        "colour_names": rg.colour_names,
+        "hierarchy": None if rg.hierarchy is None else rg.hierarchy.checksum}
+    _write_directory(directory, arrays, manifest)
+
+
+def load_routing_graph(directory: str,
+                       build: Callable[[], routing.RoutingGraph],
+                       sources: List[str] = CITY_SOURCES
+                       ) -> routing.RoutingGraph:
+    """Returns the routing graph stored in directory, with its arrays mapped
+       from the files. If the directory is missing, in another format or
+       built from other sources, build() is called and its graph is saved
+       first."""
+    manifest: Optional[Dict[str, Any]] = _read_manifest(
+        directory, "routing_graph", sources)
+    if manifest is not None:
+        arrays: Dict[str, np.ndarray] = {
+            name: _load_array(directory, name) for name in ROUTING_ARRAYS}
+        checksum: str = contraction.graph_checksum(
+            arrays["offsets"], arrays["neighbours"], arrays["weights"])
+        # A damaged or half copied directory is also built again.
+        if checksum != manifest["checksum"]:
+            manifest = None
+    if manifest is None:
+        save_routing_graph(build(), directory, sources)
+        return load_routing_graph(directory, build, sources)
+
+    if manifest["ids"] is None:
+        ids: np.ndarray = _load_array(directory, "ids")
+    else:
+        ids = np.array(manifest["ids"], dtype=object)
+    rg = routing.RoutingGraph(
+        ids, {node: i for i, node in enumerate(ids.tolist())},
+        arrays["positions"], arrays["node_types"], arrays["offsets"],
+        arrays["neighbours"], arrays["weights"], arrays["distances"],
+        arrays["edge_types"], arrays["colours"], manifest["node_type_names"],
+        manifest["edge_type_names"], manifest["colour_names"])
+    if manifest["hierarchy"] == checksum:
+        rg.hierarchy = contraction.ContractionHierarchy(
+            checksum, *[_load_array(directory, "ch_" + name)
+                        for name in HIERARCHY_ARRAYS])
+    return rg
+
+
+def _is_missing(value: Any) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def save_restaurants(restaurants_list: restaurants.Restaurants,
+                     directory: str,
+                     sources: List[str] = RESTAURANTS_SOURCES) -> None:
+    """Saves the restaurants in directory, one array per field. Text fields
+       have a second array that tells which values are missing (NaN)."""
+    arrays: Dict[str, np.ndarray] = {}
+    kinds: Dict[str, str] = {}
+    for field in RESTAURANT_FIELDS:
+        values: List[Any] = [getattr(r, field) for r in restaurants_list]
+        present: List[Any] = [v for v in values if not _is_missing(v)]
+        if all(isinstance(v, int) and not isinstance(v, bool)
+               for v in present) and len(present) == len(values):
+            kinds[field] = "int"
+            arrays[field] = np.array(values, dtype=np.int64)
+        elif all(isinstance(v, (int, float)) and not isinstance(v, bool)
+                 for v in present):
+            kinds[field] = "float"
+            arrays[field] = np.array([math.nan if _is_missing(v) else v
+                                      for v in values], dtype=np.float64)
+        else:
+            kinds[field] = "str"
+            arrays[field] = np.array(["" if _is_missing(v) else str(v)
+                                      for v in values], dtype=np.str_)
+            arrays[field + "_missing"] = np.array(
+                [_is_missing(v) for v in values], dtype=bool)
+    arrays["position"] = np.array([r.position for r in restaurants_list],
+                                  dtype=np.float64).reshape(-1, 2)
+    manifest: Dict[str, Any] = {"kind": "restaurants",
+                                "version": FORMAT_VERSION,
+                                "sources": _describe(sources),
+                                "count": len(restaurants_list),
+                                "fields": kinds}
+    _write_directory(directory, arrays, manifest)
+
+
+def load_restaurant_columns(
+        directory: str, build: Callable[[], restaurants.Restaurants],
+        sources: List[str] = RESTAURANTS_SOURCES) -> Dict[str, np.ndarray]:
+    """Returns the arrays of the restaurants stored in directory, mapped from
+       the files, building them first with build() if they are missing or
+       stale"""
+    manifest: Optional[Dict[str, Any]] = _read_manifest(
+        directory, "restaurants", sources)
+    if manifest is None:
+        save_restaurants(build(), directory, sources)
+        return load_restaurant_columns(directory, build, sources)
+    names: List[str] = ["position"] + list(manifest["fields"]) + \
+        [field + "_missing" for field, kind in manifest["fields"].items()
+         if kind == "str"]
+    return {name: _load_array(directory, name) for name in names}
+
+
+def load_restaurants(directory: str,
+                     build: Callable[[], restaurants.Restaurants],
+                     sources: List[str] = RESTAURANTS_SOURCES
+                     ) -> restaurants.Restaurants:
+    """Returns the restaurants stored in directory (see
+       load_restaurant_columns); missing text values are NaN, as when they
+       are read from the csv file"""
+    columns: Dict[str, np.ndarray] = load_restaurant_columns(directory, build,
+                                                             sources)
+    fields: Dict[str, List[Any]] = {}
+    for field in RESTAURANT_FIELDS:
+        values: List[Any] = columns[field].tolist()
+        if field + "_missing" in columns:
+            values = [math.nan if missing else value for value, missing in
+                      zip(values, columns[field + "_missing"].tolist())]
+        fields[field] = values
+    positions: List[List[float]] = columns["position"].tolist()
+    return [restaurants.Restaurant(*[fields[field][i]
+                                     for field in RESTAURANT_FIELDS],
+                                   tuple(positions[i]))
+            for i in range(len(positions))]
@@ -0,0 +1,127 @@
+from dataclasses import dataclass  # type: ignore
+from typing import Optional  # type: ignore
+import threading  # type: ignore
+import gc  # type: ignore
+import os  # type: ignore
+import city  # type: ignore
+import cache  # type: ignore
+import routing  # type: ignore
+import spatial  # type: ignore
+import storage  # type: ignore
+
+# The store keeps one snapshot of every graph the bot needs. Handlers only
+# read from it, so after main() has filled it the same objects are shared by
+# every handler (and, after a fork, by every worker process).
+
+
+@dataclass(frozen=True)
+class Graphs:
+    routing_graph: routing.RoutingGraph
+    spatial_index: spatial.SpatialIndex
+    routes: cache.LRUCache  # (src_node, dst_node) -> (path, minutes)
+    images: cache.LRUCache  # (path, src, dst) -> png of plot_path()
+    generation: int
+
+
+# Size and lifetime (in seconds) of the cache of computed routes.
+ROUTE_CACHE_ENTRIES: int = 4096
+ROUTE_CACHE_TTL: float = 6 * 3600
+# Number and total bytes of the rendered route images that are kept.
+IMAGE_CACHE_ENTRIES: int = 1024
+IMAGE_CACHE_BYTES: int = 64 * 1024 * 1024
+
+_graphs: Optional[Graphs] = None
+_filenames = {"city": "city_graph"}
+_lock = threading.Lock()
+
+
+def _build() -> routing.RoutingGraph:
+    """Builds the routing graph from the city graph, with its hierarchy if
+       build_hierarchy() has saved one for the same graph"""
+    # When the files the city graph is made of are here it is built from
+    # them, since the pickled graph may be older; otherwise the pickle is
+    # used (or everything is downloaded).
+    if all(os.path.exists(source) for source in storage.CITY_SOURCES):
+        g: city.CityGraph = city.make_city_graph()
+    else:
+        g = city.load_city_graph(_filenames["city"])
+    rg: routing.RoutingGraph = routing.build_routing_graph(g)
+    # Building the contraction hierarchy takes minutes, so it is never done
+    # while the bot starts; a hierarchy built offline is kept if it still
+    # belongs to the graph.
+    routing.load_hierarchy(rg, _filenames["city"] + "_ch", build=False)
+    return rg
+
+
+def _read(generation: int) -> Graphs:
+    """Loads a new snapshot of the graphs from disk"""
+    # The arrays are mapped from their files, so loading takes milliseconds
+    # and forked or separately started workers share the same pages.
+    rg: routing.RoutingGraph = storage.load_routing_graph(
+        _filenames["city"] + "_data", _build)
+    # Snapping only needs the street nodes, which are also in the routing
+    # graph, so the osmnx graph does not have to stay in memory.
+    index: spatial.SpatialIndex = spatial.index_from_routing(rg)
+    # Every snapshot gets its own empty caches, so routes computed on the
+    # old graphs are forgotten when the graphs are reloaded.
+    routes = cache.LRUCache(ROUTE_CACHE_ENTRIES, ROUTE_CACHE_TTL)
+    images = cache.LRUCache(IMAGE_CACHE_ENTRIES,
+                            max_size=IMAGE_CACHE_BYTES)
+    return Graphs(rg, index, routes, images, generation)
+
+
+def load(city_filename: str = "city_graph") -> Graphs:
+    """Fills the store the first time it is called and returns its snapshot;
+       later calls return the graphs that are already in memory."""
+    global _graphs
+    with _lock:
+        if _graphs is None:
+            _filenames["city"] = city_filename
+            _graphs = _read(1)
+        return _graphs
+
+
+def reload(generation: Optional[int] = None) -> Graphs:
+    """Reads the graphs again from their files and replaces the snapshot,
+       numbered generation or the one after the current one. Handlers that
+       already got the old snapshot keep using it until they finish."""
+    global _graphs
+    with _lock:
+        if generation is None:
+            generation = 1 if _graphs is None else _graphs.generation + 1
+        # The new snapshot is built completely before it is published, so
+        # readers never see a half loaded store.
+        _graphs = _read(generation)
+        return _graphs
+
+
+def get() -> Graphs:
+    """Returns the current snapshot of the graphs"""
+    graphs: Optional[Graphs] = _graphs
+    if graphs is None:
+        raise RuntimeError("the graph store has not been loaded")
+    return graphs
+
+
+def build_hierarchy(city_filename: str = "city_graph") -> None:
+    """Builds the contraction hierarchy of the stored routing graph, if it
+       has none, and stores it with the graph, so the "ch" search mode can
+       be used. It takes minutes; run it offline with python store.py."""
+    _filenames["city"] = city_filename
+    rg: routing.RoutingGraph = storage.load_routing_graph(
+        city_filename + "_data", _build)
+    if rg.hierarchy is None:
+        routing.load_hierarchy(rg, city_filename + "_ch")
+        storage.save_routing_graph(rg, city_filename + "_data")
+
+
+def freeze() -> None:
+    """Moves every object allocated so far out of the garbage collector's
+       reach. Call it after load() and before forking workers so the
+       collector does not touch (and therefore copy) the shared pages."""
+    gc.collect()
+    gc.freeze()
+
+
+if __name__ == "__main__":
+    build_hierarchy()
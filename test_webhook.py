@@ -0,0 +1,175 @@
+from concurrent.futures import ThreadPoolExecutor  # type: ignore
+from typing import Any, Dict, List, Tuple  # type: ignore
+from unittest import mock  # type: ignore
+import http.client  # type: ignore
+import json  # type: ignore
+import multiprocessing  # type: ignore
+import os  # type: ignore
+import signal  # type: ignore
+import time  # type: ignore
+import unittest  # type: ignore
+import urllib.error  # type: ignore
+import urllib.request  # type: ignore
+import webhook  # type: ignore
+
+# Tests of the webhook server against shards that only record the updates
+# they handle. Run them with
+#
+#     python -m unittest test_webhook
+
+SECRET: str = "secret"
+PATH: str = "/telbot"
+CHAT: int = 12345
+SHARDS: int = 2
+# Seconds a shard takes to handle /slow.
+SLOW: float = 2
+
+
+def message(update_id: int, chat: int = CHAT,
+            text: str = "/find bar") -> Dict[str, Any]:
+    """Returns an update with a text message of chat"""
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "text": text,
+                        "chat": {"id": chat, "type": "private"}}}
+
+
+class WebhookServerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # Made before the shards are forked, so they inherit them: the
+        # shards put their index and pid in started when they start, and
+        # (chat, update_id) in handled for every update.
+        context = multiprocessing.get_context("fork")
+        self.started: "multiprocessing.Queue[Tuple[int, int]]" = \
+            context.Queue()
+        self.handled: "multiprocessing.Queue[Tuple[int, int]]" = \
+            context.Queue()
+        self.server = webhook.WebhookServer(
+            self.setup_shard, SECRET, shards=SHARDS, host="127.0.0.1",
+            port=0, path=webhook.path_of("https://example.org" + PATH))
+        self.server.start()
+        self.pids: Dict[int, int] = dict(
+            self.started.get(timeout=10) for _ in range(SHARDS))
+
+    def tearDown(self) -> None:
+        self.server.stop()
+
+    def setup_shard(self, index: int) -> webhook.Handle:
+        self.started.put((index, os.getpid()))
+
+        def handle(update: webhook.Update) -> None:
+            if update["message"]["text"] == "/slow":
+                time.sleep(SLOW)
+            self.handled.put((webhook.chat_id(update), update["update_id"]))
+        return handle
+
+    def post(self, update: Any, secret: str = SECRET,
+             path: str = PATH) -> int:
+        """POSTs update to the server and returns the status it answers"""
+        data: bytes = update if isinstance(update, bytes) else \
+            json.dumps(update).encode()
+        request = urllib.request.Request(
+            "http://%s:%d%s" % (*self.server.address, path), data=data,
+            headers={"Content-Type": "application/json",
+                     "X-Telegram-Bot-Api-Secret-Token": secret})
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def handled_ids(self, count: int) -> List[int]:
+        return [self.handled.get(timeout=10)[1] for _ in range(count)]
+
+    def test_updates_of_every_chat_keep_their_order(self) -> None:
+        # Like Telegram, every chat sends its next update once the last one
+        # was answered, and the chats send theirs at the same time.
+        chats: int = 16
+        rounds: int = 20
+
+        def send(chat: int) -> List[int]:
+            return [self.post(message(1000 + i * chats + chat, CHAT + chat))
+                    for i in range(rounds)]
+        with ThreadPoolExecutor(chats) as executor:
+            statuses: List[List[int]] = list(executor.map(send,
+                                                          range(chats)))
+        self.assertEqual(statuses, [[200] * rounds] * chats)
+        by_chat: Dict[int, List[int]] = {}
+        for _ in range(chats * rounds):
+            chat, update_id = self.handled.get(timeout=10)
+            by_chat.setdefault(chat, []).append(update_id)
+        self.assertEqual(by_chat, {
+            CHAT + chat: [1000 + i * chats + chat for i in range(rounds)]
+            for chat in range(chats)})
+
+    def test_updates_sent_again_are_handled_once(self) -> None:
+        for update_id in [1, 2, 2, 3, 1]:
+            self.assertEqual(self.post(message(update_id)), 200)
+        self.server.stop()
+        self.assertEqual(self.handled_ids(3), [1, 2, 3])
+        self.assertTrue(self.handled.empty())
+
+    def test_requests_without_the_secret_or_path_are_refused(self) -> None:
+        self.assertEqual(self.post(message(1), secret="other"), 403)
+        self.assertEqual(self.post(message(1), path="/"), 403)
+        # Answered from the headers alone, before the body is sent.
+        connection = http.client.HTTPConnection(*self.server.address,
+                                                timeout=10)
+        connection.putrequest("POST", PATH)
+        connection.putheader("X-Telegram-Bot-Api-Secret-Token", SECRET)
+        connection.putheader("Content-Length", str(webhook.MAX_BODY + 1))
+        connection.endheaders()
+        self.assertEqual(connection.getresponse().status, 413)
+        connection.close()
+        self.assertEqual(self.post(b"not json"), 400)
+        self.assertEqual(self.post(message(1)), 200)
+        self.assertEqual(self.handled_ids(1), [1])
+
+    def test_a_slow_chat_does_not_hold_up_the_others(self) -> None:
+        other: int = CHAT + SHARDS * webhook.THREADS
+        self.assertEqual(webhook.shard_of(message(1, other), SHARDS),
+                         webhook.shard_of(message(1), SHARDS))
+        self.assertEqual(self.post(message(1, text="/slow")), 200)
+        self.assertEqual(self.post(message(2)), 200)
+        start: float = time.monotonic()
+        self.assertEqual(self.post(message(3, other)), 200)
+        self.assertEqual(self.handled.get(timeout=10), (other, 3))
+        self.assertLess(time.monotonic() - start, SLOW / 2)
+        # The chat of the slow update still gets its updates in order.
+        self.assertEqual(self.handled_ids(2), [1, 2])
+
+    def test_a_full_shard_answers_503(self) -> None:
+        pid: int = self.pids[webhook.shard_of(message(1), SHARDS)]
+        os.kill(pid, signal.SIGSTOP)
+        try:
+            # Large updates, so the pipe to the shard fills up soon.
+            text: str = "/find " + "x" * 16384
+            statuses: List[int] = []
+            with mock.patch.object(webhook, "QUEUE_TIMEOUT", 0.1):
+                while 503 not in statuses and \
+                        len(statuses) < 2 * webhook.MAX_PENDING:
+                    statuses.append(self.post(message(len(statuses) + 1,
+                                                      text=text)))
+                # The other shard still takes updates.
+                self.assertEqual(self.post(message(5000, CHAT + 1)), 200)
+        finally:
+            os.kill(pid, signal.SIGCONT)
+        self.assertEqual(statuses[-1], 503)
+        self.assertEqual(self.handled.get(timeout=10), (CHAT + 1, 5000))
+        # Sent again, the update refused comes after the ones before it.
+        self.assertEqual(self.post(message(len(statuses), text=text)), 200)
+        self.assertEqual(self.handled_ids(len(statuses)),
+                         list(range(1, len(statuses) + 1)))
+
+    def test_shards_that_die_are_started_again(self) -> None:
+        index: int = webhook.shard_of(message(1), SHARDS)
+        os.kill(self.pids[index], signal.SIGKILL)
+        # Updates the shard had read when it died are lost, so this one is
+        # only sent once it was started again.
+        self.assertEqual(self.started.get(timeout=10)[0], index)
+        self.assertEqual(self.post(message(1)), 200)
+        self.assertEqual(self.handled_ids(1), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+from collections import OrderedDict  # type: ignore
+from typing import Any, Dict, Hashable, List, Optional, Tuple, TypeAlias
+from staticmap import CircleMarker, Line, StaticMap  # type: ignore
+from staticmap.staticmap import _lat_to_y, _lon_to_x  # type: ignore
+from PIL import Image  # type: ignore
+import hashlib  # type: ignore
+import io  # type: ignore
+import os  # type: ignore
+import re  # type: ignore
+import tempfile  # type: ignore
+import threading  # type: ignore
+import numpy as np  # type: ignore
+import requests  # type: ignore
+import geometry  # type: ignore
+
+# Every map the bot draws asks for its base tiles through a TileCache, which
+# keeps the downloaded tiles on disk and forgets the least recently used ones
+# when they take more than max_bytes. In offline mode nothing is downloaded:
+# tiles come from the cache or from a directory of tiles laid out as
+# {z}/{x}/{y}.png, and the missing ones are left blank.
+
+TILE_URL: str = "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+TILE_CACHE_DIRECTORY: str = "tile_cache"
+TILE_CACHE_BYTES: int = 256 * 1024 * 1024
+TILE_SIZE: int = 256
+
+Coord: TypeAlias = Tuple[float, float]
+
+
+class TileCache:
+    """Disk cache of map tiles with a limit on its total size. It may be
+       shared by threads; processes sharing the directory keep separate
+       counts and just miss the tiles another one removed."""
+
+    def __init__(self, directory: str = TILE_CACHE_DIRECTORY,
+                 max_bytes: int = TILE_CACHE_BYTES, offline: bool = False,
+                 tile_directory: Optional[str] = None) -> None:
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.offline: bool = offline
+        self.tile_directory: Optional[str] = tile_directory
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.downloads: int = 0
+        self.evictions: int = 0
+        self._lock = threading.Lock()
+        # file name -> size, from the least to the most recently used
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        # The order of use survives restarts through the modification times,
+        # which are updated on every hit.
+        entries = sorted((entry for entry in os.scandir(directory)
+                          if entry.is_file() and entry.name.endswith(".png")),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            self._files[entry.name] = entry.stat().st_size
+            self.size += entry.stat().st_size
+
+    def get(self, url: str, **kwargs: Any) -> Tuple[int, bytes]:
+        """Returns the status code and the content of the tile at url, like
+           StaticMap.get(); kwargs are passed to requests.get()"""
+        name: str = hashlib.sha1(url.encode()).hexdigest() + ".png"
+        content: Optional[bytes] = self._read(name)
+        if content is not None:
+            return 200, content
+        content = self._local(url)
+        if content is None and not self.offline:
+            response = requests.get(url, **kwargs)
+            if response.status_code != 200:
+                return response.status_code, response.content
+            content = response.content
+            with self._lock:
+                self.downloads += 1
+        if content is None:
+            return 200, _blank_tile()
+        self._write(name, content)
+        return 200, content
+
+    def _read(self, name: str) -> Optional[bytes]:
+        path: str = os.path.join(self.directory, name)
+        with self._lock:
+            if name not in self._files:
+                self.misses += 1
+                return None
+            self._files.move_to_end(name)
+        try:
+            with open(path, "rb") as file:
+                content: bytes = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # Another process removed it.
+            with self._lock:
+                self.size -= self._files.pop(name, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def _local(self, url: str) -> Optional[bytes]:
+        """Returns the tile of url from the tile directory, if it is there"""
+        if self.tile_directory is None:
+            return None
+        match = _URL_PATTERN.match(url)
+        if match is None:
+            return None
+        path: str = os.path.join(self.tile_directory, match.group("z"),
+                                 match.group("x"), match.group("y") + ".png")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as file:
+            return file.read()
+
+    def _write(self, name: str, content: bytes) -> None:
+        if len(content) > self.max_bytes:
+            return
+        # The tile is written under another name and then renamed, so
+        # readers never see half a file.
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory,
+                                                 suffix=".tmp")
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(content)
+        os.replace(temporary, os.path.join(self.directory, name))
+        with self._lock:
+            self.size += len(content) - self._files.pop(name, 0)
+            self._files[name] = len(content)
+            while self.size > self.max_bytes:
+                old, size = self._files.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the counters of the cache"""
+        return {"tiles": len(self._files), "size": self.size,
+                "hits": self.hits, "misses": self.misses,
+                "downloads": self.downloads, "evictions": self.evictions}
+
+
+_URL_PATTERN = re.compile(re.escape(TILE_URL)
+                          .replace(r"\{z\}", r"(?P<z>\d+)")
+                          .replace(r"\{x\}", r"(?P<x>\d+)")
+                          .replace(r"\{y\}", r"(?P<y>\d+)") + "$")
+
+_blank: Optional[bytes] = None
+_cache: Optional[TileCache] = None
+
+
+def _blank_tile() -> bytes:
+    """Returns a transparent tile, used offline for the missing ones"""
+    global _blank
+    if _blank is None:
+        buffer = io.BytesIO()
+        Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)).save(buffer,
+                                                                    "PNG")
+        _blank = buffer.getvalue()
+    return _blank
+
+
+def configure(directory: str = TILE_CACHE_DIRECTORY,
+              max_bytes: int = TILE_CACHE_BYTES, offline: bool = False,
+              tile_directory: Optional[str] = None) -> TileCache:
+    """Replaces the tile cache used by the maps created with new_map()"""
+    global _cache
+    _cache = TileCache(directory, max_bytes, offline, tile_directory)
+    return _cache
+
+
+def get_cache() -> TileCache:
+    """Returns the tile cache, creating the default one the first time"""
+    if _cache is None:
+        return configure()
+    return _cache
+
+
+class CachedStaticMap(StaticMap):
+    """StaticMap that takes its tiles from a TileCache"""
+
+    def __init__(self, *args: Any, tile_cache: TileCache,
+                 **kwargs: Any) -> None:
+        super().__init__(*args, url_template=TILE_URL, **kwargs)
+        self.tile_cache: TileCache = tile_cache
+
+    def get(self, url: str, **kwargs: Any) -> Tuple[int, bytes]:
+        return self.tile_cache.get(url, **kwargs)
+
+    def simplify_lines(self, tolerance: float,
+                       zoom: Optional[int] = None) -> int:
+        """Simplifies the lines added so far with Douglas-Peucker, moving no
+           point more than tolerance pixels at the zoom the map will be
+           rendered at (the one render() would choose, if none is given),
+           and returns that zoom. Give it to render(), since the simplified
+           lines could lead to another zoom."""
+        if zoom is None:
+            zoom = self._calculate_zoom()
+        for line in self.lines:
+            points: np.ndarray = np.array(
+                [(_lon_to_x(lon, zoom), _lat_to_y(lat, zoom))
+                 for lon, lat in line.coords]) * self.tile_size
+            line.coords = [line.coords[i] for i in
+                           geometry.douglas_peucker(points, tolerance)]
+        return zoom
+
+
+def new_map(width: int, height: int, padding_x: int = 0,
+            padding_y: int = 0) -> StaticMap:
+    """Returns an empty StaticMap whose tiles go through the tile cache"""
+    return CachedStaticMap(width, height, padding_x, padding_y,
+                           tile_cache=get_cache())
+
+
+def add_network(m: StaticMap, edges: List[Tuple[Hashable, Hashable, str]],
+                pos: Dict[Hashable, Coord], colors: Dict[Hashable, str],
+                marker_width: int, line_width: int) -> None:
+    """Adds to m the (node, node, colour) edges and the nodes at their ends.
+       Edges of the same colour are joined into chains drawn as one line
+       each, and every node gets one marker."""
+    for chain, color in geometry.chains(edges):
+        m.add_line(Line([pos[node] for node in chain], color, line_width,
+                        simplify=False))
+    # Drawing the two ends of every edge drew most nodes several times; each
+    # one is drawn once, in the order of the last time it was, so markers
+    # that overlap look the same.
+    nodes: Dict[Hashable, None] = {}
+    for a, b, _ in edges:
+        for node in (a, b):
+            nodes.pop(node, None)
+            nodes[node] = None
+    for node in nodes:
+        m.add_marker(CircleMarker(pos[node], colors[node], marker_width))
@@ -0,0 +1,37 @@
+from contextlib import contextmanager  # type: ignore
+from typing import Dict, Iterator, List, Tuple  # type: ignore
+import time  # type: ignore
+
+
+class Timer:
+    """Measures how long every stage of a process takes, in the order the
+       stages run"""
+
+    def __init__(self) -> None:
+        self.stages: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Measures the code inside the with block as the stage name"""
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - start))
+
+    def add(self, name: str, seconds: float) -> None:
+        """Records a stage that was measured some other way"""
+        self.stages.append((name, seconds))
+
+    def seconds(self) -> Dict[str, float]:
+        """Returns the seconds taken by every stage"""
+        return dict(self.stages)
+
+    def report(self) -> str:
+        """Returns a line for every stage and one for the total"""
+        width: int = max([len(name) for name, _ in self.stages] + [5])
+        lines: List[str] = ["%-*s %8.3f s" % (width, name, seconds)
+                            for name, seconds in self.stages]
+        lines.append("%-*s %8.3f s" % (width, "total",
+                                       sum(s for _, s in self.stages)))
+        return "\n".join(lines)
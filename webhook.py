@@ -0,0 +1,389 @@
+from collections import deque  # type: ignore
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Set
+from typing import TypeAlias  # type: ignore
+import hashlib  # type: ignore
+import hmac  # type: ignore
+import json  # type: ignore
+import multiprocessing  # type: ignore
+import multiprocessing.connection  # type: ignore
+import os  # type: ignore
+import queue  # type: ignore
+import signal  # type: ignore
+import threading  # type: ignore
+import time  # type: ignore
+import urllib.parse  # type: ignore
+
+# Webhook mode. Telegram POSTs every update to a small HTTP server in the
+# main process, which passes it on to one of several shard processes chosen
+# by its chat, so the commands of different chats run in different
+# interpreters. Inside its shard the updates of a chat are handled one after
+# another by whichever of the shard's threads is free, so a slow command
+# only holds up its own chat.
+#
+# Telegram POSTs the updates of different chats at the same time, but those
+# of a chat one after another: it sends the next one once the server has
+# answered the last. The server only answers once the update is in the queue
+# of its shard, so the updates of a chat keep their order all the way to its
+# shard. When the queue of a shard stays full the server answers 503 and
+# Telegram sends that update again later, still before the next ones of its
+# chat; the other shards go on meanwhile.
+#
+# The shards are forked once the main process has loaded the graphs and the
+# catalog, so they start with them in memory. What a shard needs on its own
+# (its route workers, its session store connection...) is made by the setup
+# function it is given, after the fork. They are forked by a supervisor
+# process, itself forked before the server starts any thread, which starts
+# again the shards that die. Each shard reads its updates from a pipe the
+# supervisor keeps open, so a shard started again reads the updates the one
+# that died had not read yet.
+
+Update: TypeAlias = Dict[str, Any]  # as decoded from the JSON Telegram sends
+Handle: TypeAlias = Callable[[Update], None]
+Setup: TypeAlias = Callable[[int], Handle]  # shard index -> its handle
+Teardown: TypeAlias = Callable[[], None]
+
+WEBHOOK_HOST: str = "0.0.0.0"
+WEBHOOK_PORT: int = 8443
+# Shard processes, threads of every shard and updates that may wait for
+# each shard.
+SHARDS: int = os.cpu_count() or 1
+THREADS: int = 8
+MAX_PENDING: int = 1024
+# Seconds the server waits for room in the queue of a shard, and seconds the
+# supervisor waits before starting again a shard that died.
+QUEUE_TIMEOUT: float = 5
+RESTART_DELAY: float = 1
+# Ids of the last updates queued, remembered to drop them if they come
+# again.
+RECENT_UPDATES: int = 4096
+# Connections that may wait to be accepted; Telegram opens up to 40 at once
+# by default, and up to 100.
+BACKLOG: int = 128
+# Largest update accepted, in bytes; Telegram's are a few kilobytes.
+MAX_BODY: int = 1 << 20
+
+
+def secret_token(token: str) -> str:
+    """Returns the secret Telegram sends with every update, made from the
+       bot token so it does not need to be configured"""
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+def path_of(url: str) -> str:
+    """Returns the path the updates sent to url are POSTed to"""
+    return urllib.parse.urlsplit(url).path or "/"
+
+
+def chat_id(update: Update) -> Optional[int]:
+    """Returns the id of the chat of an update, or of its user when it has
+       no chat (like inline queries); None if it has neither"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        if "chat" in value:
+            return value["chat"]["id"]
+        if isinstance(value.get("message"), dict) and \
+                "chat" in value["message"]:
+            return value["message"]["chat"]["id"]
+        if "from" in value:
+            return value["from"]["id"]
+    return None
+
+
+def shard_of(update: Update, shards: int) -> int:
+    """Returns the shard that handles the updates of the chat of update"""
+    chat: Optional[int] = chat_id(update)
+    return 0 if chat is None else chat % shards
+
+
+class _Chats:
+    """Handles updates with a number of threads: the updates of a chat one
+       at a time and in the order they were put, those of different chats
+       at the same time. Updates without a chat are handled on their own."""
+
+    def __init__(self, handle: Handle, threads: int) -> None:
+        self.handle: Handle = handle
+        # Updates of every chat that has some; the first one is being
+        # handled, or the chat is waiting in _ready for a thread.
+        self._pending: Dict[Hashable, Deque[Update]] = {}
+        self._ready: "queue.Queue[Optional[Hashable]]" = queue.Queue()
+        self._lock = threading.Condition()
+        self._threads: List[threading.Thread] = [
+            threading.Thread(target=self._work, name="chats %d" % i)
+            for i in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, update: Update) -> None:
+        chat: Optional[int] = chat_id(update)
+        key: Hashable = chat if chat is not None else \
+            ("update", update.get("update_id"))
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].append(update)
+                return
+            self._pending[key] = deque([update])
+        self._ready.put(key)
+
+    def stop(self) -> None:
+        """Handles the updates already put and stops the threads"""
+        with self._lock:
+            while self._pending:
+                self._lock.wait()
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self) -> None:
+        while True:
+            key: Optional[Hashable] = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                update: Update = self._pending[key][0]
+            try:
+                self.handle(update)
+            except Exception as e:
+                print("could not handle update %s: %r"
+                      % (update.get("update_id"), e))
+            with self._lock:
+                updates: Deque[Update] = self._pending[key]
+                updates.popleft()
+                if not updates:
+                    del self._pending[key]
+                    self._lock.notify_all()
+            if updates:
+                self._ready.put(key)
+
+
+def _run_shard(index: int, threads: int, setup: Setup,
+               teardown: Optional[Teardown],
+               updates: multiprocessing.connection.Connection) -> None:
+    """Main function of shard index: hands the updates it reads to its
+       threads until it reads None or the server process is gone"""
+    # The server stops the shards itself, after the updates it accepted.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    chats = _Chats(setup(index), threads)
+    while True:
+        try:
+            update: Optional[Update] = updates.recv()
+        except EOFError:
+            # Only the server has the pipe open for writing.
+            break
+        if update is None:
+            break
+        chats.put(update)
+    chats.stop()
+    if teardown is not None:
+        teardown()
+
+
+def _supervise(threads: int, setup: Setup, teardown: Optional[Teardown],
+               readers: List[multiprocessing.connection.Connection],
+               writers: List[multiprocessing.connection.Connection]) -> None:
+    """Main function of the supervisor: forks a shard for every reader and
+       starts again the ones that die, until all of them have stopped"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # So the shards read the end of their pipe once the server is gone.
+    for writer in writers:
+        writer.close()
+    context = multiprocessing.get_context("fork")
+
+    def fork(index: int) -> multiprocessing.Process:
+        process = context.Process(
+            target=_run_shard, name="shard %d" % index,
+            args=(index, threads, setup, teardown, readers[index]))
+        process.start()
+        return process
+    shards: Dict[int, multiprocessing.Process] = {
+        index: fork(index) for index in range(len(readers))}
+    while shards:
+        multiprocessing.connection.wait(
+            [process.sentinel for process in shards.values()])
+        for index, process in list(shards.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            if process.exitcode == 0:
+                del shards[index]
+                continue
+            # The updates it had read are lost, the ones still in the pipe
+            # go to the new shard.
+            print("shard %d exited with code %s, starting it again"
+                  % (index, process.exitcode))
+            time.sleep(RESTART_DELAY)
+            shards[index] = fork(index)
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    request_queue_size = BACKLOG
+    daemon_threads = True
+
+
+class WebhookServer:
+    """HTTP server that receives the updates at http://host:port/path and
+       passes them to the shards. Only requests with the secret token are
+       accepted. Every shard calls setup when it starts and teardown, if it
+       is given, when it stops; a shard that dies is started again."""
+
+    def __init__(self, setup: Setup, secret: str, shards: int = SHARDS,
+                 threads: int = THREADS, host: str = WEBHOOK_HOST,
+                 port: int = WEBHOOK_PORT, path: str = "/",
+                 teardown: Optional[Teardown] = None) -> None:
+        self.setup: Setup = setup
+        self.teardown: Optional[Teardown] = teardown
+        self.secret: str = secret
+        self.shards: int = shards
+        self.threads: int = threads
+        self.path: str = path
+        self.address = (host, port)
+        # Updates waiting to be written to the pipe of every shard, and the
+        # threads that write them.
+        self._queues: List["queue.Queue[Optional[Update]]"] = []
+        self._senders: List[threading.Thread] = []
+        self._supervisor: Optional[multiprocessing.Process] = None
+        self._server: Optional[_HTTPServer] = None
+        self._recent: Set[int] = set()
+        self._order: Deque[int] = deque()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """Forks the supervisor of the shards and then starts the HTTP
+           server. Call it before the process starts any other thread."""
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("webhook mode needs the fork start method")
+        context = multiprocessing.get_context("fork")
+        readers: List[multiprocessing.connection.Connection] = []
+        writers: List[multiprocessing.connection.Connection] = []
+        for _ in range(self.shards):
+            reader, writer = context.Pipe(duplex=False)
+            readers.append(reader)
+            writers.append(writer)
+        self._supervisor = context.Process(
+            target=_supervise, name="shards",
+            args=(self.threads, self.setup, self.teardown, readers, writers))
+        self._supervisor.start()
+        for reader in readers:
+            reader.close()
+        for index, writer in enumerate(writers):
+            updates: "queue.Queue[Optional[Update]]" = \
+                queue.Queue(MAX_PENDING)
+            sender = threading.Thread(target=self._send,
+                                      args=(index, updates, writer),
+                                      name="shard %d" % index)
+            sender.start()
+            self._queues.append(updates)
+            self._senders.append(sender)
+        self._server = _HTTPServer(self.address, _WebhookHandler)
+        self._server.webhook = self  # type: ignore
+        # The port the server got, if it was given 0.
+        self.address = self._server.server_address[:2]
+        threading.Thread(target=self._server.serve_forever, name="webhook",
+                         daemon=True).start()
+
+    def _send(self, index: int, updates: "queue.Queue[Optional[Update]]",
+              writer: multiprocessing.connection.Connection) -> None:
+        """Writes the updates queued for shard index to its pipe, waiting
+           while the pipe is full, until it gets None"""
+        while True:
+            update: Optional[Update] = updates.get()
+            try:
+                writer.send(update)
+            except OSError as e:
+                print("could not pass update %s to shard %d: %r"
+                      % (update and update.get("update_id"), index, e))
+            if update is None:
+                writer.close()
+                return
+
+    def dispatch(self, update: Update) -> bool:
+        """Queues update for its shard; returns False if the shard has had
+           too many updates waiting for QUEUE_TIMEOUT seconds. Updates that
+           were already queued are dropped."""
+        update_id: Any = update.get("update_id")
+        with self._lock:
+            if update_id in self._recent:
+                return True
+        if self._stopped.is_set():
+            return False
+        try:
+            self._queues[shard_of(update, self.shards)].put(
+                update, timeout=QUEUE_TIMEOUT)
+        except queue.Full:
+            return False
+        if isinstance(update_id, int):
+            with self._lock:
+                self._recent.add(update_id)
+                self._order.append(update_id)
+                if len(self._order) > RECENT_UPDATES:
+                    self._recent.discard(self._order.popleft())
+        return True
+
+    def wait(self) -> None:
+        """Blocks until stop() is called or the process gets SIGINT or
+           SIGTERM, and then stops"""
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: self._stopped.set())
+        self._stopped.wait()
+        self.stop()
+
+    def stop(self) -> None:
+        """Stops receiving updates and waits for the shards to handle the
+           ones they already have"""
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for updates in self._queues:
+            updates.put(None)
+        for sender in self._senders:
+            sender.join()
+        if self._supervisor is not None:
+            self._supervisor.join()
+            self._supervisor = None
+        self._queues, self._senders = [], []
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self) -> None:
+        webhook: WebhookServer = self.server.webhook  # type: ignore
+        # Requests from anyone else are turned down before their body is
+        # read.
+        if urllib.parse.urlsplit(self.path).path != webhook.path or \
+                not hmac.compare_digest(
+                    self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""),
+                    webhook.secret):
+            self.send_error(403)
+            return
+        try:
+            length: int = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.send_error(400)
+            return
+        if not 0 <= length <= MAX_BODY:
+            self.send_error(413)
+            return
+        try:
+            update: Update = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+        if not isinstance(update, dict):
+            self.send_error(400)
+            return
+        if not webhook.dispatch(update):
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Updates are not worth a line each.
+        pass
@@ -0,0 +1,165 @@
+from concurrent.futures import Future, ProcessPoolExecutor  # type: ignore
+from typing import Any, Callable, Dict, List, Optional, Tuple  # type: ignore
+from typing import TypeAlias  # type: ignore
+import multiprocessing  # type: ignore
+import threading  # type: ignore
+import io  # type: ignore
+import os  # type: ignore
+import city  # type: ignore
+import routing  # type: ignore
+import store  # type: ignore
+import timing  # type: ignore
+
+# Routes are computed and drawn by a pool of worker processes, so a slow
+# /guide only keeps one worker busy and the handlers of the other commands
+# keep running. The workers are forked after main() has filled the store, so
+# they start with the graphs already in memory. Every job carries the
+# generation of the store of the bot, and a worker whose graphs are older
+# loads them again (with new caches) before it runs the job.
+
+Coord: TypeAlias = Tuple[float, float]
+
+# Number of worker processes, seconds a handler waits for its job and number
+# of jobs that may be waiting or running at the same time.
+WORKERS: int = os.cpu_count() or 1
+JOB_TIMEOUT: float = 30
+MAX_QUEUE: int = 32
+# Search mode of the routes (see routing.MODES). The compiled Dijkstra is
+# faster than the pure Python contraction hierarchy queries on the city.
+ROUTE_MODE: str = "dijkstra"
+
+
+class PoolBusy(Exception):
+    """Raised when the pool already has max_queue jobs"""
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+_max_queue: int = MAX_QUEUE
+_mode: str = ROUTE_MODE
+_pending: int = 0
+_lock = threading.Lock()
+
+
+def _graphs(generation: Optional[int]) -> store.Graphs:
+    """Returns the graphs of the worker, loading them again first if they
+       are not of the given generation of the store of the bot"""
+    graphs: store.Graphs = store.get()
+    if generation is not None and graphs.generation != generation:
+        graphs = store.reload(generation)
+    return graphs
+
+
+def route_job(src: Coord, dst: Coord, mode: str = ROUTE_MODE,
+              generation: Optional[int] = None
+              ) -> Tuple[bytes, int, Dict[str, float]]:
+    """Returns the png image of the route between src and dst, found with
+       the given search mode, how many minutes it takes and the seconds
+       taken by every stage of the job. It runs inside a worker process,
+       with the graphs of the given generation."""
+    timer = timing.Timer()
+    with timer.stage("graphs"):
+        graphs: store.Graphs = _graphs(generation)
+    # Without a hierarchy built offline (see store.build_hierarchy) "ch"
+    # falls back to the plain search.
+    if mode == "ch" and graphs.routing_graph.hierarchy is None:
+        mode = "dijkstra"
+    path, total_time = city.find_route(graphs.spatial_index,
+                                       graphs.routing_graph, src, dst, mode,
+                                       graphs.routes, timer)
+    # The image is drawn into memory; the same route between the same
+    # points is only drawn once.
+    with timer.stage("render"):
+        key = (tuple(path), src, dst)
+        image: Optional[bytes] = graphs.images.get(key)
+        if image is None:
+            buffer = io.BytesIO()
+            city.plot_path(graphs.routing_graph, path, buffer, src, dst)
+            image = buffer.getvalue()
+            graphs.images.put(key, image, len(image))
+    return image, total_time, timer.seconds()
+
+
+def travel_times_job(src: Coord, places: List[int],
+                     generation: Optional[int] = None
+                     ) -> List[Optional[int]]:
+    """Returns the minutes from src to each of places, graph nodes snapped
+       beforehand (see city.travel_times_to). It runs inside a worker
+       process, with the graphs of the given generation."""
+    graphs: store.Graphs = _graphs(generation)
+    return city.travel_times_to(graphs.spatial_index, graphs.routing_graph,
+                                src, places)
+
+
+def _ready() -> int:
+    """Job used to start the workers; returns the generation of their
+       store"""
+    return store.get().generation
+
+
+def start(workers: int = WORKERS, max_queue: int = MAX_QUEUE,
+          city_filename: str = "city_graph", mode: str = ROUTE_MODE) -> None:
+    """Starts the worker processes, which search the routes with the given
+       mode. Call it after store.load() and store.freeze() and before
+       starting the bot, so the workers are forked from a process that holds
+       the graphs and has no other threads yet."""
+    global _executor, _max_queue, _mode
+    if mode not in routing.MODES:
+        raise ValueError("Unknown search mode %s" % mode)
+    # Where fork is not available the workers load the graphs themselves.
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods()
+        else None)
+    _max_queue, _mode = max_queue, mode
+    _executor = ProcessPoolExecutor(workers, mp_context=context,
+                                    initializer=store.load,
+                                    initargs=(city_filename,))
+    # With fork all the workers are started by the first job.
+    _executor.submit(_ready).result()
+
+
+def _finished(future: Future) -> None:
+    global _pending
+    with _lock:
+        _pending -= 1
+
+
+def _submit(job: Callable[..., Any], *args: Any) -> Future:
+    """Queues job(*args) in the pool. Raises PoolBusy if there are too many
+       jobs already."""
+    global _pending
+    if _executor is None:
+        raise RuntimeError("the worker pool has not been started")
+    with _lock:
+        if _pending >= _max_queue:
+            raise PoolBusy("%d jobs are already queued" % _pending)
+        _pending += 1
+    try:
+        future: Future = _executor.submit(job, *args)
+    except Exception:
+        with _lock:
+            _pending -= 1
+        raise
+    future.add_done_callback(_finished)
+    return future
+
+
+def submit_route(src: Coord, dst: Coord) -> Future:
+    """Queues the computation of the route between src and dst; the future
+       gives what route_job() returns. Raises PoolBusy if there are too many
+       jobs already."""
+    return _submit(route_job, src, dst, _mode, store.get().generation)
+
+
+def submit_travel_times(src: Coord, places: List[int]) -> Future:
+    """Queues the search of the minutes from src to each of places; the
+       future gives what travel_times_job() returns. Raises PoolBusy if there
+       are too many jobs already."""
+    return _submit(travel_times_job, src, places, store.get().generation)
+
+
+def shutdown() -> None:
+    """Stops the workers once they finish their jobs"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None